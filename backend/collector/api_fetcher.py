@@ -22,6 +22,7 @@ from collector.config import (
     get_supabase,
 )
 from collector.poller import get_cast_session, get_live_casts
+from services.vip_checker import update_vip_index
 
 logger = logging.getLogger(__name__)
 
@@ -287,6 +288,7 @@ async def save_payers(
                     on_conflict="account_id,user_name",
                 ).execute()
                 saved += len(rows)
+                update_vip_index(account_id, rows)
             except Exception as e:
                 logger.error(f"paid_users upsert失敗: {e}")
 
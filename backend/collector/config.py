@@ -86,6 +86,18 @@ WS_MAX_CONSECUTIVE_FAILURES = 3         # → Telegramアラート
 # レート制限
 RATE_LIMIT_429_WAIT = 60    # 429受信時の待機秒数
 
+# ---------------------------------------------------------------------------
+# ロギング
+# ---------------------------------------------------------------------------
+LOG_FILE = os.environ.get("COLLECTOR_LOG_FILE", str(Path(__file__).parent / "spy.log"))
+LOG_FORMAT = os.environ.get("COLLECTOR_LOG_FORMAT", "text")        # text | json
+LOG_FILE_LEVEL = os.environ.get("COLLECTOR_LOG_LEVEL", "DEBUG")
+LOG_MAX_BYTES = int(os.environ.get("COLLECTOR_LOG_MAX_BYTES", 20 * 1024 * 1024))  # 20MBでローテート
+LOG_ROTATE_WHEN = os.environ.get("COLLECTOR_LOG_ROTATE_WHEN", "midnight")         # 日次でもローテート
+LOG_BACKUP_COUNT = int(os.environ.get("COLLECTOR_LOG_BACKUP_COUNT", 7))
+LOG_QUEUE_SIZE = 10000      # ログキュー上限（超過分は破棄してカウント）
+LOG_CHAT_SAMPLE_RATE = int(os.environ.get("COLLECTOR_LOG_CHAT_SAMPLE_RATE", 50))  # チャットDEBUGログは N件に1件
+
 # ---------------------------------------------------------------------------
 # Telegram通知（未設定ならログのみ）
 # ---------------------------------------------------------------------------
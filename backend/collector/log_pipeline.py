@@ -0,0 +1,184 @@
+"""
+ロギングパイプライン — QueueHandler + リスナースレッドで I/O をイベントループから分離
+
+- ルートロガーには QueueHandler だけを付け、フォーマット・ファイル書き込みは
+  リスナースレッド側で行う（イベントループはレコードをキューに積むだけ）
+- キューは上限付き。溢れた分は破棄して件数のみ記録する
+- ファイルはサイズ・時刻の両方でローテート（spy.log が無制限に肥大化しない）
+- COLLECTOR_LOG_FORMAT=json で1行1JSONの構造化ログを出力
+"""
+
+import atexit
+import json
+import logging
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime, timezone
+
+from collector.config import (
+    LOG_BACKUP_COUNT,
+    LOG_CHAT_SAMPLE_RATE,
+    LOG_FILE,
+    LOG_FILE_LEVEL,
+    LOG_FORMAT,
+    LOG_MAX_BYTES,
+    LOG_QUEUE_SIZE,
+    LOG_ROTATE_WHEN,
+)
+
+_TEXT_FORMAT = "%(asctime)s [%(levelname)s] %(name)s: %(message)s"
+_DATE_FORMAT = "%Y-%m-%d %H:%M:%S"
+
+_listener: logging.handlers.QueueListener | None = None
+_queue_handler: "DroppingQueueHandler | None" = None
+
+
+class JsonFormatter(logging.Formatter):
+    """1レコード = 1行のJSON"""
+
+    def format(self, record: logging.LogRecord) -> str:
+        entry = {
+            "ts": datetime.fromtimestamp(record.created, timezone.utc).isoformat(),
+            "level": record.levelname,
+            "logger": record.name,
+            "msg": record.getMessage(),
+        }
+        if record.exc_info:
+            entry["exc"] = self.formatException(record.exc_info)
+        return json.dumps(entry, ensure_ascii=False)
+
+
+class SizedTimedRotatingFileHandler(logging.handlers.TimedRotatingFileHandler):
+    """時刻ローテートに加えて、maxBytes 超過でもローテートする"""
+
+    def __init__(self, filename: str, max_bytes: int = 0, **kwargs):
+        super().__init__(filename, **kwargs)
+        self.max_bytes = max_bytes
+
+    def shouldRollover(self, record: logging.LogRecord) -> bool:
+        if super().shouldRollover(record):
+            return True
+        if self.max_bytes > 0 and self.stream is not None:
+            self.stream.seek(0, 2)
+            if self.stream.tell() + len(self.format(record)) + 1 >= self.max_bytes:
+                return True
+        return False
+
+    def rotation_filename(self, default_name: str) -> str:
+        # 同一時刻枠で複数回ローテートした場合に上書きしない
+        name = super().rotation_filename(default_name)
+        n = 1
+        candidate = name
+        while os.path.exists(candidate):
+            candidate = f"{name}.{n}"
+            n += 1
+        return candidate
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    フォーマットせずにレコードをキューへ積む QueueHandler。
+
+    標準の prepare() は呼び出し元スレッドで format() するため、
+    メッセージ整形はリスナースレッドまで遅延させる。
+    キュー満杯時は例外を出さずに破棄し、dropped に件数を残す。
+    """
+
+    def __init__(self, q: queue.Queue):
+        super().__init__(q)
+        self.dropped = 0
+
+    def prepare(self, record: logging.LogRecord) -> logging.LogRecord:
+        return record
+
+    def enqueue(self, record: logging.LogRecord):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class ChatLogSampler:
+    """
+    チャット1件ごとのDEBUGログを N件に1件へ間引く。
+
+    DEBUG無効時は isEnabledFor() だけで即 False を返すため、
+    ホットパスでは文字列整形が一切発生しない。
+    """
+
+    def __init__(self, logger: logging.Logger, rate: int = LOG_CHAT_SAMPLE_RATE):
+        self._logger = logger
+        self._rate = max(1, rate)
+        self._count = 0
+
+    def should_log(self) -> bool:
+        if not self._logger.isEnabledFor(logging.DEBUG):
+            return False
+        self._count += 1
+        return self._count % self._rate == 1 or self._rate == 1
+
+
+def _build_formatter() -> logging.Formatter:
+    if LOG_FORMAT == "json":
+        return JsonFormatter()
+    return logging.Formatter(_TEXT_FORMAT, datefmt=_DATE_FORMAT)
+
+
+def start_logging():
+    """QueueHandler をルートに設定し、リスナースレッドを起動"""
+    global _listener, _queue_handler
+    if _listener is not None:
+        return
+
+    formatter = _build_formatter()
+
+    # Console
+    console = logging.StreamHandler(sys.stdout)
+    console.setFormatter(formatter)
+    console.setLevel(logging.INFO)
+
+    # File（サイズ+時刻ローテート）
+    os.makedirs(os.path.dirname(os.path.abspath(LOG_FILE)), exist_ok=True)
+    file_handler = SizedTimedRotatingFileHandler(
+        LOG_FILE,
+        max_bytes=LOG_MAX_BYTES,
+        when=LOG_ROTATE_WHEN,
+        backupCount=LOG_BACKUP_COUNT,
+        encoding="utf-8",
+        utc=True,
+    )
+    file_handler.setFormatter(formatter)
+    file_level = logging.getLevelName(LOG_FILE_LEVEL.upper())
+    if not isinstance(file_level, int):
+        file_level = logging.DEBUG
+    file_handler.setLevel(file_level)
+
+    _queue_handler = DroppingQueueHandler(queue.Queue(maxsize=LOG_QUEUE_SIZE))
+    _listener = logging.handlers.QueueListener(
+        _queue_handler.queue, console, file_handler, respect_handler_level=True
+    )
+
+    root = logging.getLogger()
+    # ルートレベルはハンドラの最小レベルに合わせ、不要なレコード生成を避ける
+    root.setLevel(min(logging.INFO, file_level))
+    root.addHandler(_queue_handler)
+    _listener.start()
+    atexit.register(stop_logging)
+
+
+def stop_logging():
+    """キューを排出してリスナースレッドを停止"""
+    global _listener, _queue_handler
+    if _listener is None:
+        return
+    if _queue_handler is not None:
+        if _queue_handler.dropped:
+            logging.getLogger("collector").warning(
+                "ログキュー溢れで %d 件破棄", _queue_handler.dropped
+            )
+        logging.getLogger().removeHandler(_queue_handler)
+    _listener.stop()
+    _listener = None
+    _queue_handler = None
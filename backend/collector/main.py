@@ -22,35 +22,15 @@ import sys
 from datetime import datetime, timezone
 
 from collector.config import get_all_monitored_casts, get_monitored_casts, get_supabase
+from collector.log_pipeline import start_logging, stop_logging
 from collector.session_manager import SessionManager, send_telegram
 
 logger = logging.getLogger("collector")
 
 
 def setup_logging():
-    """ロギング設定"""
-    formatter = logging.Formatter(
-        "%(asctime)s [%(levelname)s] %(name)s: %(message)s",
-        datefmt="%Y-%m-%d %H:%M:%S",
-    )
-
-    # Console
-    console = logging.StreamHandler(sys.stdout)
-    console.setFormatter(formatter)
-    console.setLevel(logging.INFO)
-
-    # File
-    file_handler = logging.FileHandler(
-        "C:/dev/livespot/backend/collector/spy.log",
-        encoding="utf-8",
-    )
-    file_handler.setFormatter(formatter)
-    file_handler.setLevel(logging.DEBUG)
-
-    root = logging.getLogger()
-    root.setLevel(logging.DEBUG)
-    root.addHandler(console)
-    root.addHandler(file_handler)
+    """ロギング設定（QueueHandler経由でファイルI/Oは別スレッド）"""
+    start_logging()
 
     # httpx/websocketsの過剰ログを抑制
     logging.getLogger("httpx").setLevel(logging.WARNING)
@@ -169,6 +149,7 @@ async def main():
         await manager.stop()
         await send_telegram("🛑 <b>SPY Pipeline 停止</b>")
         logger.info("SPY Pipeline 正常終了")
+        stop_logging()
 
 
 if __name__ == "__main__":
@@ -39,6 +39,10 @@ from collector.config import (
     WS_URL,
     get_supabase,
 )
+from collector.log_pipeline import ChatLogSampler
+from services.vip_checker import (
+    classify_comment, evaluate_vip, is_vip_user, pickup_columns, refresh_vip_index_sync,
+)
 
 logger = logging.getLogger(__name__)
 
@@ -203,6 +207,7 @@ class CentrifugoClient:
 
         # メッセージバッファ（バッチINSERT用）
         self._buffer: list[dict] = []
+        self._chat_log_sampler = ChatLogSampler(logger)
         self._flush_task: asyncio.Task | None = None
 
     @property
@@ -222,9 +227,20 @@ class CentrifugoClient:
             return
         self._running = True
         self._consecutive_failures = 0
+        await self._refresh_vip_index()
         self._receive_task = asyncio.create_task(self._connection_loop())
         self._flush_task = asyncio.create_task(self._flush_loop())
 
+    async def _refresh_vip_index(self):
+        """paid_users の VIP 索引を読込・差分取り込み（失敗しても受信は継続）
+
+        sync クライアントのページング読込なので、受信ループを止めないようスレッドで実行する。
+        """
+        try:
+            await asyncio.to_thread(refresh_vip_index_sync, get_supabase(), self.account_id)
+        except Exception as e:
+            logger.warning(f"{self.cast_name}: VIP索引の更新失敗: {e}")
+
     async def disconnect(self):
         """切断してバックグラウンドタスクをクリーンアップ"""
         self._running = False
@@ -349,7 +365,7 @@ class CentrifugoClient:
                     "id": self._msg_id,
                 })
                 await ws.send(sub_cmd)
-                logger.debug(f"{self.cast_name}: SUB → {channel}")
+                logger.debug("%s: SUB → %s", self.cast_name, channel)
 
             # keepalive起動
             self._keepalive_task = asyncio.create_task(self._keepalive(ws))
@@ -390,13 +406,13 @@ class CentrifugoClient:
         except asyncio.CancelledError:
             pass
         except Exception as e:
-            logger.debug(f"{self.cast_name}: keepaliveエラー: {e}")
+            logger.debug("%s: keepaliveエラー: %s", self.cast_name, e)
 
     def _handle_frame(self, frame: dict):
         """受信フレーム1つを処理"""
         # Subscribe確認
         if frame.get("id") and frame.get("subscribe"):
-            logger.debug(f"{self.cast_name}: SUB OK id={frame['id']}")
+            logger.debug("%s: SUB OK id=%s", self.cast_name, frame["id"])
             return
 
         # Subscribe/その他エラー
@@ -424,7 +440,7 @@ class CentrifugoClient:
         elif event == "newModelEvent":
             self._on_model_event(pub_data)
         elif event == "userUpdated":
-            logger.debug(f"{self.cast_name}: USER_UPDATED")
+            logger.debug("%s: USER_UPDATED", self.cast_name)
 
     def _on_chat(self, data: dict):
         """チャット/チップメッセージを処理"""
@@ -433,18 +449,24 @@ class CentrifugoClient:
             return
 
         self.message_count += 1
+        vip_alert = evaluate_vip(self.account_id, parsed["user_name"])
+        if vip_alert:
+            logger.info("%s: VIP %s", self.cast_name, vip_alert["alert_message"])
         if parsed["tokens"] > 0:
             self.tip_total += parsed["tokens"]
             logger.info(
-                f"{self.cast_name}: TIP {parsed['user_name']} "
-                f"{parsed['tokens']}tk \"{parsed['message'][:40]}\""
+                '%s: TIP %s %stk "%.40s"',
+                self.cast_name, parsed["user_name"], parsed["tokens"], parsed["message"],
             )
-        else:
+        elif self._chat_log_sampler.should_log():
+            # チャットは件数が多いため間引いてDEBUG出力
             logger.debug(
-                f"{self.cast_name}: CHAT {parsed['user_name']}: "
-                f"{parsed['message'][:60]}"
+                "%s: CHAT %s: %.60s (#%d)",
+                self.cast_name, parsed["user_name"], parsed["message"], self.message_count,
             )
 
+        classification = classify_comment(parsed["message"], parsed["msg_type"], parsed["tokens"])
+        classification["is_whale"] = is_vip_user(self.account_id, parsed["user_name"])
         row = {
             "account_id": self.account_id,
             "cast_name": self.cast_name,
@@ -453,7 +475,8 @@ class CentrifugoClient:
             "user_name": parsed["user_name"],
             "message": parsed["message"],
             "tokens": parsed["tokens"],
-            "is_vip": parsed["is_vip"],
+            "is_vip": parsed["is_vip"] or classification["is_whale"],
+            **pickup_columns(classification),
             "session_id": self.session_id,
             "user_league": parsed["user_league"] or None,
             "user_level": parsed["user_level"] or None,
@@ -471,7 +494,7 @@ class CentrifugoClient:
     def _on_model_event(self, data: dict):
         """モデルイベントを処理"""
         event_type = str(data.get("event") or data.get("type") or "unknown")
-        logger.info(f"{self.cast_name}: EVENT {event_type}")
+        logger.info("%s: EVENT %s", self.cast_name, event_type)
 
         row = {
             "account_id": self.account_id,
@@ -496,6 +519,7 @@ class CentrifugoClient:
             while self._running:
                 await asyncio.sleep(30)
                 await self._flush_buffer()
+                await self._refresh_vip_index()
         except asyncio.CancelledError:
             pass
 
@@ -514,7 +538,7 @@ class CentrifugoClient:
             for i in range(0, len(rows), batch_size):
                 batch = rows[i : i + batch_size]
                 sb.table("spy_messages").insert(batch).execute()
-            logger.debug(f"{self.cast_name}: spy_messages {len(rows)}件 INSERT")
+            logger.debug("%s: spy_messages %d件 INSERT", self.cast_name, len(rows))
         except Exception as e:
             logger.error(f"{self.cast_name}: spy_messages INSERT失敗: {e}")
             # 失敗分はバッファに戻す（次回フラッシュで再試行）
@@ -1,7 +1,9 @@
 """Configuration and Supabase client setup"""
 import os
 import re
+import threading
 from functools import lru_cache
+import httpx
 from pydantic_settings import BaseSettings
 
 # ============================================================
@@ -40,6 +42,9 @@ def _patched_init(self, supabase_url, supabase_key, options=None):
 _sb_sync.SyncClient.__init__ = _patched_init
 
 from supabase import create_client, Client
+from postgrest import AsyncPostgrestClient, SyncPostgrestClient
+from postgrest.utils import AsyncClient as _AsyncPostgrestSession
+from postgrest.utils import SyncClient as _PostgrestSession
 
 
 class Settings(BaseSettings):
@@ -47,6 +52,12 @@ class Settings(BaseSettings):
     supabase_url: str = ""
     supabase_service_key: str = ""
     supabase_jwt_secret: str = ""
+    supabase_pool_size: int = 50          # PostgREST への同時接続上限（プロセス全体）
+    supabase_pool_keepalive: int = 20     # keep-alive で保持する接続数
+    supabase_timeout: float = 30.0        # API ハンドラ用 async クライアントのタイムアウト（秒）
+    auth_token_cache_size: int = 10000    # 検証済みJWTキャッシュの上限件数
+    jwks_refresh_interval: int = 600      # JWKS 公開鍵のバックグラウンド更新間隔（秒）
+    account_context_ttl: float = 30.0     # アカウントコンテキスト（所有権・設定・プラン上限）のキャッシュ秒数
 
     # Anthropic
     anthropic_api_key: str = ""
@@ -65,15 +76,156 @@ def get_settings() -> Settings:
     return Settings()
 
 
-def get_supabase_admin() -> Client:
-    """Service-role client for backend operations (bypasses RLS)"""
-    settings = get_settings()
-    return create_client(settings.supabase_url, settings.supabase_service_key)
+# ============================================================
+# Supabase クライアント（プロセス全体で1つのコネクションプールを共有）
+# ============================================================
+class PooledPostgrestClient(SyncPostgrestClient):
+    """共有 httpx transport 上で動く PostgREST クライアント
+
+    transport（= httpcore のコネクションプール）は全クライアントで共有し、
+    クライアントごとに持つのはヘッダ（Authorization）だけ。
+    共有 transport を閉じないよう、個別クライアントは close しないこと。
+    """
+
+    def __init__(self, base_url: str, *, transport: httpx.BaseTransport, **kwargs):
+        self._transport = transport
+        super().__init__(base_url, **kwargs)
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return _PostgrestSession(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            transport=self._transport,
+            follow_redirects=True,
+        )
+
+
+class AsyncPooledPostgrestClient(AsyncPostgrestClient):
+    """API ハンドラ用の非同期 PostgREST クライアント（service-role）
+
+    FastAPI の async ハンドラから await で呼ぶため、クエリ待ちの間も
+    イベントループは他のリクエストを処理できる。
+    """
+
+    def __init__(self, base_url: str, *, limits: httpx.Limits, **kwargs):
+        self._limits = limits
+        super().__init__(base_url, **kwargs)
+
+    def create_session(self, base_url, headers, timeout, verify=True, proxy=None):
+        return _AsyncPostgrestSession(
+            base_url=base_url,
+            headers=headers,
+            timeout=timeout,
+            verify=verify,
+            proxy=proxy,
+            follow_redirects=True,
+            http2=True,
+            limits=self._limits,
+        )
+
+    def rpc(self, func: str, params: dict | None = None, *args, **kwargs):
+        # supabase Client.rpc() と同じく params 省略可
+        return super().rpc(func, params or {}, *args, **kwargs)
+
+
+_client_lock = threading.Lock()
+_transport: httpx.HTTPTransport | None = None
+_admin_client: Client | None = None
+_async_client: AsyncPooledPostgrestClient | None = None
+
+
+def _get_transport() -> httpx.HTTPTransport:
+    global _transport
+    if _transport is None:
+        settings = get_settings()
+        _transport = httpx.HTTPTransport(
+            http2=True,
+            limits=httpx.Limits(
+                max_connections=settings.supabase_pool_size,
+                max_keepalive_connections=settings.supabase_pool_keepalive,
+            ),
+        )
+    return _transport
+
+
+def init_supabase() -> Client:
+    """Service-role クライアントを生成（起動時に1回だけ）
+
+    _patched_init は re.match を一時的に差し替えるためスレッドセーフではない。
+    ロック内で1度だけ実行し、以降は同じインスタンスを返す。
+    """
+    global _admin_client
+    if _admin_client is not None:
+        return _admin_client
+    with _client_lock:
+        if _admin_client is None:
+            settings = get_settings()
+            client = create_client(settings.supabase_url, settings.supabase_service_key)
+            # postgrest を共有プール版に差し替え（table()/rpc() はこれを経由する）
+            client._postgrest = PooledPostgrestClient(
+                client.rest_url,
+                headers=client.options.headers,
+                schema=client.options.schema,
+                timeout=client.options.postgrest_client_timeout,
+                transport=_get_transport(),
+            )
+            _admin_client = client
+    return _admin_client
+
+
+def get_supabase_async() -> AsyncPooledPostgrestClient:
+    """Service-role の非同期クライアント（API ハンドラはこちらを使う）"""
+    global _async_client
+    if _async_client is None:
+        settings = get_settings()
+        if not settings.supabase_url or not settings.supabase_service_key:
+            raise RuntimeError("SUPABASE_URL / SUPABASE_SERVICE_KEY が未設定です")
+        _async_client = AsyncPooledPostgrestClient(
+            f"{settings.supabase_url.rstrip('/')}/rest/v1",
+            headers={
+                "apiKey": settings.supabase_service_key,
+                "Authorization": f"Bearer {settings.supabase_service_key}",
+            },
+            timeout=settings.supabase_timeout,
+            limits=httpx.Limits(
+                max_connections=settings.supabase_pool_size,
+                max_keepalive_connections=settings.supabase_pool_keepalive,
+            ),
+        )
+    return _async_client
+
+
+async def close_supabase():
+    """シャットダウン時にコネクションプールを閉じる"""
+    global _admin_client, _transport, _async_client
+    if _async_client is not None:
+        await _async_client.aclose()
+        _async_client = None
+    with _client_lock:
+        _admin_client = None
+        if _transport is not None:
+            _transport.close()
+            _transport = None
 
 
-def get_supabase_for_user(jwt_token: str) -> Client:
-    """User-scoped client that respects RLS"""
-    settings = get_settings()
-    client = create_client(settings.supabase_url, settings.supabase_service_key)
-    client.postgrest.auth(jwt_token)
-    return client
+def get_supabase_admin() -> Client:
+    """Service-role client for backend operations (bypasses RLS)"""
+    return _admin_client or init_supabase()
+
+
+def get_supabase_for_user(jwt_token: str) -> SyncPostgrestClient:
+    """User-scoped client that respects RLS
+
+    create_client は行わず、共有プール上の PostgREST クライアントに
+    Authorization ヘッダだけユーザーJWTへ差し替えたものを返す。
+    """
+    admin = get_supabase_admin()
+    headers = {**admin.options.headers, "Authorization": f"Bearer {jwt_token}"}
+    return PooledPostgrestClient(
+        admin.rest_url,
+        headers=headers,
+        schema=admin.options.schema,
+        timeout=admin.options.postgrest_client_timeout,
+        transport=_get_transport(),
+    )
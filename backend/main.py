@@ -7,15 +7,39 @@ from dotenv import load_dotenv
 
 load_dotenv()
 
+from config import init_supabase, get_supabase_async, close_supabase
 from routers import auth, dm, spy, sync, analytics, ai, scripts, reports, feed, stt, competitive
+from services.spy_ingest import start_spy_ingest, stop_spy_ingest, get_ingest_stats
+from services.adm_daemon import start_adm_daemon, stop_adm_daemon, get_adm_daemon_stats
+from services.analytics_cache import get_cache_stats
+from services.dm_notify import get_notify_stats
+from services.dm_trigger_ledger import get_ledger_stats
+from services.paying_users_refresh import start_paying_users_refresher, stop_paying_users_refresher, get_refresh_stats
+from services.db_maintenance import start_db_maintenance, stop_db_maintenance, get_db_maintenance_stats
 
 @asynccontextmanager
 async def lifespan(app: FastAPI):
     # Startup
     print("[LS] Morning Hook API starting...")
+    try:
+        init_supabase()
+        get_supabase_async()
+    except Exception as e:
+        print(f"[LS] Supabase client init failed (retry on first request): {e}")
+    auth.start_jwks_refresher()
+    start_spy_ingest()
+    start_paying_users_refresher()
+    start_adm_daemon()
+    start_db_maintenance()
     yield
     # Shutdown
     print("[LS] Morning Hook API shutting down...")
+    await stop_db_maintenance()
+    await stop_adm_daemon()
+    await stop_spy_ingest()
+    await stop_paying_users_refresher()
+    await auth.stop_jwks_refresher()
+    await close_supabase()
 
 app = FastAPI(
     title="Morning Hook API",
@@ -32,6 +56,7 @@ app.add_middleware(
     allow_credentials=True,
     allow_methods=["*"],
     allow_headers=["*"],
+    expose_headers=["X-Next-Cursor"],
 )
 
 # Routers
@@ -49,4 +74,15 @@ app.include_router(competitive.router, prefix="/api/competitive", tags=["Competi
 
 @app.get("/health")
 async def health():
-    return {"status": "ok", "service": "morninghook-api"}
+    return {
+        "status": "ok",
+        "service": "morninghook-api",
+        "auth": auth.get_auth_stats(),
+        "spy_ingest": get_ingest_stats(),
+        "paying_users_refresh": get_refresh_stats(),
+        "analytics_cache": get_cache_stats(),
+        "dm_notify": get_notify_stats(),
+        "adm_daemon": get_adm_daemon_stats(),
+        "dm_trigger_ledger": get_ledger_stats(),
+        "db_maintenance": get_db_maintenance_stats(),
+    }
@@ -51,6 +51,7 @@ class DMBatchCreate(BaseModel):
     send_order: str = "text-image"   # text-image, image-text, text-only
     send_mode: str = "sequential"    # sequential, pipeline
     concurrent_tabs: int = 1
+    skip_duplicates: bool = True     # 24h以内に同じキャストから送信済みのユーザーを除外
 
 
 class DMBatchResponse(BaseModel):
@@ -59,6 +60,10 @@ class DMBatchResponse(BaseModel):
     send_order: str
     send_mode: str
     concurrent_tabs: int
+    scheduled_until: Optional[str] = None  # 最後の1件の送信可能時刻（ペーシング後）
+    skipped_duplicates: int = 0
+    skipped_blacklisted: int = 0
+    skipped_over_quota: int = 0
 
 
 class DMBatchStatus(BaseModel):
@@ -68,7 +73,9 @@ class DMBatchStatus(BaseModel):
     sending: int
     success: int
     error: int
-    items: list[dict]
+    items: list[dict]          # cursor 以降にステータスが変わった行
+    cursor: int = 0            # 次回の since に渡す（採番直後の行の手前に留まる）
+    has_more: bool = False
 
 
 class DMStatusUpdate(BaseModel):
@@ -76,6 +83,29 @@ class DMStatusUpdate(BaseModel):
     error: Optional[str] = None
     sent_at: Optional[datetime] = None
 
+
+class DMQueueClaim(BaseModel):
+    """送信タブがキューからN件をリースする"""
+    account_id: str
+    worker_id: str                 # タブ/ブラウザごとに一意なID
+    limit: int = Field(default=10, ge=1, le=50)
+    lease_seconds: int = Field(default=300, ge=30, le=3600)
+    wait_seconds: int = Field(default=0, ge=0, le=60)  # 空なら最大この秒数待つ（long-poll）
+
+
+class DMQueueAckItem(BaseModel):
+    id: int
+    status: str  # success, error, sending(リース延長)
+    error: Optional[str] = None
+    sent_at: Optional[datetime] = None
+
+
+class DMQueueAck(BaseModel):
+    account_id: str
+    worker_id: str
+    results: list[DMQueueAckItem]
+    lease_seconds: int = Field(default=300, ge=30, le=3600)
+
 class DMTemplateCreate(BaseModel):
     account_id: str
     name: str
@@ -1,27 +1,21 @@
 """AI router - Live assist, daily report, DM suggestions"""
 from fastapi import APIRouter, Depends, HTTPException
-from config import get_supabase_admin, get_settings
-from routers.auth import get_current_user
+from config import get_supabase_async, get_settings
+from routers.auth import get_account_context, get_current_user
 from models.schemas import AIAssistRequest
 from services.llm_engine import generate_live_assist, generate_daily_report
 
 router = APIRouter()
 
 
-def _verify_account(sb, account_id: str, user_id: str):
-    result = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user_id).single().execute()
-    if not result.data:
-        raise HTTPException(status_code=404, detail="Account not found")
-
-
 @router.post("/live-assist")
 async def live_assist(body: AIAssistRequest, user=Depends(get_current_user)):
     """配信中AIアシスト（手動ボタン）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
     # Check AI usage limit
-    profile = sb.table("profiles").select("ai_used_this_month, max_ai_per_month").eq("id", user["user_id"]).single().execute()
+    profile = await sb.table("profiles").select("ai_used_this_month, max_ai_per_month").eq("id", user["user_id"]).single().execute()
     if profile.data["max_ai_per_month"] > 0 and profile.data["ai_used_this_month"] >= profile.data["max_ai_per_month"]:
         raise HTTPException(status_code=403, detail="Monthly AI limit reached")
 
@@ -33,7 +27,7 @@ async def live_assist(body: AIAssistRequest, user=Depends(get_current_user)):
     )
 
     # Save report
-    sb.table("ai_reports").insert({
+    await sb.table("ai_reports").insert({
         "account_id": body.account_id,
         "cast_name": body.cast_name,
         "report_type": "live_assist",
@@ -44,7 +38,7 @@ async def live_assist(body: AIAssistRequest, user=Depends(get_current_user)):
     }).execute()
 
     # Increment usage
-    sb.table("profiles").update({
+    await sb.table("profiles").update({
         "ai_used_this_month": profile.data["ai_used_this_month"] + 1
     }).eq("id", user["user_id"]).execute()
 
@@ -54,10 +48,10 @@ async def live_assist(body: AIAssistRequest, user=Depends(get_current_user)):
 @router.post("/daily-report")
 async def daily_report(body: AIAssistRequest, user=Depends(get_current_user)):
     """日次レポート生成"""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
-    profile = sb.table("profiles").select("ai_used_this_month, max_ai_per_month").eq("id", user["user_id"]).single().execute()
+    profile = await sb.table("profiles").select("ai_used_this_month, max_ai_per_month").eq("id", user["user_id"]).single().execute()
     if profile.data["max_ai_per_month"] > 0 and profile.data["ai_used_this_month"] >= profile.data["max_ai_per_month"]:
         raise HTTPException(status_code=403, detail="Monthly AI limit reached")
 
@@ -67,7 +61,7 @@ async def daily_report(body: AIAssistRequest, user=Depends(get_current_user)):
         context=body.context,
     )
 
-    sb.table("ai_reports").insert({
+    await sb.table("ai_reports").insert({
         "account_id": body.account_id,
         "cast_name": body.cast_name,
         "report_type": "daily_summary",
@@ -77,7 +71,7 @@ async def daily_report(body: AIAssistRequest, user=Depends(get_current_user)):
         "cost_usd": result["cost_usd"],
     }).execute()
 
-    sb.table("profiles").update({
+    await sb.table("profiles").update({
         "ai_used_this_month": profile.data["ai_used_this_month"] + 1
     }).eq("id", user["user_id"]).execute()
 
@@ -91,8 +85,8 @@ async def list_reports(
     limit: int = 20,
     user=Depends(get_current_user)
 ):
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
     query = (sb.table("ai_reports")
              .select("*")
              .eq("account_id", account_id)
@@ -100,4 +94,4 @@ async def list_reports(
              .limit(limit))
     if report_type:
         query = query.eq("report_type", report_type)
-    return query.execute().data
+    return (await query.execute()).data
@@ -5,17 +5,18 @@ from datetime import datetime, timedelta, timezone
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from typing import Optional
-from config import get_supabase_admin
-from routers.auth import get_current_user
+from config import get_supabase_async
+from routers.auth import get_account_context, get_current_user
+from services.analytics_cache import cached_rpc
+from services.dm_enqueue import DmQuotaExceededError, enqueue_dms
+from services.dm_pacing import PRIORITY_THANK_YOU
 
 router = APIRouter()
 
 
-def _verify_account(sb, account_id: str, user_id: str):
-    result = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user_id).single().execute()
-    if not result.data:
-        from fastapi import HTTPException
-        raise HTTPException(status_code=404, detail="Account not found")
+def _since(days: int) -> str:
+    """期間の起点。分単位に丸めて RPC キャッシュのキーを安定させる"""
+    return (datetime.utcnow() - timedelta(days=days)).replace(second=0, microsecond=0).isoformat()
 
 
 # ============================================================
@@ -30,15 +31,14 @@ async def daily_sales(
     user=Depends(get_current_user)
 ):
     """日別売上（棒グラフ用）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
+    since = _since(days)
 
     params = {"p_account_id": account_id, "p_since": since}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("daily_sales", params).execute()
-    return result.data
+    return await cached_rpc(sb, "daily_sales", params)
 
 
 @router.get("/sales/cumulative")
@@ -49,19 +49,19 @@ async def cumulative_sales(
     user=Depends(get_current_user)
 ):
     """累計推移（折れ線グラフ用）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
+    since = _since(days)
 
     # Get daily data and compute cumulative client-side
     params = {"p_account_id": account_id, "p_since": since}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("daily_sales", params).execute()
+    daily = await cached_rpc(sb, "daily_sales", params)
 
     cumulative = []
     total = 0
-    for day in result.data:
+    for day in daily:
         total += day["tokens"]
         cumulative.append({**day, "cumulative": total})
     return cumulative
@@ -73,13 +73,15 @@ async def top_users(
     limit: int = Query(default=15, le=50),
     user=Depends(get_current_user)
 ):
-    """太客ランキング"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    """太客ランキング（user_segment_members のアカウント全体行。MVの更新待ちなし）"""
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
-    result = (sb.table("paying_users")
-              .select("*")
+    result = (await sb.table("user_segment_members")
+              .select("account_id, user_name, total_tokens, last_paid, first_paid, tx_count")
               .eq("account_id", account_id)
+              .eq("cast_name", "")
+              .gt("tx_count", 0)
               .order("total_tokens", desc=True)
               .limit(limit)
               .execute())
@@ -94,15 +96,14 @@ async def revenue_breakdown(
     user=Depends(get_current_user)
 ):
     """収入源内訳（ドーナツチャート用）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
+    since = _since(days)
 
     params = {"p_account_id": account_id, "p_since": since}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("revenue_breakdown", params).execute()
-    return result.data
+    return await cached_rpc(sb, "revenue_breakdown", params)
 
 
 @router.get("/revenue/hourly")
@@ -113,15 +114,14 @@ async def hourly_revenue(
     user=Depends(get_current_user)
 ):
     """時間帯分析（ヒートマップ用）— UTC→JST変換"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
+    since = _since(days)
 
     params = {"p_account_id": account_id, "p_since": since}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("hourly_revenue", params).execute()
-    return result.data
+    return await cached_rpc(sb, "hourly_revenue", params)
 
 
 # ============================================================
@@ -135,39 +135,35 @@ async def arpu_trend(
     user=Depends(get_current_user)
 ):
     """ARPU推移（月別: 総売上 ÷ ユニーク課金者数）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
     params = {"p_account_id": account_id}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("arpu_trend", params).execute()
-    return result.data
+    return await cached_rpc(sb, "arpu_trend", params)
+
+
+_LTV_TIERS = ("0-99", "100-499", "500-999", "1000-4999", "5000-9999", "10000+")
 
 
 @router.get("/funnel/ltv")
 async def ltv_distribution(account_id: str, user=Depends(get_current_user)):
-    """LTV分布（ユーザー別累計tk、6ティア分布）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    """LTV分布（ユーザー別累計tk、6ティア分布）
+
+    account_coin_totals.ltv_tiers（課金取り込み時にトリガーで更新）を1行読むだけ。
+    """
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
-    result = (sb.table("paying_users")
-              .select("total_tokens")
+    result = (await sb.table("account_coin_totals")
+              .select("ltv_tiers")
               .eq("account_id", account_id)
+              .limit(1)
               .execute())
 
-    # Tier distribution
-    tiers = {"0-99": 0, "100-499": 0, "500-999": 0,
-             "1000-4999": 0, "5000-9999": 0, "10000+": 0}
-    for row in result.data:
-        t = row["total_tokens"]
-        if t < 100: tiers["0-99"] += 1
-        elif t < 500: tiers["100-499"] += 1
-        elif t < 1000: tiers["500-999"] += 1
-        elif t < 5000: tiers["1000-4999"] += 1
-        elif t < 10000: tiers["5000-9999"] += 1
-        else: tiers["10000+"] += 1
-
-    return {"tiers": tiers, "total_users": len(result.data)}
+    counts = result.data[0]["ltv_tiers"] if result.data else []
+    tiers = {name: (counts[i] if i < len(counts) else 0) for i, name in enumerate(_LTV_TIERS)}
+    return {"tiers": tiers, "total_users": sum(tiers.values())}
 
 
 @router.get("/funnel/retention")
@@ -177,13 +173,12 @@ async def retention_cohort(
     user=Depends(get_current_user)
 ):
     """リテンション（最終支払月別ユーザー分布）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
     params = {"p_account_id": account_id}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("retention_cohort", params).execute()
-    return result.data
+    return await cached_rpc(sb, "retention_cohort", params)
 
 
 @router.get("/funnel/revenue-trend")
@@ -193,13 +188,12 @@ async def revenue_trend(
     user=Depends(get_current_user)
 ):
     """収入源推移（月別×タイプ別 積み上げエリア）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
     params = {"p_account_id": account_id}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("revenue_trend", params).execute()
-    return result.data
+    return await cached_rpc(sb, "revenue_trend", params)
 
 
 @router.get("/funnel/top-users")
@@ -210,13 +204,15 @@ async def top_users_detail(
     user=Depends(get_current_user)
 ):
     """太客詳細（累計tk、初課金日、最終課金日、継続月数、主要収入源）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
     params = {"p_account_id": account_id, "p_limit": limit}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("top_users_detail", params).execute()
-    return result.data
+    return await cached_rpc(sb, "top_users_detail", params)
+
+
+_PAYER_SEGMENTS = ("whale", "regular", "light", "free")
 
 
 @router.get("/funnel/segments")
@@ -226,66 +222,34 @@ async def funnel_segments(
     cast_name: Optional[str] = Query(default=None),
     user=Depends(get_current_user)
 ):
-    """ファネル分析: セグメント別ユーザー分布"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
-
-    # 課金ユーザー取得
-    paying_q = (sb.table("paying_users")
-              .select("user_name, total_tokens, last_paid, first_paid, tx_count")
-              .eq("account_id", account_id))
-    if cast_name:
-        paying_q = paying_q.eq("cast_name", cast_name)
-    paying = paying_q.execute()
-
-    whale, regular, light, free_seg = [], [], [], []
-    paying_names = set()
-    for u in (paying.data or []):
-        paying_names.add(u["user_name"])
-        t = u.get("total_tokens", 0) or 0
-        if t >= 1000:
-            whale.append(u)
-        elif t >= 100:
-            regular.append(u)
-        elif t >= 10:
-            light.append(u)
-        else:
-            free_seg.append(u)
-
-    # チャットのみユーザー（Lead）
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
-    msgs_q = (sb.table("spy_messages")
-            .select("user_name")
-            .eq("account_id", account_id)
-            .eq("msg_type", "chat")
-            .gte("message_time", since)
-            .limit(2000))
-    if cast_name:
-        msgs_q = msgs_q.eq("cast_name", cast_name)
-    msgs = msgs_q.execute()
+    """ファネル分析: セグメント別ユーザー分布
 
-    chat_users = set()
-    for m in (msgs.data or []):
-        un = m.get("user_name")
-        if un:
-            chat_users.add(un)
+    user_segment_rollup（coin_transactions / spy_messages のトリガーで差分更新）を
+    1回のRPCで読む。lead は期間内にチャットした未課金ユーザー（キャスト本人は除外）。
+    """
+    sb = get_supabase_async()
+    ctx = await get_account_context(account_id, user["user_id"])
 
-    # キャスト除外
-    acct = sb.table("accounts").select("cast_usernames").eq("id", account_id).single().execute()
-    cast_names = set(acct.data.get("cast_usernames") or []) if acct.data else set()
-    lead_names = chat_users - paying_names - cast_names
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    result = await sb.rpc("get_funnel_segments", {
+        "p_account_id": account_id,
+        "p_cast_name": cast_name,
+        "p_since": since,
+        "p_exclude_users": ctx["cast_usernames"],
+    }).execute()
+
+    segments = {seg: {"count": 0, "total_tokens": 0} for seg in (*_PAYER_SEGMENTS, "lead")}
+    for row in (result.data or []):
+        segments[row["segment"]] = {
+            "count": row["user_count"] or 0,
+            "total_tokens": row["total_tokens"] or 0,
+        }
 
-    total_payers = len(paying.data or [])
-    total_all = total_payers + len(lead_names)
+    total_payers = sum(segments[seg]["count"] for seg in _PAYER_SEGMENTS)
+    total_all = total_payers + segments["lead"]["count"]
 
     return {
-        "segments": {
-            "whale": {"count": len(whale), "total_tokens": sum(u.get("total_tokens", 0) for u in whale)},
-            "regular": {"count": len(regular), "total_tokens": sum(u.get("total_tokens", 0) for u in regular)},
-            "light": {"count": len(light), "total_tokens": sum(u.get("total_tokens", 0) for u in light)},
-            "free": {"count": len(free_seg), "total_tokens": sum(u.get("total_tokens", 0) for u in free_seg)},
-            "lead": {"count": len(lead_names), "total_tokens": 0},
-        },
+        "segments": segments,
         "total_users": total_all,
         "total_payers": total_payers,
         "conversion_rate": round(total_payers / total_all * 100, 1) if total_all > 0 else 0,
@@ -301,58 +265,34 @@ async def funnel_leads(
     cast_name: Optional[str] = Query(default=None),
     user=Depends(get_current_user)
 ):
-    """リード一覧: セグメント別ユーザーリスト"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    """リード一覧: セグメント別ユーザーリスト（セグメント順 → 累計tk降順）"""
+    sb = get_supabase_async()
+    ctx = await get_account_context(account_id, user["user_id"])
 
-    paying_q = (sb.table("paying_users")
-              .select("user_name, total_tokens, last_paid, first_paid, tx_count")
-              .eq("account_id", account_id)
-              .order("total_tokens", desc=True))
-    if cast_name:
-        paying_q = paying_q.eq("cast_name", cast_name)
-    paying = paying_q.execute()
-
-    paying_map = {}
-    for u in (paying.data or []):
-        t = u.get("total_tokens", 0) or 0
-        seg = "whale" if t >= 1000 else "regular" if t >= 100 else "light" if t >= 10 else "free"
-        paying_map[u["user_name"]] = {**u, "segment": seg}
-
-    result = []
-    if segment in (None, "whale", "regular", "light", "free"):
-        for un, info in paying_map.items():
-            if segment and info["segment"] != segment:
-                continue
-            result.append(info)
-
-    if segment in (None, "lead"):
-        since = (datetime.utcnow() - timedelta(days=days)).isoformat()
-        lead_msgs_q = (sb.table("spy_messages")
-                .select("user_name")
-                .eq("account_id", account_id)
-                .eq("msg_type", "chat")
-                .gte("message_time", since)
-                .limit(2000))
-        if cast_name:
-            lead_msgs_q = lead_msgs_q.eq("cast_name", cast_name)
-        msgs = lead_msgs_q.execute()
-
-        chat_users = set()
-        for m in (msgs.data or []):
-            un = m.get("user_name")
-            if un and un not in paying_map:
-                chat_users.add(un)
-
-        acct = sb.table("accounts").select("cast_usernames").eq("id", account_id).single().execute()
-        cast_names = set(acct.data.get("cast_usernames") or []) if acct.data else set()
-        for un in chat_users - cast_names:
-            result.append({"user_name": un, "total_tokens": 0, "segment": "lead"})
-
-    seg_order = {"whale": 0, "regular": 1, "light": 2, "free": 3, "lead": 4}
-    result.sort(key=lambda x: (seg_order.get(x["segment"], 5), -(x.get("total_tokens", 0) or 0)))
-
-    return result[:limit]
+    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    query = (sb.table("user_segment_members")
+             .select("user_name, total_tokens, last_paid, first_paid, tx_count, segment")
+             .eq("account_id", account_id)
+             .eq("cast_name", cast_name or ""))
+
+    if segment:
+        query = query.eq("segment", segment)
+    if segment == "lead":
+        query = query.gte("last_chat_at", since)
+    elif segment is None:
+        # 課金セグメントは全期間、lead だけ期間内チャットに絞る
+        query = query.or_(f'tx_count.gt.0,last_chat_at.gte."{since}"')
+    if segment in (None, "lead") and ctx["cast_usernames"]:
+        # キャスト本人は lead から除外（課金者としては従来どおり残す）
+        quoted = ",".join('"' + name.replace('"', '\\"') + '"' for name in ctx["cast_usernames"])
+        query = query.or_(f"tx_count.gt.0,user_name.not.in.({quoted})")
+
+    result = await (query
+                    .order("segment_rank")
+                    .order("total_tokens", desc=True)
+                    .limit(limit)
+                    .execute())
+    return result.data or []
 
 
 @router.get("/dm-effectiveness")
@@ -364,14 +304,14 @@ async def dm_effectiveness(
     user=Depends(get_current_user),
 ):
     """DM効果測定（サマリー + キャンペーン別CV率）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     # キャンペーン別データ（RPC）
     params = {"p_account_id": account_id, "p_window_days": days_window}
     if cast_name:
         params["p_cast_name"] = cast_name
-    rpc_result = sb.rpc("dm_effectiveness", params).execute()
+    rpc_result = await sb.rpc("dm_effectiveness", params).execute()
 
     by_campaign = rpc_result.data or []
 
@@ -414,76 +354,15 @@ async def dm_timeline(
     cast_name: Optional[str] = Query(default=None),
     user=Depends(get_current_user),
 ):
-    """日別DM送信・成功・エラー・再課金数"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
-
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+    """日別DM送信・成功・エラー・再課金数（再課金は送信後7日以内に帰属した課金のユニーク人数）"""
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
-    # DM送信ログを取得
-    dm_q = (
-        sb.table("dm_send_log")
-        .select("status, queued_at, sent_at, user_name")
-        .eq("account_id", account_id)
-        .gte("queued_at", since)
-    )
+    params = {"p_account_id": account_id, "p_days": days}
     if cast_name:
-        dm_q = dm_q.eq("cast_name", cast_name)
-    dm_result = dm_q.execute()
-
-    # 再課金データ
-    coin_q = (
-        sb.table("coin_transactions")
-        .select("user_name, date")
-        .eq("account_id", account_id)
-        .gte("date", since)
-    )
-    if cast_name:
-        coin_q = coin_q.eq("cast_name", cast_name)
-    coin_result = coin_q.execute()
-
-    # 再課金ユーザーセット（日付別）
-    coin_by_date: dict[str, set] = {}
-    for c in (coin_result.data or []):
-        d = (c.get("date") or "")[:10]
-        if d:
-            coin_by_date.setdefault(d, set()).add(c["user_name"])
-
-    # DM送信ユーザーセット（日付別、成功のみ）
-    dm_users_by_date: dict[str, set] = {}
-
-    # 日別集計
-    day_map: dict[str, dict] = {}
-    for dm in (dm_result.data or []):
-        d = (dm.get("queued_at") or "")[:10]
-        if not d:
-            continue
-        if d not in day_map:
-            day_map[d] = {"date": d, "sent": 0, "success": 0, "error": 0, "converted": 0}
-        day_map[d]["sent"] += 1
-        status = dm.get("status", "")
-        if status == "success":
-            day_map[d]["success"] += 1
-            dm_users_by_date.setdefault(d, set()).add(dm.get("user_name", ""))
-        elif status == "error":
-            day_map[d]["error"] += 1
-
-    # 再課金マッチング: DM成功ユーザーが7日以内に課金したか
-    for d, dm_users in dm_users_by_date.items():
-        converted = 0
-        for offset in range(8):  # 0～7日後
-            try:
-                check_date = (datetime.strptime(d, "%Y-%m-%d") + timedelta(days=offset)).strftime("%Y-%m-%d")
-            except ValueError:
-                continue
-            coin_users = coin_by_date.get(check_date, set())
-            converted += len(dm_users & coin_users)
-        if d in day_map:
-            day_map[d]["converted"] = converted
-
-    # 日付順にソート
-    result = sorted(day_map.values(), key=lambda x: x["date"])
-    return {"days": result}
+        params["p_cast_name"] = cast_name
+    result = await sb.rpc("get_dm_timeline", params).execute()
+    return {"days": result.data or []}
 
 
 # ============================================================
@@ -507,8 +386,8 @@ async def new_whales(
     user=Depends(get_current_user),
 ):
     """新規太客検出: since以降に初めて課金し、合計min_coins以上のユーザー"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     # デフォルト: 昨日0時(UTC)
     if not since:
@@ -517,49 +396,27 @@ async def new_whales(
         )
         since = yesterday.isoformat()
 
-    # coin_transactionsから全ユーザーのmin(date)とsince以降の合計を取得
-    # 全レコードを取得してPython側で集計（RPCなしで実現）
-    all_tx_q = (
-        sb.table("coin_transactions")
-        .select("user_name, tokens, date")
+    # 初課金インデックス（user_segment_members.first_paid）を範囲検索
+    # first_paid >= since なら全取引が since 以降なので total_tokens = 期間内合計
+    result = await (
+        sb.table("user_segment_members")
+        .select("user_name, total_tokens, first_paid")
         .eq("account_id", account_id)
-        .order("date")
+        .eq("cast_name", cast_name or "")
+        .gt("tx_count", 0)
+        .gte("first_paid", since)
+        .gte("total_tokens", min_coins)
+        .order("total_tokens", desc=True)
+        .limit(1000)
+        .execute()
     )
-    if cast_name:
-        all_tx_q = all_tx_q.eq("cast_name", cast_name)
-    all_tx = all_tx_q.execute()
-
-    # ユーザーごとの最初の課金日と期間内合計を集計
-    user_stats: dict[str, dict] = {}
-    for tx in (all_tx.data or []):
-        un = tx["user_name"]
-        if un not in user_stats:
-            user_stats[un] = {
-                "first_paid": tx["date"],
-                "total_tokens_since": 0,
-            }
-        # first_paid は最初のレコード（order by dateなので先頭）
-        if tx["date"] >= since:
-            user_stats[un]["total_tokens_since"] += tx["tokens"]
-
-    # since以降に初課金（first_paid >= since）& min_coins以上をフィルタ
-    new_users = []
-    for un, st in user_stats.items():
-        if st["first_paid"] >= since and st["total_tokens_since"] >= min_coins:
-            new_users.append({
-                "user_name": un,
-                "total_tokens": st["total_tokens_since"],
-                "first_paid": st["first_paid"],
-            })
-
-    # 太客順にソート
-    new_users.sort(key=lambda x: x["total_tokens"], reverse=True)
+    new_users = result.data or []
 
     # dm_send_logで既にDM送信済みか確認
     if new_users:
         user_name_list = [u["user_name"] for u in new_users]
         dm_result = (
-            sb.table("dm_send_log")
+            await sb.table("dm_send_log")
             .select("user_name")
             .eq("account_id", account_id)
             .in_("user_name", user_name_list)
@@ -581,8 +438,8 @@ async def thank_dm(
     user=Depends(get_current_user),
 ):
     """新規太客へのお礼DM一括キュー登録"""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
     if not body.user_names:
         raise HTTPException(status_code=400, detail="ユーザーを1名以上選択してください")
@@ -591,7 +448,7 @@ async def thank_dm(
     message_template = None
     if body.template_id:
         tpl = (
-            sb.table("dm_templates")
+            await sb.table("dm_templates")
             .select("message")
             .eq("id", body.template_id)
             .single()
@@ -625,25 +482,18 @@ async def thank_dm(
         row["cast_name"] = body.cast_name or ""
         rows.append(row)
 
-    result = sb.table("dm_send_log").insert(rows).execute()
-
-    # プロフィールのDM使用カウンター更新
+    # 除外 → 使用量予約 → ペーシング → チャンクINSERT
     try:
-        profile = (
-            sb.table("profiles")
-            .select("dm_used_this_month")
-            .eq("id", user["user_id"])
-            .single()
-            .execute()
+        result = await enqueue_dms(
+            sb, body.account_id, user["user_id"], body.cast_name or "", rows, PRIORITY_THANK_YOU,
         )
-        if profile.data:
-            sb.table("profiles").update({
-                "dm_used_this_month": profile.data["dm_used_this_month"] + len(rows)
-            }).eq("id", user["user_id"]).execute()
-    except Exception:
-        pass  # カウンター更新失敗は無視
+    except DmQuotaExceededError:
+        raise HTTPException(status_code=403, detail="今月のDM送信上限に達しました")
 
     return {
-        "queued": len(result.data),
+        "queued": result["queued"],
+        "skipped_duplicates": result["duplicates"],
+        "skipped_blacklisted": result["blacklisted"],
+        "skipped_over_quota": result["over_quota"],
         "batch_id": batch_id,
     }
@@ -1,80 +1,288 @@
 """Auth router - JWT verification, profile, account management"""
+import asyncio
+import hashlib
+import logging
+import time
+from collections import OrderedDict
 import jwt
 from jwt import PyJWKClient
 from fastapi import APIRouter, Depends, HTTPException, Request
 from functools import lru_cache
-from config import get_settings, get_supabase_admin
+from postgrest.exceptions import APIError
+from config import get_settings, get_supabase_async
 from models.schemas import AccountCreate, AccountResponse, AccountSettingsUpdate, UserProfile
 
 router = APIRouter()
+logger = logging.getLogger(__name__)
 
 
 # ============================================================
 # JWKS Client (Supabase ES256 公開鍵をキャッシュ)
 # ============================================================
 _jwks_client = None
+_jwks_kids: frozenset[str] = frozenset()
+_jwks_refresh_task: asyncio.Task | None = None
 
 def _get_jwks_client():
     global _jwks_client
     if _jwks_client is None:
         settings = get_settings()
         jwks_url = f"{settings.supabase_url}/auth/v1/.well-known/jwks.json"
-        _jwks_client = PyJWKClient(jwks_url, headers={"apikey": settings.supabase_service_key})
+        # バックグラウンド更新が止まっても鍵セットが古くなりすぎないよう、更新間隔の2倍で失効させる
+        _jwks_client = PyJWKClient(
+            jwks_url,
+            headers={"apikey": settings.supabase_service_key},
+            lifespan=max(1, settings.jwks_refresh_interval * 2),
+        )
     return _jwks_client
 
 
+def _refresh_jwks():
+    """JWKS を再取得し、鍵が入れ替わっていれば検証済みトークンキャッシュを破棄"""
+    global _jwks_kids
+    jwk_set = _get_jwks_client().get_jwk_set(refresh=True)
+    kids = frozenset(k.key_id for k in jwk_set.keys if k.key_id)
+    if _jwks_kids and kids != _jwks_kids:
+        # 失効した鍵で署名されたトークンをキャッシュから通さない
+        logger.info(f"JWKS key rotation detected: {sorted(_jwks_kids)} -> {sorted(kids)}")
+        _token_cache.clear()
+    _jwks_kids = kids
+
+
+async def _jwks_refresh_loop(interval: int):
+    while True:
+        try:
+            await asyncio.to_thread(_refresh_jwks)
+        except Exception as e:
+            logger.warning(f"JWKS refresh failed: {e}")
+        await asyncio.sleep(interval)
+
+
+def start_jwks_refresher():
+    """JWKS のバックグラウンド更新タスクを起動（lifespan から呼ぶ）"""
+    global _jwks_refresh_task
+    settings = get_settings()
+    if _jwks_refresh_task is not None or not settings.supabase_url:
+        return
+    _jwks_refresh_task = asyncio.create_task(_jwks_refresh_loop(settings.jwks_refresh_interval))
+
+
+async def stop_jwks_refresher():
+    global _jwks_refresh_task
+    if _jwks_refresh_task is None:
+        return
+    _jwks_refresh_task.cancel()
+    try:
+        await _jwks_refresh_task
+    except asyncio.CancelledError:
+        pass
+    _jwks_refresh_task = None
+
+
+# ============================================================
+# 検証済みトークンキャッシュ（sha256(token) → user_id, exp）
+# ============================================================
+class _TokenCache:
+    """上限付き LRU。エントリはトークンの exp まで有効"""
+
+    def __init__(self, maxsize: int):
+        self._maxsize = maxsize
+        self._entries: OrderedDict[str, tuple[str, float]] = OrderedDict()
+
+    def get(self, key: str) -> str | None:
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        user_id, exp = entry
+        if exp <= time.time():
+            self._entries.pop(key, None)
+            return None
+        self._entries.move_to_end(key)
+        return user_id
+
+    def put(self, key: str, user_id: str, exp: float):
+        self._entries[key] = (user_id, exp)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self._maxsize:
+            self._entries.popitem(last=False)
+
+    def clear(self):
+        self._entries.clear()
+
+    def __len__(self) -> int:
+        return len(self._entries)
+
+
+_token_cache = _TokenCache(get_settings().auth_token_cache_size)
+_auth_stats = {"hits": 0, "misses": 0, "hit_seconds": 0.0, "miss_seconds": 0.0}
+
+
+def get_auth_stats() -> dict:
+    """認証キャッシュのヒット率と平均レイテンシ（/health で公開）"""
+    hits, misses = _auth_stats["hits"], _auth_stats["misses"]
+    total = hits + misses
+    return {
+        "cache_size": len(_token_cache),
+        "hits": hits,
+        "misses": misses,
+        "hit_rate": round(hits / total, 4) if total else 0.0,
+        "avg_hit_ms": round(_auth_stats["hit_seconds"] / hits * 1000, 3) if hits else 0.0,
+        "avg_miss_ms": round(_auth_stats["miss_seconds"] / misses * 1000, 3) if misses else 0.0,
+    }
+
+
+def _verify_token(token: str) -> dict:
+    """署名検証（JWKS 取得を伴う場合があるためスレッドで実行する）"""
+    settings = get_settings()
+
+    # JWTヘッダからアルゴリズムを判定
+    header = jwt.get_unverified_header(token)
+    alg = header.get("alg", "HS256")
+
+    if alg == "ES256":
+        # 新しいSupabase: ES256 (ECDSA) → JWKSから公開鍵を取得
+        jwks_client = _get_jwks_client()
+        signing_key = jwks_client.get_signing_key_from_jwt(token)
+        return jwt.decode(
+            token,
+            signing_key.key,
+            algorithms=["ES256"],
+            audience="authenticated",
+            leeway=30,  # 時計ずれ許容（秒）
+        )
+    # レガシーSupabase: HS256 (HMAC) → JWT Secretで検証
+    return jwt.decode(
+        token,
+        settings.supabase_jwt_secret,
+        algorithms=["HS256"],
+        audience="authenticated",
+        leeway=30,
+    )
+
+
 # ============================================================
 # JWT Dependency
 # ============================================================
 async def get_current_user(request: Request) -> dict:
     """Extract and verify Supabase JWT (ES256 via JWKS)"""
+    started = time.perf_counter()
     auth_header = request.headers.get("Authorization", "")
     if not auth_header.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing authorization header")
 
     token = auth_header.split(" ", 1)[1]
-    settings = get_settings()
+
+    # ホットパス: 検証済みトークンなら辞書参照のみ
+    cache_key = hashlib.sha256(token.encode()).hexdigest()
+    user_id = _token_cache.get(cache_key)
+    if user_id is not None:
+        _auth_stats["hits"] += 1
+        _auth_stats["hit_seconds"] += time.perf_counter() - started
+        return {"user_id": user_id, "jwt": token}
 
     try:
-        # JWTヘッダからアルゴリズムを判定
-        header = jwt.get_unverified_header(token)
-        alg = header.get("alg", "HS256")
-
-        if alg == "ES256":
-            # 新しいSupabase: ES256 (ECDSA) → JWKSから公開鍵を取得
-            jwks_client = _get_jwks_client()
-            signing_key = jwks_client.get_signing_key_from_jwt(token)
-            payload = jwt.decode(
-                token,
-                signing_key.key,
-                algorithms=["ES256"],
-                audience="authenticated",
-                leeway=30,  # 時計ずれ許容（秒）
-            )
-        else:
-            # レガシーSupabase: HS256 (HMAC) → JWT Secretで検証
-            payload = jwt.decode(
-                token,
-                settings.supabase_jwt_secret,
-                algorithms=["HS256"],
-                audience="authenticated",
-                leeway=30,
-            )
-
-        return {"user_id": payload["sub"], "jwt": token}
+        payload = await asyncio.to_thread(_verify_token, token)
     except jwt.ExpiredSignatureError:
         raise HTTPException(status_code=401, detail="Token expired")
     except jwt.InvalidTokenError as e:
         raise HTTPException(status_code=401, detail=f"Invalid token: {e}")
 
+    user_id = payload["sub"]
+    if "exp" in payload:
+        _token_cache.put(cache_key, user_id, float(payload["exp"]))
+    _auth_stats["misses"] += 1
+    _auth_stats["miss_seconds"] += time.perf_counter() - started
+    return {"user_id": user_id, "jwt": token}
+
+
+# ============================================================
+# Account Context（所有権 + cast_usernames + coin_rate + プラン上限）
+# ============================================================
+_ACCOUNT_CONTEXT_MAX = 5000
+_account_contexts: dict[tuple[str, str], tuple[float, dict]] = {}
+
+
+async def _load_account_context_fallback(sb, account_id: str, user_id: str) -> list[dict]:
+    """get_account_context RPC 未適用環境向け: accounts + profiles を個別に取得"""
+    account, profile = await asyncio.gather(
+        sb.table("accounts").select("*").eq("id", account_id).eq("user_id", user_id).limit(1).execute(),
+        sb.table("profiles").select("plan, max_casts, max_dm_per_month, max_ai_per_month")
+        .eq("id", user_id).limit(1).execute(),
+    )
+    if not account.data:
+        return []
+    row = {**(profile.data[0] if profile.data else {}), **account.data[0]}
+    row["account_id"] = row.get("id")
+    return [row]
+
+
+async def get_account_context(account_id: str, user_id: str) -> dict:
+    """
+    所有権チェック済みのアカウントコンテキストを返す（未所有・不存在は404）。
+
+    (user, account) ごとに account_context_ttl 秒キャッシュする。
+    accounts を更新した箇所では invalidate_account_context() を呼ぶこと。
+
+    Returns:
+        {"account_id", "account_name", "cast_usernames": list, "coin_rate",
+         "plan", "max_casts", "max_dm_per_month", "max_ai_per_month"}
+    """
+    key = (user_id, account_id)
+    now = time.monotonic()
+    cached = _account_contexts.get(key)
+    if cached is not None and cached[0] > now:
+        return cached[1]
+
+    sb = get_supabase_async()
+    try:
+        rows = (await sb.rpc("get_account_context", {
+            "p_account_id": account_id,
+            "p_user_id": user_id,
+        }).execute()).data or []
+    except APIError as e:
+        if e.code == "22P02":
+            # account_id が UUID 形式でない
+            rows = []
+        else:
+            rows = await _load_account_context_fallback(sb, account_id, user_id)
+
+    if not rows:
+        raise HTTPException(status_code=404, detail="Account not found")
+
+    row = rows[0]
+    ctx = {
+        "account_id": str(row["account_id"]),
+        "account_name": row.get("account_name"),
+        "cast_usernames": list(row.get("cast_usernames") or []),
+        "coin_rate": float(row.get("coin_rate") or 7.7),
+        "plan": row.get("plan") or "free",
+        "max_casts": row.get("max_casts") if row.get("max_casts") is not None else 1,
+        "max_dm_per_month": row.get("max_dm_per_month") if row.get("max_dm_per_month") is not None else 10,
+        "max_ai_per_month": row.get("max_ai_per_month") if row.get("max_ai_per_month") is not None else 0,
+    }
+
+    if len(_account_contexts) >= _ACCOUNT_CONTEXT_MAX:
+        for k in [k for k, (exp, _) in _account_contexts.items() if exp <= now]:
+            del _account_contexts[k]
+        if len(_account_contexts) >= _ACCOUNT_CONTEXT_MAX:
+            _account_contexts.clear()
+    _account_contexts[key] = (now + get_settings().account_context_ttl, ctx)
+    return ctx
+
+
+def invalidate_account_context(account_id: str):
+    """accounts 更新・削除時にキャッシュを破棄"""
+    for key in [k for k in _account_contexts if k[1] == account_id]:
+        _account_contexts.pop(key, None)
+
 
 # ============================================================
 # Profile
 # ============================================================
 @router.get("/me", response_model=UserProfile)
 async def get_profile(user=Depends(get_current_user)):
-    sb = get_supabase_admin()
-    result = sb.table("profiles").select("*").eq("id", user["user_id"]).single().execute()
+    sb = get_supabase_async()
+    result = await sb.table("profiles").select("*").eq("id", user["user_id"]).single().execute()
     if not result.data:
         raise HTTPException(status_code=404, detail="Profile not found")
     return result.data
@@ -85,18 +293,20 @@ async def get_profile(user=Depends(get_current_user)):
 # ============================================================
 @router.get("/accounts", response_model=list[AccountResponse])
 async def list_accounts(user=Depends(get_current_user)):
-    sb = get_supabase_admin()
-    result = sb.table("accounts").select("*").eq("user_id", user["user_id"]).order("created_at").execute()
+    sb = get_supabase_async()
+    result = await sb.table("accounts").select("*").eq("user_id", user["user_id"]).order("created_at").execute()
     return result.data
 
 
 @router.post("/accounts", response_model=AccountResponse)
 async def create_account(body: AccountCreate, user=Depends(get_current_user)):
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     # Check plan limits
-    profile = sb.table("profiles").select("max_casts").eq("id", user["user_id"]).single().execute()
-    existing = sb.table("accounts").select("id", count="exact").eq("user_id", user["user_id"]).execute()
+    profile, existing = await asyncio.gather(
+        sb.table("profiles").select("max_casts").eq("id", user["user_id"]).single().execute(),
+        sb.table("accounts").select("id", count="exact").eq("user_id", user["user_id"]).execute(),
+    )
 
     if existing.count >= profile.data["max_casts"]:
         raise HTTPException(status_code=403, detail=f"Plan limit: max {profile.data['max_casts']} casts")
@@ -109,24 +319,20 @@ async def create_account(body: AccountCreate, user=Depends(get_current_user)):
         # TODO: encrypt cookie before storing
         data["stripchat_cookie_encrypted"] = body.stripchat_cookie
 
-    result = sb.table("accounts").insert(data).execute()
+    result = await sb.table("accounts").insert(data).execute()
     return result.data[0]
 
 
 @router.get("/accounts/{account_id}/settings")
 async def get_account_settings(account_id: str, user=Depends(get_current_user)):
     """アカウントのキャスト除外・コイン換算設定を取得"""
-    sb = get_supabase_admin()
-
-    account = (sb.table("accounts")
-               .select("id, account_name, cast_usernames, coin_rate")
-               .eq("id", account_id)
-               .eq("user_id", user["user_id"])
-               .single().execute())
-    if not account.data:
-        raise HTTPException(status_code=404, detail="Account not found")
-
-    return account.data
+    ctx = await get_account_context(account_id, user["user_id"])
+    return {
+        "id": ctx["account_id"],
+        "account_name": ctx["account_name"],
+        "cast_usernames": ctx["cast_usernames"],
+        "coin_rate": ctx["coin_rate"],
+    }
 
 
 @router.put("/accounts/{account_id}/settings")
@@ -136,12 +342,10 @@ async def update_account_settings(
     user=Depends(get_current_user)
 ):
     """アカウントのキャスト除外・コイン換算設定を更新"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     # Verify ownership
-    account = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user["user_id"]).single().execute()
-    if not account.data:
-        raise HTTPException(status_code=404, detail="Account not found")
+    await get_account_context(account_id, user["user_id"])
 
     update_data = {}
     if body.cast_usernames is not None:
@@ -154,18 +358,18 @@ async def update_account_settings(
     if not update_data:
         raise HTTPException(status_code=400, detail="更新データがありません")
 
-    result = sb.table("accounts").update(update_data).eq("id", account_id).execute()
+    result = await sb.table("accounts").update(update_data).eq("id", account_id).execute()
+    invalidate_account_context(account_id)
     return result.data[0]
 
 
 @router.delete("/accounts/{account_id}")
 async def delete_account(account_id: str, user=Depends(get_current_user)):
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     # Verify ownership
-    account = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user["user_id"]).single().execute()
-    if not account.data:
-        raise HTTPException(status_code=404, detail="Account not found")
+    await get_account_context(account_id, user["user_id"])
 
-    sb.table("accounts").delete().eq("id", account_id).execute()
+    await sb.table("accounts").delete().eq("id", account_id).execute()
+    invalidate_account_context(account_id)
     return {"deleted": True}
@@ -1,37 +1,17 @@
 """Competitive Analysis router - Cross-cast comparison, tip clustering, viewer trends,
 user overlap, hourly heatmap, success patterns, cast ranking, and LLM analysis.
 """
+import asyncio
 import traceback
 from typing import Literal, Optional
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
-from config import get_supabase_admin
-from routers.auth import get_current_user
+from config import get_supabase_async
+from routers.auth import get_account_context, get_current_user
 
 router = APIRouter()
 
 
-def _verify_account(sb, account_id: str, user_id: str):
-    """アカウント所有権を確認。見つからない場合は HTTPException(404) を送出。"""
-    try:
-        result = (
-            sb.table("accounts")
-            .select("id")
-            .eq("id", account_id)
-            .eq("user_id", user_id)
-            .limit(1)
-            .execute()
-        )
-        if not result.data:
-            raise HTTPException(status_code=404, detail="Account not found")
-    except HTTPException:
-        raise
-    except Exception as e:
-        print(f"[competitive] _verify_account error: {e}")
-        traceback.print_exc()
-        raise HTTPException(status_code=404, detail="Account not found")
-
-
 def _split_cast_names(cast_names: Optional[str]) -> list[str]:
     """カンマ区切り文字列をリストに変換。空文字・Noneは空リスト。"""
     if not cast_names:
@@ -49,11 +29,11 @@ async def competitor_overview(
     user=Depends(get_current_user),
 ):
     """全キャスト概要 → OverviewSummary 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     try:
-        result = sb.rpc("get_competitor_overview", {
+        result = await sb.rpc("get_competitor_overview", {
             "p_account_id": account_id,
             "p_days": days,
         }).execute()
@@ -94,22 +74,23 @@ async def cast_ranking(
     user=Depends(get_current_user),
 ):
     """キャストランキング → RankingItem[] 形式で返却（全指標含む + 前期比較）"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     try:
-        # get_cast_ranking RPC で前期比較付きランキングを取得
-        rank_result = sb.rpc("get_cast_ranking", {
-            "p_account_id": account_id,
-            "p_metric": metric,
-            "p_days": days,
-        }).execute()
-
-        # overview RPC で全指標（sessions, viewers, hours等）を取得
-        overview_result = sb.rpc("get_competitor_overview", {
-            "p_account_id": account_id,
-            "p_days": days,
-        }).execute()
+        rank_result, overview_result = await asyncio.gather(
+            # get_cast_ranking RPC で前期比較付きランキングを取得
+            sb.rpc("get_cast_ranking", {
+                "p_account_id": account_id,
+                "p_metric": metric,
+                "p_days": days,
+            }).execute(),
+            # overview RPC で全指標（sessions, viewers, hours等）を取得
+            sb.rpc("get_competitor_overview", {
+                "p_account_id": account_id,
+                "p_days": days,
+            }).execute(),
+        )
 
         # overview データをキャスト名で引けるようにする
         overview_map: dict[str, dict] = {}
@@ -162,13 +143,13 @@ async def session_comparison(
     user=Depends(get_current_user),
 ):
     """セッション比較 → SessionCompare[] 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     names_list = _split_cast_names(cast_names)
 
     try:
-        result = sb.rpc("get_session_comparison", {
+        result = await sb.rpc("get_session_comparison", {
             "p_account_id": account_id,
             "p_cast_names": names_list,
             "p_days": days,
@@ -203,11 +184,11 @@ async def tip_clustering(
     user=Depends(get_current_user),
 ):
     """チップ集中分析 → TipCluster[] 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     try:
-        result = sb.rpc("get_tip_clustering", {
+        result = await sb.rpc("get_tip_clustering", {
             "p_account_id": account_id,
             "p_cast_name": cast_name,
             "p_days": days,
@@ -241,13 +222,13 @@ async def viewer_trends(
     user=Depends(get_current_user),
 ):
     """視聴者推移 → ViewerTrendPoint[] 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     names_list = _split_cast_names(cast_names)
 
     try:
-        result = sb.rpc("get_viewer_trend", {
+        result = await sb.rpc("get_viewer_trend", {
             "p_account_id": account_id,
             "p_cast_names": names_list,
             "p_session_id": session_id,
@@ -279,13 +260,13 @@ async def user_overlap(
     user=Depends(get_current_user),
 ):
     """ユーザー重複分析 → UserOverlap[] 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     names_filter = set(_split_cast_names(cast_names)) if cast_names else None
 
     try:
-        result = sb.rpc("get_user_overlap", {
+        result = await sb.rpc("get_user_overlap", {
             "p_account_id": account_id,
             "p_days": days,
         }).execute()
@@ -327,13 +308,13 @@ async def hourly_heatmap(
     user=Depends(get_current_user),
 ):
     """時間帯ヒートマップ → HeatmapCell[] 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     names_list = _split_cast_names(cast_names)
 
     try:
-        result = sb.rpc("get_hourly_heatmap", {
+        result = await sb.rpc("get_hourly_heatmap", {
             "p_account_id": account_id,
             "p_cast_names": names_list,
             "p_days": days,
@@ -374,13 +355,13 @@ async def success_patterns(
     user=Depends(get_current_user),
 ):
     """成功パターン抽出 → SuccessSession[] 形式で返却"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     names_filter = set(_split_cast_names(cast_names)) if cast_names else None
 
     try:
-        result = sb.rpc("get_success_patterns", {
+        result = await sb.rpc("get_success_patterns", {
             "p_account_id": account_id,
             "p_min_tokens": min_tokens,
         }).execute()
@@ -431,15 +412,37 @@ async def analyze_cast(body: AnalyzeRequest, user=Depends(get_current_user)):
             detail="AI分析にはANTHROPIC_API_KEYの設定が必要です",
         )
 
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
     # 分析用データ収集
     try:
-        overview_result = sb.rpc("get_competitor_overview", {
-            "p_account_id": body.account_id,
-            "p_days": 30,
-        }).execute()
+        # 概要・SPYログ件数・トップチッパー・ヒートマップは互いに独立なので並行取得
+        overview_result, count_result, tip_result, heatmap_result = await asyncio.gather(
+            sb.rpc("get_competitor_overview", {
+                "p_account_id": body.account_id,
+                "p_days": 30,
+            }).execute(),
+            sb.table("spy_messages")
+            .select("id", count="exact")
+            .eq("account_id", body.account_id)
+            .eq("cast_name", body.cast_name)
+            .execute(),
+            sb.table("spy_messages")
+            .select("user_name, tokens")
+            .eq("account_id", body.account_id)
+            .eq("cast_name", body.cast_name)
+            .in_("msg_type", ["tip", "gift"])
+            .gt("tokens", 0)
+            .order("tokens", desc=True)
+            .limit(200)
+            .execute(),
+            sb.rpc("get_hourly_heatmap", {
+                "p_account_id": body.account_id,
+                "p_cast_names": [body.cast_name],
+                "p_days": 30,
+            }).execute(),
+        )
 
         cast_data = None
         for r in (overview_result.data or []):
@@ -454,13 +457,6 @@ async def analyze_cast(body: AnalyzeRequest, user=Depends(get_current_user)):
             )
 
         # SPYログの件数チェック（最低50件必要）
-        count_result = (
-            sb.table("spy_messages")
-            .select("id", count="exact")
-            .eq("account_id", body.account_id)
-            .eq("cast_name", body.cast_name)
-            .execute()
-        )
         msg_count = count_result.count if count_result.count is not None else 0
         if msg_count < 50:
             raise HTTPException(
@@ -468,19 +464,7 @@ async def analyze_cast(body: AnalyzeRequest, user=Depends(get_current_user)):
                 detail=f"分析に必要なデータが不足しています（最低50件のSPYログが必要、現在{msg_count}件）",
             )
 
-        # トップチッパー取得
-        tip_result = (
-            sb.table("spy_messages")
-            .select("user_name, tokens")
-            .eq("account_id", body.account_id)
-            .eq("cast_name", body.cast_name)
-            .in_("msg_type", ["tip", "gift"])
-            .gt("tokens", 0)
-            .order("tokens", desc=True)
-            .limit(200)
-            .execute()
-        )
-
+        # トップチッパー集計
         tipper_map: dict[str, int] = {}
         for r in (tip_result.data or []):
             name = r.get("user_name", "")
@@ -489,12 +473,6 @@ async def analyze_cast(body: AnalyzeRequest, user=Depends(get_current_user)):
         top_tippers = sorted(tipper_map.items(), key=lambda x: x[1], reverse=True)[:10]
 
         # ヒートマップ（ピーク時間帯）
-        heatmap_result = sb.rpc("get_hourly_heatmap", {
-            "p_account_id": body.account_id,
-            "p_cast_names": [body.cast_name],
-            "p_days": 30,
-        }).execute()
-
         peak_hours = sorted(
             (heatmap_result.data or []),
             key=lambda x: float(x.get("avg_tokens_per_hour", 0)),
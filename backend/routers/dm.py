@@ -1,30 +1,29 @@
 """DM router - Queue management, templates, effectiveness, thank-you candidates, churn risk, ADM trigger"""
 import re
-from datetime import datetime, timedelta
+from datetime import datetime, timedelta, timezone
 from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, Query
-from config import get_supabase_admin
-from routers.auth import get_current_user
+from fastapi import APIRouter, Depends, HTTPException, Query, Response
+from config import get_supabase_async
+from routers.auth import get_account_context, get_current_user
 from models.schemas import (
     DMQueueCreate, DMBatchCreate, DMBatchResponse, DMBatchStatus,
-    DMStatusUpdate, DMTemplateCreate, DMLogResponse,
+    DMStatusUpdate, DMTemplateCreate, DMLogResponse, DMQueueClaim, DMQueueAck,
 )
-from services.adm_engine import run_adm_cycle
+from services.adm_daemon import invalidate_adm_triggers
+from services.adm_engine import VALID_TRIGGER_TYPES, run_adm_cycle
+from services.dm_enqueue import DmQuotaExceededError, enqueue_dms
 from services.dm_guard import is_dm_test_mode, DM_TEST_WHITELIST
+from services.dm_notify import long_poll
+from services.dm_pacing import PRIORITY_BATCH
+from services.dm_trigger_ledger import forget_trigger
+from services.pagination import apply_keyset, next_cursor
 
 router = APIRouter()
 
 
-def _verify_account_ownership(sb, account_id: str, user_id: str):
-    """Verify user owns the account"""
-    result = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user_id).single().execute()
-    if not result.data:
-        raise HTTPException(status_code=404, detail="Account not found")
-
-
-def _get_first_account_id(sb, user_id: str) -> str:
+async def _get_first_account_id(sb, user_id: str) -> str:
     """ユーザーの最初のaccountを取得"""
-    result = sb.table("accounts").select("id").eq("user_id", user_id).limit(1).execute()
+    result = await sb.table("accounts").select("id").eq("user_id", user_id).limit(1).execute()
     if not result.data:
         raise HTTPException(status_code=404, detail="アカウントが見つかりません。先にアカウントを作成してください。")
     return result.data[0]["id"]
@@ -49,18 +48,10 @@ async def create_dm_batch(
     cast_name: Optional[str] = Query(default=None),
     user=Depends(get_current_user),
 ):
-    """Web UIからの一斉送信キュー登録"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
-
-    # プラン上限チェック
-    profile = sb.table("profiles").select("dm_used_this_month, max_dm_per_month").eq("id", user["user_id"]).single().execute()
-    remaining = profile.data["max_dm_per_month"] - profile.data["dm_used_this_month"]
-    if remaining <= 0:
-        raise HTTPException(status_code=403, detail="今月のDM送信上限に達しました")
+    """Web UIからの一斉送信キュー登録（重複・ブラックリスト除外、使用量は予約制）"""
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
-    # ターゲット処理
-    targets = body.targets[:remaining]
     batch_id = f"batch_{datetime.utcnow().strftime('%Y%m%d_%H%M%S')}_{user['user_id'][:8]}"
 
     # DM安全ゲート: テストモード時ホワイトリスト外をフィルタ
@@ -68,7 +59,7 @@ async def create_dm_batch(
 
     rows = []
     blocked_count = 0
-    for t in targets:
+    for t in body.targets:
         user_name = _extract_username(t)
 
         # テストモード時: ホワイトリスト外はブロック
@@ -97,19 +88,25 @@ async def create_dm_batch(
             detail=f"[DM_TEST_MODE] 全{blocked_count}名がホワイトリスト外のためブロック。許可: {', '.join(sorted(DM_TEST_WHITELIST))}",
         )
 
-    result = sb.table("dm_send_log").insert(rows).execute()
-
-    # 使用カウンター更新
-    sb.table("profiles").update({
-        "dm_used_this_month": profile.data["dm_used_this_month"] + len(rows)
-    }).eq("id", user["user_id"]).execute()
+    # 除外 → 使用量予約 → ペーシング → チャンクINSERT
+    try:
+        result = await enqueue_dms(
+            sb, account_id, user["user_id"], cast_name or "", rows, PRIORITY_BATCH,
+            skip_duplicates=body.skip_duplicates,
+        )
+    except DmQuotaExceededError:
+        raise HTTPException(status_code=403, detail="今月のDM送信上限に達しました")
 
     return DMBatchResponse(
-        queued=len(result.data),
+        queued=result["queued"],
         batch_id=batch_id,
         send_order=body.send_order,
         send_mode=body.send_mode,
         concurrent_tabs=body.concurrent_tabs,
+        scheduled_until=result["scheduled_until"],
+        skipped_duplicates=result["duplicates"],
+        skipped_blacklisted=result["blacklisted"],
+        skipped_over_quota=result["over_quota"],
     )
 
 
@@ -117,34 +114,45 @@ async def create_dm_batch(
 # DM Batch Status
 # ============================================================
 @router.get("/status/{batch_id}", response_model=DMBatchStatus)
-async def get_batch_status(batch_id: str, user=Depends(get_current_user)):
-    """バッチの送信状況を取得"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
-
-    result = (sb.table("dm_send_log")
-              .select("*")
-              .eq("account_id", account_id)
-              .eq("campaign", batch_id)
-              .order("queued_at")
-              .execute())
-
-    items = result.data or []
-
-    counts = {"queued": 0, "sending": 0, "success": 0, "error": 0, "pending": 0}
-    for item in items:
-        s = item.get("status", "queued")
-        if s in counts:
-            counts[s] += 1
+async def get_batch_status(
+    batch_id: str,
+    since: int = Query(default=0, ge=0),
+    limit: int = Query(default=200, ge=1, le=1000),
+    user=Depends(get_current_user),
+):
+    """バッチの送信状況を取得
+
+    件数はDB側で集計し、items は前回レスポンスの cursor（since）以降に
+    ステータスが変わった行だけを最大 limit 件返す。has_more の間は続けて取得する。
+    cursor は後からコミットされる行を取りこぼさないよう、採番直後の行の手前に留まるので
+    直近の行は次回も items に含まれる（id ごとに上書きすればよい）。
+    """
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
+
+    result = await sb.rpc("get_dm_batch_status", {
+        "p_account_id": account_id,
+        "p_campaign": batch_id,
+        "p_since": since,
+        "p_limit": limit,
+    }).execute()
+
+    data = result.data or {}
+    counts = data.get("counts") or {}
+    items = data.get("items") or []
+    cursor = data.get("cursor") or since
 
     return DMBatchStatus(
         batch_id=batch_id,
-        total=len(items),
-        queued=counts["queued"] + counts["pending"],
-        sending=counts["sending"],
-        success=counts["success"],
-        error=counts["error"],
+        total=sum(counts.values()),
+        queued=counts.get("queued", 0) + counts.get("pending", 0),
+        sending=counts.get("sending", 0),
+        success=counts.get("success", 0),
+        error=counts.get("error", 0),
         items=items,
+        cursor=cursor,
+        # カーソルが採番直後の行で止まったときは、続けて読んでも同じ行が返るだけ
+        has_more=len(items) >= limit and cursor >= items[-1]["status_seq"],
     )
 
 
@@ -154,20 +162,20 @@ async def get_batch_status(batch_id: str, user=Depends(get_current_user)):
 @router.get("/history")
 async def get_dm_history(
     limit: int = Query(default=100, le=500),
+    cursor: Optional[str] = None,
     user=Depends(get_current_user)
 ):
-    """直近の送信履歴を返す"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    """直近の送信履歴を返す（next_cursor で続きを取得）"""
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
-    result = (sb.table("dm_send_log")
-              .select("*")
-              .eq("account_id", account_id)
-              .order("queued_at", desc=True)
-              .limit(limit)
-              .execute())
+    query = (sb.table("dm_send_log")
+             .select("*")
+             .eq("account_id", account_id)
+             .limit(limit))
+    items = (await apply_keyset(query, "queued_at", cursor).execute()).data or []
 
-    return {"items": result.data or []}
+    return {"items": items, "next_cursor": next_cursor(items, limit, "queued_at")}
 
 
 # ============================================================
@@ -178,27 +186,45 @@ async def get_dm_queue(
     account_id: str,
     status: str = "queued",
     limit: int = Query(default=10, le=50),
+    wait_seconds: int = Query(default=0, ge=0, le=60),
     user=Depends(get_current_user)
 ):
-    """Chrome extension polls this to get pending DM tasks"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
-
-    result = (sb.table("dm_send_log")
-              .select("*")
-              .eq("account_id", account_id)
-              .eq("status", status)
-              .order("queued_at")
-              .limit(limit)
-              .execute())
-    return result.data
+    """Chrome extension polls this to get pending DM tasks
+
+    取得のみでリースしない（レガシー）。複数タブで送る場合は POST /queue/claim を使う。
+    queued は claim と同じく送信予定時刻（not_before）が来た行だけを優先度順に返す
+    （リースしないので分あたりの送信レートは呼び出し側の間隔に任せる）。
+    wait_seconds > 0 なら、空のときキュー登録の通知かタイムアウトまで待ってから返す。
+    """
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
+
+    async def fetch():
+        query = (sb.table("dm_send_log")
+                 .select("*")
+                 .eq("account_id", account_id)
+                 .eq("status", status))
+        if status == "queued":
+            now = datetime.now(timezone.utc).isoformat()
+            query = (query.or_(f'not_before.is.null,not_before.lte."{now}"')
+                     .order("priority", desc=True)
+                     .order("not_before")
+                     .order("id"))
+        else:
+            query = query.order("queued_at")
+        result = await query.limit(limit).execute()
+        return result.data or []
+
+    if wait_seconds and status == "queued":
+        return await long_poll(account_id, fetch, wait_seconds)
+    return await fetch()
 
 
 @router.put("/queue/{dm_id}/status")
 async def update_dm_status(dm_id: int, body: DMStatusUpdate, user=Depends(get_current_user)):
     """Chrome extension reports send result"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
     update_data = {"status": body.status}
     if body.error:
@@ -208,12 +234,74 @@ async def update_dm_status(dm_id: int, body: DMStatusUpdate, user=Depends(get_cu
     elif body.status == "success":
         update_data["sent_at"] = datetime.utcnow().isoformat()
 
-    result = sb.table("dm_send_log").update(update_data).eq("id", dm_id).eq("account_id", account_id).execute()
+    result = await sb.table("dm_send_log").update(update_data).eq("id", dm_id).eq("account_id", account_id).execute()
     if not result.data:
         raise HTTPException(status_code=404, detail="DM log not found")
     return result.data[0]
 
 
+@router.post("/queue/claim")
+async def claim_dm_queue(body: DMQueueClaim, user=Depends(get_current_user)):
+    """送信タブ用: queued 行を最大 limit 件リースして返す
+
+    claim_dm_queue RPC（FOR UPDATE SKIP LOCKED）で取得と 'sending' への更新を
+    1文で行うため、複数タブ・複数端末が同時に呼んでも同じ行は配られない。
+    lease_seconds 内に ack されなかった行は次の claim で再配布される。
+    wait_seconds > 0 なら、空のときキュー登録の通知かタイムアウトまで待つ（long-poll）。
+    """
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
+
+    async def claim():
+        result = await sb.rpc("claim_dm_queue", {
+            "p_account_id": body.account_id,
+            "p_worker_id": body.worker_id,
+            "p_limit": body.limit,
+            "p_lease_seconds": body.lease_seconds,
+        }).execute()
+        return result.data or []
+
+    if body.wait_seconds:
+        return await long_poll(body.account_id, claim, body.wait_seconds)
+    return await claim()
+
+
+@router.post("/queue/ack")
+async def ack_dm_queue(body: DMQueueAck, user=Depends(get_current_user)):
+    """送信タブ用: 送信結果をまとめて確定（status=sending はリース延長）
+
+    リースを保持しているワーカーの結果だけが反映される。
+    反映されなかった id（リース切れで他ワーカーへ再配布済み等）は rejected で返す。
+    """
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
+
+    if not body.results:
+        return {"acked": [], "rejected": []}
+
+    results = [
+        {
+            "id": r.id,
+            "status": r.status,
+            "error": r.error,
+            "sent_at": r.sent_at.isoformat() if r.sent_at else None,
+        }
+        for r in body.results
+    ]
+    result = await sb.rpc("ack_dm_queue", {
+        "p_account_id": body.account_id,
+        "p_worker_id": body.worker_id,
+        "p_results": results,
+        "p_lease_seconds": body.lease_seconds,
+    }).execute()
+
+    acked = {r["ack_id"]: r["ack_status"] for r in (result.data or [])}
+    return {
+        "acked": [{"id": dm_id, "status": status} for dm_id, status in acked.items()],
+        "rejected": [r.id for r in body.results if r.id not in acked],
+    }
+
+
 # ============================================================
 # DM Logs (レガシー互換)
 # ============================================================
@@ -223,23 +311,27 @@ async def get_dm_log(
     campaign: str = None,
     days: int = Query(default=30, le=365),
     limit: int = Query(default=100, le=1000),
+    cursor: Optional[str] = None,
+    response: Response = None,
     user=Depends(get_current_user)
 ):
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    """送信ログ（新しい順）。次ページのカーソルは X-Next-Cursor ヘッダ、cursor 指定時は days を適用しない"""
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
-    since = (datetime.utcnow() - timedelta(days=days)).isoformat()
     query = (sb.table("dm_send_log")
              .select("*")
              .eq("account_id", account_id)
-             .gte("queued_at", since)
-             .order("queued_at", desc=True)
              .limit(limit))
-
+    if not cursor:
+        since = (datetime.utcnow() - timedelta(days=days)).isoformat()
+        query = query.gte("queued_at", since)
     if campaign:
         query = query.eq("campaign", campaign)
 
-    return query.execute().data
+    data = (await apply_keyset(query, "queued_at", cursor).execute()).data
+    response.headers["X-Next-Cursor"] = next_cursor(data or [], limit, "queued_at") or ""
+    return data
 
 
 # ============================================================
@@ -253,13 +345,13 @@ async def get_dm_effectiveness(
     user=Depends(get_current_user)
 ):
     """DM送信後N日以内の再課金率（キャンペーン別）"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     params = {"p_account_id": account_id, "p_window_days": window_days}
     if cast_name:
         params["p_cast_name"] = cast_name
-    result = sb.rpc("dm_effectiveness", params).execute()
+    result = await sb.rpc("dm_effectiveness", params).execute()
 
     return result.data
 
@@ -269,18 +361,18 @@ async def get_dm_effectiveness(
 # ============================================================
 @router.get("/templates")
 async def list_templates(account_id: str, user=Depends(get_current_user)):
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
-    result = sb.table("dm_templates").select("*").eq("account_id", account_id).order("created_at").execute()
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
+    result = await sb.table("dm_templates").select("*").eq("account_id", account_id).order("created_at").execute()
     return result.data
 
 
 @router.post("/templates")
 async def create_template(body: DMTemplateCreate, user=Depends(get_current_user)):
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
-    result = sb.table("dm_templates").insert({
+    result = await sb.table("dm_templates").insert({
         "account_id": body.account_id,
         "name": body.name,
         "message": body.message,
@@ -292,13 +384,13 @@ async def create_template(body: DMTemplateCreate, user=Depends(get_current_user)
 
 @router.delete("/templates/{template_id}")
 async def delete_template(template_id: str, user=Depends(get_current_user)):
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
     # 所有権チェック: テンプレートのaccount_idがユーザーのものか確認
-    tmpl = sb.table("dm_templates").select("account_id").eq("id", template_id).single().execute()
+    tmpl = await sb.table("dm_templates").select("account_id").eq("id", template_id).single().execute()
     if not tmpl.data:
         raise HTTPException(status_code=404, detail="Template not found")
-    _verify_account_ownership(sb, tmpl.data["account_id"], user["user_id"])
-    sb.table("dm_templates").delete().eq("id", template_id).execute()
+    await get_account_context(tmpl.data["account_id"], user["user_id"])
+    await sb.table("dm_templates").delete().eq("id", template_id).execute()
     return {"deleted": True}
 
 
@@ -314,11 +406,11 @@ async def get_thankyou_candidates(
     user=Depends(get_current_user),
 ):
     """配信終了後のお礼DM候補を取得"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     try:
-        result = sb.rpc("get_thankyou_dm_candidates", {
+        result = await sb.rpc("get_thankyou_dm_candidates", {
             "p_account_id": account_id,
             "p_cast_name": cast_name,
             "p_session_id": session_id,
@@ -341,11 +433,11 @@ async def get_churn_risk(
     user=Depends(get_current_user),
 ):
     """離脱予兆ユーザーを検出"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     try:
-        result = sb.rpc("detect_churn_risk", {
+        result = await sb.rpc("detect_churn_risk", {
             "p_account_id": account_id,
             "p_cast_name": cast_name,
             "p_lookback_sessions": lookback_sessions,
@@ -357,19 +449,20 @@ async def get_churn_risk(
 
 
 # ============================================================
-# ADM Trigger — 新規ユーザー自動DM発火
+# ADM Trigger — 自動DM発火（手動実行）
 # ============================================================
 @router.post("/trigger")
 async def trigger_adm(
-    lookback_hours: int = Query(default=24, ge=1, le=168, description="新規ユーザー検出の遡り時間"),
+    lookback_hours: int = Query(default=24, ge=1, le=168, description="課金・セッション終了イベントの遡り時間"),
     user=Depends(get_current_user),
 ):
     """
     ADM（自動DM）トリガーを実行。
-    paid_usersの新規ユーザーを検出し、dm_triggersルールに基づいてDMを自動発火する。
+    常駐の ADM daemon は課金・セッション終了を数秒で評価するため、通常は不要。
+    lookback_hours 内のイベントを全タイプの有効トリガーでまとめて評価し直す。
     """
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
     try:
         result = await run_adm_cycle(sb, account_id, lookback_hours=lookback_hours)
@@ -384,11 +477,11 @@ async def trigger_adm(
 @router.get("/triggers")
 async def list_triggers(user=Depends(get_current_user)):
     """有効・無効を含む全トリガーの一覧を返す"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
     result = (
-        sb.table("dm_triggers")
+        await sb.table("dm_triggers")
         .select("*")
         .eq("account_id", account_id)
         .order("priority")
@@ -400,13 +493,9 @@ async def list_triggers(user=Depends(get_current_user)):
 @router.post("/triggers")
 async def create_trigger(body: dict, user=Depends(get_current_user)):
     """新規トリガーを作成する"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
-    VALID_TRIGGER_TYPES = {
-        "first_visit", "vip_no_tip", "churn_risk", "segment_upgrade",
-        "competitor_outflow", "post_session", "cross_promotion",
-    }
     trigger_type = body.get("trigger_type")
     if trigger_type not in VALID_TRIGGER_TYPES:
         raise HTTPException(status_code=400, detail=f"無効なtrigger_type: {trigger_type}")
@@ -431,19 +520,20 @@ async def create_trigger(body: dict, user=Depends(get_current_user)):
         "priority": body.get("priority", 100),
     }
 
-    result = sb.table("dm_triggers").insert(insert_data).execute()
+    result = await sb.table("dm_triggers").insert(insert_data).execute()
+    invalidate_adm_triggers()
     return {"data": result.data[0] if result.data else None}
 
 
 @router.put("/triggers/{trigger_id}")
 async def update_trigger(trigger_id: str, body: dict, user=Depends(get_current_user)):
     """既存トリガーを更新する"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
     # 所有権チェック
     existing = (
-        sb.table("dm_triggers")
+        await sb.table("dm_triggers")
         .select("id")
         .eq("id", trigger_id)
         .eq("account_id", account_id)
@@ -462,24 +552,25 @@ async def update_trigger(trigger_id: str, body: dict, user=Depends(get_current_u
         raise HTTPException(status_code=400, detail="更新フィールドがありません")
 
     result = (
-        sb.table("dm_triggers")
+        await sb.table("dm_triggers")
         .update(update_data)
         .eq("id", trigger_id)
         .eq("account_id", account_id)
         .execute()
     )
+    invalidate_adm_triggers()
     return {"data": result.data[0] if result.data else None}
 
 
 @router.delete("/triggers/{trigger_id}")
 async def delete_trigger(trigger_id: str, user=Depends(get_current_user)):
     """トリガーを削除する"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
     # 所有権チェック
     existing = (
-        sb.table("dm_triggers")
+        await sb.table("dm_triggers")
         .select("id")
         .eq("id", trigger_id)
         .eq("account_id", account_id)
@@ -488,7 +579,9 @@ async def delete_trigger(trigger_id: str, user=Depends(get_current_user)):
     if not existing.data:
         raise HTTPException(status_code=404, detail="トリガーが見つかりません")
 
-    sb.table("dm_triggers").delete().eq("id", trigger_id).eq("account_id", account_id).execute()
+    await sb.table("dm_triggers").delete().eq("id", trigger_id).eq("account_id", account_id).execute()
+    invalidate_adm_triggers()
+    forget_trigger(trigger_id)
     return {"success": True}
 
 
@@ -499,8 +592,8 @@ async def list_trigger_logs(
     user=Depends(get_current_user),
 ):
     """トリガー発火ログを取得する"""
-    sb = get_supabase_admin()
-    account_id = _get_first_account_id(sb, user["user_id"])
+    sb = get_supabase_async()
+    account_id = await _get_first_account_id(sb, user["user_id"])
 
     query = (
         sb.table("dm_trigger_logs")
@@ -512,5 +605,5 @@ async def list_trigger_logs(
     if trigger_id:
         query = query.eq("trigger_id", trigger_id)
 
-    result = query.execute()
+    result = await query.execute()
     return {"data": result.data or []}
@@ -1,21 +1,15 @@
 """Feed router - Cast feed posts management & analytics"""
 from datetime import datetime, timedelta
 from collections import defaultdict
-from fastapi import APIRouter, Depends, HTTPException, Query
+from fastapi import APIRouter, Depends, Query
 from pydantic import BaseModel
 from typing import Optional
-from config import get_supabase_admin
-from routers.auth import get_current_user
+from config import get_supabase_async
+from routers.auth import get_account_context, get_current_user
 
 router = APIRouter()
 
 
-def _verify_account(sb, account_id: str, user_id: str):
-    result = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user_id).single().execute()
-    if not result.data:
-        raise HTTPException(status_code=404, detail="Account not found")
-
-
 class FeedPostCreate(BaseModel):
     account_id: str
     cast_name: str
@@ -37,8 +31,8 @@ async def list_posts(
     user=Depends(get_current_user),
 ):
     """フィード投稿一覧"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     query = (sb.table("feed_posts")
              .select("id, cast_name, post_type, content, media_url, likes_count, comments_count, posted_at")
@@ -51,7 +45,7 @@ async def list_posts(
     if since:
         query = query.gte("posted_at", since)
 
-    result = query.execute()
+    result = await query.execute()
     return {"posts": result.data or []}
 
 
@@ -61,8 +55,8 @@ async def list_posts(
 @router.post("/posts")
 async def create_post(body: FeedPostCreate, user=Depends(get_current_user)):
     """フィード投稿を登録"""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
     row = {
         "account_id": body.account_id,
@@ -73,7 +67,7 @@ async def create_post(body: FeedPostCreate, user=Depends(get_current_user)):
         "posted_at": body.posted_at.isoformat(),
     }
 
-    result = sb.table("feed_posts").insert(row).execute()
+    result = await sb.table("feed_posts").insert(row).execute()
     inserted = result.data[0]
     return {"id": inserted["id"], "posted_at": inserted["posted_at"]}
 
@@ -89,8 +83,8 @@ async def feed_analytics(
     user=Depends(get_current_user),
 ):
     """フィード分析: 週別投稿数、タイプ別内訳、セッション視聴者数との相関"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     since = (datetime.utcnow() - timedelta(days=days)).isoformat()
 
@@ -103,7 +97,7 @@ async def feed_analytics(
                .limit(500))
     if cast_name:
         posts_q = posts_q.eq("cast_name", cast_name)
-    posts_result = posts_q.execute()
+    posts_result = await posts_q.execute()
 
     posts = posts_result.data or []
 
@@ -141,7 +135,7 @@ async def feed_analytics(
               .limit(200))
     if cast_name:
         sess_q = sess_q.eq("cast_name", cast_name)
-    sessions_result = sess_q.execute()
+    sessions_result = await sess_q.execute()
 
     sessions_list = sessions_result.data or []
 
@@ -1,12 +1,13 @@
 """Reports router - AI session analysis report generation"""
+import asyncio
 from datetime import datetime, timedelta
 from collections import Counter
 from fastapi import APIRouter, Depends, HTTPException, Query
 from pydantic import BaseModel
 from typing import Optional
 import anthropic
-from config import get_supabase_admin, get_settings
-from routers.auth import get_current_user
+from config import get_supabase_async, get_settings
+from routers.auth import get_account_context, get_current_user
 
 router = APIRouter()
 
@@ -16,41 +17,29 @@ class ReportGenerateRequest(BaseModel):
     session_id: str
 
 
-def _verify_account(sb, account_id: str, user_id: str):
-    result = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user_id).single().execute()
-    if not result.data:
-        raise HTTPException(status_code=404, detail="Account not found")
-
-
-def _get_cast_usernames(sb, account_id: str) -> set:
-    result = sb.table("accounts").select("cast_usernames").eq("id", account_id).single().execute()
-    if result.data and result.data.get("cast_usernames"):
-        return set(result.data["cast_usernames"])
-    return set()
-
-
 @router.post("/generate")
 async def generate_report(body: ReportGenerateRequest, user=Depends(get_current_user)):
     """セッション終了後のAI分析レポート生成"""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
-
-    # (a) セッション情報取得（account_id で所有権チェック）
-    sess_result = sb.table("sessions").select("*").eq("session_id", body.session_id).eq("account_id", body.account_id).single().execute()
+    sb = get_supabase_async()
+    ctx = await get_account_context(body.account_id, user["user_id"])
+    cast_users = set(ctx["cast_usernames"])
+
+    # (a) セッション情報（account_id で所有権チェック）・(b) 全メッセージを並行取得
+    sess_result, msgs_result = await asyncio.gather(
+        sb.table("sessions").select("*").eq("session_id", body.session_id).eq("account_id", body.account_id).single().execute(),
+        sb.table("spy_messages")
+        .select("*")
+        .eq("session_id", body.session_id)
+        .order("message_time")
+        .limit(2000)
+        .execute(),
+    )
     if not sess_result.data:
         raise HTTPException(status_code=404, detail="Session not found")
     session = sess_result.data
 
-    # (b) 全メッセージ取得（キャスト除外）
-    msgs_result = (sb.table("spy_messages")
-                   .select("*")
-                   .eq("session_id", body.session_id)
-                   .order("message_time")
-                   .limit(2000)
-                   .execute())
+    # キャスト除外
     all_msgs = msgs_result.data or []
-
-    cast_users = _get_cast_usernames(sb, body.account_id)
     # Also exclude cast_name matching user_name
     cast_name = all_msgs[0]["cast_name"] if all_msgs else ""
     msgs = [m for m in all_msgs if not (
@@ -74,9 +63,8 @@ async def generate_report(body: ReportGenerateRequest, user=Depends(get_current_
     tip_msgs = [m for m in msgs if m.get("tokens", 0) > 0]
     total_coins = sum(m["tokens"] for m in tip_msgs)
 
-    # コイン→円換算レート取得
-    acct = sb.table("accounts").select("coin_rate").eq("id", body.account_id).single().execute()
-    coin_rate = acct.data.get("coin_rate", 7.7) if acct.data else 7.7
+    # コイン→円換算
+    coin_rate = ctx["coin_rate"]
     total_jpy = round(total_coins * coin_rate)
 
     # トップチッパー上位5名
@@ -199,13 +187,13 @@ DM送信候補のユーザーや、お礼すべきユーザーをリストアッ
         "tokens_used": tokens_used,
         "cost_usd": cost_usd,
     }
-    result = sb.table("ai_reports").insert(report_row).execute()
+    result = await sb.table("ai_reports").insert(report_row).execute()
 
     # AI使用カウンター更新
     try:
-        profile = sb.table("profiles").select("ai_used_this_month").eq("id", user["user_id"]).single().execute()
+        profile = await sb.table("profiles").select("ai_used_this_month").eq("id", user["user_id"]).single().execute()
         if profile.data:
-            sb.table("profiles").update({
+            await sb.table("profiles").update({
                 "ai_used_this_month": profile.data["ai_used_this_month"] + 1
             }).eq("id", user["user_id"]).execute()
     except Exception:
@@ -228,8 +216,8 @@ async def list_reports(
     user=Depends(get_current_user)
 ):
     """AIレポート一覧"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     query = (sb.table("ai_reports")
              .select("*")
@@ -241,5 +229,5 @@ async def list_reports(
     if session_id:
         query = query.eq("session_id", session_id)
 
-    result = query.execute()
+    result = await query.execute()
     return {"reports": result.data or []}
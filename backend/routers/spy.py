@@ -1,41 +1,35 @@
 """SPY router - Message ingestion, VIP alerts, comment pickup, sessions"""
+import asyncio
+import json
 from datetime import datetime, timedelta
 from typing import Optional
-from fastapi import APIRouter, Depends, HTTPException, Query
-from config import get_supabase_admin
-from routers.auth import get_current_user
+from fastapi import APIRouter, Depends, HTTPException, Query, Request, Response
+from fastapi.responses import StreamingResponse
+from config import get_supabase_async
+from routers.auth import get_account_context, get_current_user
 from models.schemas import SpyMessageCreate, SessionCreate, SessionUpdate, VIPAlert, ViewerStatsCreate, ViewerStatsBatchCreate, CastTagsUpdate
-from services.vip_checker import check_vip, classify_comment
+from services.adm_daemon import notify_adm_event
+from services.vip_checker import check_vip, classify_comment, get_vip_index, is_vip_user, pickup_columns
+from services.spy_ingest import enqueue_spy_message, insert_spy_rows
+from services.spy_import import get_progress, import_ndjson, new_progress, public_progress
+from services.spy_stream import Subscription, fetch_since, subscribe, unsubscribe
+from services.pagination import apply_keyset, next_cursor
 
 router = APIRouter()
 
 
-def _verify_account(sb, account_id: str, user_id: str):
-    result = sb.table("accounts").select("id").eq("id", account_id).eq("user_id", user_id).single().execute()
-    if not result.data:
-        raise HTTPException(status_code=404, detail="Account not found")
-
-
-def _get_cast_usernames(sb, account_id: str) -> set:
-    """キャスト除外用: accountsのcast_usernamesを取得（カラム未作成時は空setを返す）"""
-    try:
-        result = sb.table("accounts").select("cast_usernames").eq("id", account_id).single().execute()
-        if result.data and result.data.get("cast_usernames"):
-            return set(result.data["cast_usernames"])
-    except Exception:
-        # cast_usernames カラムが存在しない場合（406）はスキップ
-        pass
-    return set()
-
-
 # ============================================================
 # Message Ingestion (Chrome Extension → API)
 # ============================================================
 @router.post("/messages")
 async def receive_message(body: SpyMessageCreate, user=Depends(get_current_user)):
-    """Chrome extension sends intercepted chat messages here."""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    """Chrome extension sends intercepted chat messages here.
+
+    VIP判定・分類はその場で返し、INSERTはインジェストキュー経由でまとめて書き込む
+    （id はバッチ書き込み前のため None）。
+    """
+    sb = get_supabase_async()
+    ctx = await get_account_context(body.account_id, user["user_id"])
 
     # Check VIP (paid_users テーブルが空でもエラーにしない)
     try:
@@ -44,12 +38,12 @@ async def receive_message(body: SpyMessageCreate, user=Depends(get_current_user)
         vip_info = None
     is_vip = vip_info is not None
 
-    # Classify comment
+    # Classify comment（whale は一覧通知の重複抑止に関係なく既知の太客かどうか）
     classification = classify_comment(body.message, body.msg_type, body.tokens)
+    classification["is_whale"] = is_vip or is_vip_user(body.account_id, body.user_name)
 
-    # キャスト除外チェック (cast_usernames カラム未作成でもエラーにしない)
-    cast_users = _get_cast_usernames(sb, body.account_id)
-    is_cast = body.user_name in cast_users if body.user_name else False
+    # キャスト除外チェック
+    is_cast = body.user_name in ctx["cast_usernames"] if body.user_name else False
 
     metadata = {
         **body.metadata,
@@ -69,6 +63,7 @@ async def receive_message(body: SpyMessageCreate, user=Depends(get_current_user)
         "tokens": body.tokens,
         "is_vip": is_vip,
         "metadata": metadata,
+        **pickup_columns(classification),
     }
     if body.user_color:
         row["user_color"] = body.user_color
@@ -84,16 +79,12 @@ async def receive_message(body: SpyMessageCreate, user=Depends(get_current_user)
     if body.session_title:
         row["session_title"] = body.session_title
 
-    try:
-        result = sb.table("spy_messages").insert(row).execute()
-    except Exception:
-        # session_id/session_title カラムが無い場合はそれらを除外してリトライ
-        row.pop("session_id", None)
-        row.pop("session_title", None)
-        result = sb.table("spy_messages").insert(row).execute()
+    # キュー満杯・ライター停止中は直接INSERT
+    if not enqueue_spy_message(row):
+        await insert_spy_rows([row])
 
     return {
-        "id": result.data[0]["id"],
+        "id": None,
         "is_vip": is_vip,
         "is_cast": is_cast,
         "vip_alert": vip_info,
@@ -107,32 +98,68 @@ async def receive_message(body: SpyMessageCreate, user=Depends(get_current_user)
 @router.post("/messages/batch")
 async def receive_messages_batch(messages: list[SpyMessageCreate], user=Depends(get_current_user)):
     """Batch insert for catching up or importing CSV logs"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
     # 所有権チェック: バッチ内の全account_idがユーザーのものか確認
     account_ids = set(m.account_id for m in messages if m.account_id)
     for aid in account_ids:
-        _verify_account(sb, aid, user["user_id"])
-
-    rows = [{
-        "account_id": m.account_id,
-        "cast_name": m.cast_name,
-        "message_time": m.message_time.isoformat(),
-        "msg_type": m.msg_type,
-        "user_name": m.user_name,
-        "message": m.message,
-        "tokens": m.tokens,
-        "is_vip": False,
-        "metadata": m.metadata,
-        **({"session_id": m.session_id} if m.session_id else {}),
-        **({"user_color": m.user_color} if m.user_color else {}),
-        **({"user_league": m.user_league} if m.user_league else {}),
-        **({"user_level": m.user_level} if m.user_level is not None else {}),
-    } for m in messages]
-
-    result = sb.table("spy_messages").insert(rows).execute()
+        await get_account_context(aid, user["user_id"])
+        await get_vip_index(sb, aid)
+
+    def _row(m: SpyMessageCreate) -> dict:
+        # is_whale はピックアップ用に VIP 索引から（classify_comment は判定しない）
+        classification = classify_comment(m.message, m.msg_type, m.tokens)
+        classification["is_whale"] = is_vip_user(m.account_id, m.user_name)
+        return {
+            "account_id": m.account_id,
+            "cast_name": m.cast_name,
+            "message_time": m.message_time.isoformat(),
+            "msg_type": m.msg_type,
+            "user_name": m.user_name,
+            "message": m.message,
+            "tokens": m.tokens,
+            "is_vip": classification["is_whale"],
+            "metadata": m.metadata,
+            **pickup_columns(classification),
+            **({"session_id": m.session_id} if m.session_id else {}),
+            **({"user_color": m.user_color} if m.user_color else {}),
+            **({"user_league": m.user_league} if m.user_league else {}),
+            **({"user_level": m.user_level} if m.user_level is not None else {}),
+        }
+
+    rows = [_row(m) for m in messages]
+
+    result = await sb.table("spy_messages").insert(rows).execute()
     return {"inserted": len(result.data)}
 
 
+@router.post("/messages/import")
+async def import_messages_ndjson(
+    request: Request,
+    account_id: str,
+    import_id: Optional[str] = None,
+    chunk_size: int = Query(default=500, ge=50, le=1000),
+    user=Depends(get_current_user),
+):
+    """大量キャッチアップ用: (gzip) NDJSON をストリーミングで取り込む
+
+    1行 = SpyMessageCreate 相当のJSON。自然キーで重複排除し、chunk_size 行ずつINSERTする。
+    import_id を付けると取り込み中の進捗を GET /messages/import/{import_id} で参照できる。
+    """
+    await get_account_context(account_id, user["user_id"])
+    sb = get_supabase_async()
+    progress = new_progress(import_id, user["user_id"], account_id)
+    await import_ndjson(sb, account_id, request.stream(), progress, chunk_size)
+    return public_progress(progress)
+
+
+@router.get("/messages/import/{import_id}")
+async def get_import_progress(import_id: str, user=Depends(get_current_user)):
+    progress = get_progress(import_id, user["user_id"])
+    if progress is None:
+        raise HTTPException(status_code=404, detail="Import not found")
+    return progress
+
+
 # ============================================================
 # Query Messages
 # ============================================================
@@ -146,17 +173,25 @@ async def get_messages(
     vip_only: bool = False,
     exclude_cast: bool = False,
     limit: int = Query(default=200, le=2000),
+    cursor: Optional[str] = None,
+    response: Response = None,
     user=Depends(get_current_user)
 ):
-    sb = get_supabase_admin()
-    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+    """メッセージ一覧（新しい順）
+
+    次ページのカーソルは X-Next-Cursor ヘッダで返す。cursor 指定時は hours の
+    時間窓を適用せず、カーソル位置からさらに古い履歴へ辿れる。
+    """
+    sb = get_supabase_async()
 
     query = (sb.table("spy_messages")
              .select("*")
              .eq("account_id", account_id)
-             .gte("message_time", since)
-             .order("message_time", desc=True)
              .limit(limit))
+    if not cursor:
+        since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
+        query = query.gte("message_time", since)
+    query = apply_keyset(query, "message_time", cursor)
 
     if cast_name:
         query = query.eq("cast_name", cast_name)
@@ -167,18 +202,93 @@ async def get_messages(
     if vip_only:
         query = query.eq("is_vip", True)
 
-    result = query.execute()
+    result = await query.execute()
     data = result.data or []
+    # カーソルはキャスト除外前の行で決める（除外で件数が減っても続きを取りこぼさない）
+    response.headers["X-Next-Cursor"] = next_cursor(data, limit, "message_time") or ""
 
     # キャスト除外（Python側フィルタ — cast_usernamesカラムがJSONBでないため）
     if exclude_cast and data:
-        cast_users = _get_cast_usernames(sb, account_id)
+        cast_users = set((await get_account_context(account_id, user["user_id"]))["cast_usernames"])
         if cast_users:
             data = [m for m in data if m.get("user_name") not in cast_users]
 
     return data
 
 
+# ============================================================
+# Live Stream (Server-Sent Events)
+# ============================================================
+STREAM_HEARTBEAT_SECONDS = 15
+
+
+@router.get("/messages/stream")
+async def stream_messages(
+    request: Request,
+    account_id: str,
+    cast_name: str = None,
+    msg_type: str = None,
+    vip_only: bool = False,
+    exclude_cast: bool = False,
+    last_id: Optional[int] = None,
+    user=Depends(get_current_user)
+):
+    """新着 spy_messages を SSE で配信（差分のみ）
+
+    再接続時は last_id または Last-Event-ID ヘッダ以降の取りこぼし分から再開する。
+    取りこぼし分が上限を超えたときは resync イベントを送って切断する（続きは再接続で取得）。
+    """
+    ctx = await get_account_context(account_id, user["user_id"])
+    if last_id is None and request.headers.get("last-event-id", "").isdigit():
+        last_id = int(request.headers["last-event-id"])
+
+    sub = Subscription(
+        cast_name=cast_name,
+        msg_type=msg_type,
+        vip_only=vip_only,
+        exclude_users=set(ctx["cast_usernames"]) if exclude_cast else set(),
+    )
+
+    def _event(row: dict) -> str:
+        return f"id: {row['id']}\nevent: message\ndata: {json.dumps(row, ensure_ascii=False, default=str)}\n\n"
+
+    async def event_stream():
+        # 配信開始位置が確定してから取りこぼし分を取得し、ライブ側の重複は id で捨てる
+        sb = get_supabase_async()
+        await subscribe(sb, account_id, sub)
+        try:
+            replayed: set[int] = set()
+            if last_id is not None:
+                rows, truncated = await fetch_since(sb, account_id, last_id, cast_name)
+                for row in rows:
+                    replayed.add(row["id"])
+                    if sub.matches(row):
+                        yield _event(row)
+                if truncated:
+                    # 上限で打ち切った: 続きは Last-Event-ID（= resume_id）からの再接続で取得させる
+                    resume_id = rows[-1]["id"]
+                    payload = json.dumps({"reason": "replay_truncated", "last_id": resume_id})
+                    yield f"id: {resume_id}\nevent: resync\ndata: {payload}\n\n"
+                    return
+            while not (sub.overflowed and sub.queue.empty()):
+                try:
+                    row = await asyncio.wait_for(sub.queue.get(), STREAM_HEARTBEAT_SECONDS)
+                except asyncio.TimeoutError:
+                    yield ": keep-alive\n\n"
+                    continue
+                if row["id"] in replayed:
+                    continue
+                yield _event(row)
+        finally:
+            unsubscribe(account_id, sub)
+
+    return StreamingResponse(
+        event_stream(),
+        media_type="text/event-stream",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+
+
 # ============================================================
 # VIP Alerts
 # ============================================================
@@ -189,10 +299,10 @@ async def get_vip_alerts(
     user=Depends(get_current_user)
 ):
     """Recent VIP entries (deduplicated)"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
     since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
 
-    result = (sb.table("spy_messages")
+    result = (await sb.table("spy_messages")
               .select("*")
               .eq("account_id", account_id)
               .eq("is_vip", True)
@@ -229,47 +339,43 @@ async def get_vip_alerts(
 async def get_pickup_comments(
     account_id: str,
     cast_name: str,
+    response: Response = None,
     hours: int = Query(default=3, le=12),
     filter_type: str = Query(default="all", regex="^(all|whale|gift|question)$"),
     exclude_cast: bool = False,
+    limit: int = Query(default=500, ge=1, le=1000),
+    cursor: Optional[str] = None,
     user=Depends(get_current_user)
 ):
-    """Filtered comment pickup (whale/gift/question)"""
-    sb = get_supabase_admin()
-    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
-
-    result = (sb.table("spy_messages")
-              .select("*")
-              .eq("account_id", account_id)
-              .eq("cast_name", cast_name)
-              .gte("message_time", since)
-              .order("message_time", desc=True)
-              .limit(500)
-              .execute())
+    """Filtered comment pickup (whale/gift/question)
 
-    data = result.data or []
+    取り込み時に付与した is_whale / is_gift / is_question 列と、それぞれの
+    部分インデックス（マイグレーション 144）で絞り込むため、時間窓内の該当行を
+    取りこぼさない。続きは X-Next-Cursor で取得。
+    """
+    sb = get_supabase_async()
+    since = (datetime.utcnow() - timedelta(hours=hours)).isoformat()
 
-    # キャスト除外
-    if exclude_cast and data:
-        cast_users = _get_cast_usernames(sb, account_id)
+    query = (sb.table("spy_messages")
+             .select("*")
+             .eq("account_id", account_id)
+             .eq("cast_name", cast_name)
+             .gte("message_time", since))
+    if filter_type != "all":
+        query = query.eq(f"is_{filter_type}", True)
+
+    # キャスト除外（user_name が無いシステム行は残す）
+    if exclude_cast:
+        cast_users = (await get_account_context(account_id, user["user_id"]))["cast_usernames"]
         if cast_users:
-            data = [m for m in data if m.get("user_name") not in cast_users]
+            quoted = ",".join('"' + name.replace('"', '\\"') + '"' for name in cast_users)
+            query = query.or_(f"user_name.is.null,user_name.not.in.({quoted})")
 
-    if filter_type == "all":
-        return data
-
-    # Filter by classification
-    filtered = []
-    for msg in data:
-        cls = msg.get("metadata", {}).get("classification", {})
-        if filter_type == "whale" and cls.get("is_whale"):
-            filtered.append(msg)
-        elif filter_type == "gift" and msg["msg_type"] in ("gift", "tip"):
-            filtered.append(msg)
-        elif filter_type == "question" and cls.get("is_question"):
-            filtered.append(msg)
-
-    return filtered
+    result = await apply_keyset(query, "message_time", cursor).limit(limit).execute()
+    data = result.data or []
+    if response is not None:
+        response.headers["X-Next-Cursor"] = next_cursor(data, limit, "message_time") or ""
+    return data
 
 
 # ============================================================
@@ -278,7 +384,7 @@ async def get_pickup_comments(
 @router.patch("/casts/{cast_id}/tags")
 async def update_cast_tags(cast_id: int, body: CastTagsUpdate, user=Depends(get_current_user)):
     """Update tags (genre, benchmark, category, notes) for a cast."""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
     update_data: dict = {}
     if body.genre is not None:
         update_data["genre"] = body.genre or None
@@ -297,10 +403,10 @@ async def update_cast_tags(cast_id: int, body: CastTagsUpdate, user=Depends(get_
     # Try spy_casts first (BIGSERIAL id), then registered_casts
     # 所有権チェック: cast_id のレコードが現在ユーザーの account に属しているか確認
     try:
-        cast_row = sb.table("spy_casts").select("account_id").eq("id", cast_id).single().execute()
+        cast_row = await sb.table("spy_casts").select("account_id").eq("id", cast_id).single().execute()
         if cast_row.data:
-            _verify_account(sb, cast_row.data["account_id"], user["user_id"])
-            result = sb.table("spy_casts").update(update_data).eq("id", cast_id).execute()
+            await get_account_context(cast_row.data["account_id"], user["user_id"])
+            result = await sb.table("spy_casts").update(update_data).eq("id", cast_id).execute()
             if result.data:
                 return result.data[0]
     except HTTPException:
@@ -309,10 +415,10 @@ async def update_cast_tags(cast_id: int, body: CastTagsUpdate, user=Depends(get_
         pass
 
     try:
-        cast_row = sb.table("registered_casts").select("account_id").eq("id", cast_id).single().execute()
+        cast_row = await sb.table("registered_casts").select("account_id").eq("id", cast_id).single().execute()
         if cast_row.data:
-            _verify_account(sb, cast_row.data["account_id"], user["user_id"])
-            result = sb.table("registered_casts").update(update_data).eq("id", cast_id).execute()
+            await get_account_context(cast_row.data["account_id"], user["user_id"])
+            result = await sb.table("registered_casts").update(update_data).eq("id", cast_id).execute()
             if result.data:
                 return result.data[0]
     except HTTPException:
@@ -329,8 +435,8 @@ async def update_cast_tags(cast_id: int, body: CastTagsUpdate, user=Depends(get_
 @router.post("/sessions")
 async def create_session(body: SessionCreate, user=Depends(get_current_user)):
     """配信セッション開始"""
-    sb = get_supabase_admin()
-    _verify_account(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
     row = {
         "account_id": body.account_id,
@@ -338,14 +444,14 @@ async def create_session(body: SessionCreate, user=Depends(get_current_user)):
         "title": body.title,
         "started_at": body.started_at.isoformat(),
     }
-    result = sb.table("sessions").insert(row).execute()
+    result = await sb.table("sessions").insert(row).execute()
     return result.data[0]
 
 
 @router.put("/sessions/{session_id}")
 async def update_session(session_id: str, body: SessionUpdate, user=Depends(get_current_user)):
     """配信セッション終了・更新"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     update_data = {}
     if body.ended_at:
@@ -356,16 +462,20 @@ async def update_session(session_id: str, body: SessionUpdate, user=Depends(get_
     if not update_data:
         raise HTTPException(status_code=400, detail="更新データがありません")
 
-    result = sb.table("sessions").update(update_data).eq("session_id", session_id).execute()
+    result = await sb.table("sessions").update(update_data).eq("session_id", session_id).execute()
     if not result.data:
         raise HTTPException(status_code=404, detail="Session not found")
 
     # セッション統計を更新
     try:
-        sb.rpc("update_session_stats", {"p_session_id": session_id}).execute()
+        await sb.rpc("update_session_stats", {"p_session_id": session_id}).execute()
     except Exception:
         pass
 
+    # 配信終了 → vip_no_tip / post_session の評価を起こす
+    if body.ended_at:
+        notify_adm_event()
+
     return result.data[0]
 
 
@@ -374,29 +484,31 @@ async def list_sessions(
     account_id: str,
     limit: int = Query(default=20, le=100),
     cast_name: Optional[str] = Query(default=None),
+    cursor: Optional[str] = None,
+    response: Response = None,
     user=Depends(get_current_user)
 ):
-    """セッション一覧"""
-    sb = get_supabase_admin()
-    _verify_account(sb, account_id, user["user_id"])
+    """セッション一覧（次ページのカーソルは X-Next-Cursor ヘッダ）"""
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     q = (sb.table("sessions")
          .select("*")
          .eq("account_id", account_id)
-         .order("started_at", desc=True)
          .limit(limit))
     if cast_name:
         q = q.eq("cast_name", cast_name)
-    result = q.execute()
+    result = await apply_keyset(q, "started_at", cursor).execute()
+    response.headers["X-Next-Cursor"] = next_cursor(result.data or [], limit, "started_at") or ""
     return result.data
 
 
 @router.get("/sessions/{session_id}")
 async def get_session(session_id: str, user=Depends(get_current_user)):
     """セッション詳細"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
-    result = sb.table("sessions").select("*").eq("session_id", session_id).single().execute()
+    result = await sb.table("sessions").select("*").eq("session_id", session_id).single().execute()
     if not result.data:
         raise HTTPException(status_code=404, detail="Session not found")
 
@@ -409,7 +521,7 @@ async def get_session(session_id: str, user=Depends(get_current_user)):
 @router.post("/viewer-stats")
 async def create_viewer_stat(body: ViewerStatsCreate, user=Depends(get_current_user)):
     """視聴者数データを1件記録"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     row = {
         "account_id": body.account_id,
@@ -428,7 +540,7 @@ async def create_viewer_stat(body: ViewerStatsCreate, user=Depends(get_current_u
         row["recorded_at"] = body.recorded_at.isoformat()
 
     try:
-        result = sb.table("viewer_stats").insert(row).execute()
+        result = await sb.table("viewer_stats").insert(row).execute()
         return {"id": result.data[0]["id"], "recorded_at": result.data[0]["recorded_at"]}
     except Exception as e:
         # viewer_stats テーブルが未作成の場合
@@ -438,7 +550,7 @@ async def create_viewer_stat(body: ViewerStatsCreate, user=Depends(get_current_u
 @router.post("/viewer-stats/batch")
 async def create_viewer_stats_batch(body: ViewerStatsBatchCreate, user=Depends(get_current_user)):
     """視聴者数データを一括記録"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     rows = [{
         "account_id": body.account_id,
@@ -453,7 +565,7 @@ async def create_viewer_stats_batch(body: ViewerStatsBatchCreate, user=Depends(g
     } for s in body.stats]
 
     try:
-        result = sb.table("viewer_stats").insert(rows).execute()
+        result = await sb.table("viewer_stats").insert(rows).execute()
         return {"inserted": len(result.data)}
     except Exception as e:
         raise HTTPException(status_code=501, detail=f"viewer_statsテーブル未作成: {e}")
@@ -469,7 +581,7 @@ async def get_viewer_stats(
     user=Depends(get_current_user)
 ):
     """視聴者数データ取得"""
-    sb = get_supabase_admin()
+    sb = get_supabase_async()
 
     query = (sb.table("viewer_stats")
              .select("*")
@@ -481,7 +593,7 @@ async def get_viewer_stats(
 
     # session_id → sessionsテーブルからstarted_at/ended_atを取得してフィルタ
     if session_id:
-        sess = sb.table("sessions").select("started_at, ended_at").eq("session_id", session_id).single().execute()
+        sess = await sb.table("sessions").select("started_at, ended_at").eq("session_id", session_id).single().execute()
         if sess.data:
             query = query.gte("recorded_at", sess.data["started_at"])
             if sess.data.get("ended_at"):
@@ -492,7 +604,7 @@ async def get_viewer_stats(
     if until:
         query = query.lte("recorded_at", until)
 
-    result = query.limit(500).execute()
+    result = await query.limit(500).execute()
     data = result.data or []
 
     # Summary
@@ -9,7 +9,7 @@ import os
 from fastapi import APIRouter, Depends, HTTPException
 from pydantic import BaseModel
 from typing import Optional
-from config import get_supabase_admin
+from config import get_supabase_async
 from routers.auth import get_current_user
 
 router = APIRouter()
@@ -67,7 +67,7 @@ async def transcribe(body: TranscribeRequest, user=Depends(get_current_user)):
             )
 
         # 5. spy_messages に msg_type='speech' で INSERT
-        sb = get_supabase_admin()
+        sb = get_supabase_async()
         row = {
             "account_id": body.account_id,
             "cast_name": body.cast_name,
@@ -86,7 +86,7 @@ async def transcribe(body: TranscribeRequest, user=Depends(get_current_user)):
             },
         }
 
-        insert_result = sb.table("spy_messages").insert(row).execute()
+        insert_result = await sb.table("spy_messages").insert(row).execute()
         inserted_id = insert_result.data[0]["id"] if insert_result.data else None
 
         return TranscribeResponse(
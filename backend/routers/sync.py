@@ -1,4 +1,5 @@
 """Sync router - Coin API同期, CSVアップロード, デモデータ, Cookie同期, ステータス"""
+import asyncio
 import csv
 import io
 import json
@@ -11,8 +12,12 @@ from pathlib import Path
 from fastapi import APIRouter, Depends, HTTPException, UploadFile, File, Form, Query
 from pydantic import BaseModel
 from typing import Optional
-from config import get_supabase_admin
-from routers.auth import get_current_user
+from config import get_supabase_async
+from routers.auth import get_account_context, get_current_user
+from services.adm_daemon import notify_adm_event
+from services.analytics_cache import bump_account_version
+from services.paying_users_refresh import get_refresh_status, request_paying_users_refresh
+from services.vip_checker import update_vip_index
 
 logger = logging.getLogger(__name__)
 
@@ -43,6 +48,8 @@ class SyncStatusResponse(BaseModel):
     total_transactions: int
     last_sync: Optional[str] = None
     total_coins: int = 0
+    paying_users_pending: bool = False          # 同期結果が paying_users に未反映
+    paying_users_refreshed_at: Optional[str] = None
 
 
 class DemoSyncResponse(BaseModel):
@@ -53,17 +60,6 @@ class DemoSyncResponse(BaseModel):
 # ============================================================
 # Helpers
 # ============================================================
-def _verify_account_ownership(sb, account_id: str, user_id: str):
-    result = (
-        sb.table("accounts")
-        .select("id")
-        .eq("id", account_id)
-        .eq("user_id", user_id)
-        .single()
-        .execute()
-    )
-    if not result.data:
-        raise HTTPException(status_code=404, detail="Account not found")
 
 
 STRIPCHAT_COINS_API = "https://stripchat.com/api/front/v2/earnings/coins-history"
@@ -77,8 +73,8 @@ TX_TYPES = ["private", "ticket", "tip", "spy", "group", "striptease"]
 @router.post("/coins", response_model=CoinSyncResponse)
 async def sync_coins(body: CoinSyncRequest, user=Depends(get_current_user)):
     """Stripchat Coin API経由で課金履歴を同期"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, body.account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(body.account_id, user["user_id"])
 
     # Stripchat APIを呼び出し
     try:
@@ -162,7 +158,7 @@ async def sync_coins(body: CoinSyncRequest, user=Depends(get_current_user)):
     synced_tx = 0
     if tx_rows:
         result = (
-            sb.table("coin_transactions")
+            await sb.table("coin_transactions")
             .upsert(tx_rows, on_conflict="account_id,user_name,cast_name,tokens,date")
             .execute()
         )
@@ -195,17 +191,17 @@ async def sync_coins(body: CoinSyncRequest, user=Depends(get_current_user)):
     synced_users = 0
     if user_rows:
         result = (
-            sb.table("paid_users")
+            await sb.table("paid_users")
             .upsert(user_rows, on_conflict="account_id,user_name")
             .execute()
         )
         synced_users = len(result.data)
+        update_vip_index(body.account_id, user_rows)
 
-    # MATERIALIZED VIEW 更新
-    try:
-        sb.rpc("refresh_paying_users").execute()
-    except Exception:
-        pass  # VIEW が存在しない場合はスキップ
+    # MATERIALIZED VIEW 更新（バックグラウンドでまとめて実行）・集計キャッシュ無効化
+    request_paying_users_refresh(body.account_id)
+    bump_account_version(body.account_id)
+    notify_adm_event()
 
     last_date = None
     if tx_rows:
@@ -226,8 +222,8 @@ async def sync_coins(body: CoinSyncRequest, user=Depends(get_current_user)):
 @router.post("/demo", response_model=DemoSyncResponse)
 async def sync_demo(account_id: str, user=Depends(get_current_user)):
     """開発テスト用デモデータ投入"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     now = datetime.now(timezone.utc)
 
@@ -253,10 +249,11 @@ async def sync_demo(account_id: str, user=Depends(get_current_user)):
         )
 
     result_users = (
-        sb.table("paid_users")
+        await sb.table("paid_users")
         .upsert(paid_user_rows, on_conflict="account_id,user_name")
         .execute()
     )
+    update_vip_index(account_id, paid_user_rows)
 
     # --- coin_transactions: 30件 ---
     tx_rows = []
@@ -279,13 +276,12 @@ async def sync_demo(account_id: str, user=Depends(get_current_user)):
             }
         )
 
-    result_tx = sb.table("coin_transactions").insert(tx_rows).execute()
+    result_tx = await sb.table("coin_transactions").insert(tx_rows).execute()
 
-    # MATERIALIZED VIEW 更新
-    try:
-        sb.rpc("refresh_paying_users").execute()
-    except Exception:
-        pass
+    # MATERIALIZED VIEW 更新（バックグラウンドでまとめて実行）・集計キャッシュ無効化
+    request_paying_users_refresh(account_id)
+    bump_account_version(account_id)
+    notify_adm_event()
 
     return DemoSyncResponse(
         inserted_users=len(result_users.data),
@@ -299,50 +295,42 @@ async def sync_demo(account_id: str, user=Depends(get_current_user)):
 @router.get("/status/{account_id}", response_model=SyncStatusResponse)
 async def get_sync_status_by_id(account_id: str, user=Depends(get_current_user)):
     """アカウントの同期状態を取得"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
-    # paid_users 件数
-    users = (
+    # 件数・合計コインは account_coin_totals（coin_transactions のトリガーで更新）から1行で取る
+    users, totals, latest_tx = await asyncio.gather(
+        # paid_users 件数
         sb.table("paid_users")
         .select("id", count="exact")
         .eq("account_id", account_id)
-        .execute()
-    )
-
-    # coin_transactions 件数
-    tx = (
-        sb.table("coin_transactions")
-        .select("id", count="exact")
-        .eq("account_id", account_id)
-        .execute()
-    )
-
-    # 合計コイン
-    coins_result = (
-        sb.table("coin_transactions")
-        .select("tokens")
+        .limit(1)
+        .execute(),
+        # coin_transactions 件数・合計コイン
+        sb.table("account_coin_totals")
+        .select("total_coins, tx_count")
         .eq("account_id", account_id)
-        .execute()
-    )
-    total_coins = sum(r["tokens"] for r in (coins_result.data or []))
-
-    # 最新トランザクション日
-    latest_tx = (
+        .limit(1)
+        .execute(),
+        # 最新トランザクション日
         sb.table("coin_transactions")
         .select("date")
         .eq("account_id", account_id)
         .order("date", desc=True)
         .limit(1)
-        .execute()
+        .execute(),
     )
+    total = totals.data[0] if totals.data else {}
+    refresh = get_refresh_status(account_id)
 
     return SyncStatusResponse(
         account_id=account_id,
         total_users=users.count or 0,
-        total_transactions=tx.count or 0,
+        total_transactions=total.get("tx_count") or 0,
         last_sync=latest_tx.data[0]["date"] if latest_tx.data else None,
-        total_coins=total_coins,
+        total_coins=total.get("total_coins") or 0,
+        paying_users_pending=refresh["pending"],
+        paying_users_refreshed_at=refresh["refreshed_at"],
     )
 
 
@@ -365,8 +353,8 @@ async def upload_csv(
     user=Depends(get_current_user),
 ):
     """CSVファイルからpaid_usersをアップロード"""
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     content = await file.read()
     text = content.decode("utf-8-sig")
@@ -394,10 +382,12 @@ async def upload_csv(
         raise HTTPException(status_code=400, detail="CSVに有効な行がありません")
 
     result = (
-        sb.table("paid_users")
+        await sb.table("paid_users")
         .upsert(rows, on_conflict="account_id,user_name")
         .execute()
     )
+    update_vip_index(account_id, rows)
+    bump_account_version(account_id)
 
     return {"upserted": len(result.data)}
 
@@ -414,8 +404,8 @@ async def upload_coin_transactions(
     """Chrome拡張からの課金トランザクション投入（JSON文字列）"""
     import json
 
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, account_id, user["user_id"])
+    sb = get_supabase_async()
+    await get_account_context(account_id, user["user_id"])
 
     tx_list = json.loads(transactions)
     rows = []
@@ -438,17 +428,16 @@ async def upload_coin_transactions(
         })
 
     if rows:
-        sb.table("coin_transactions").upsert(
+        await sb.table("coin_transactions").upsert(
             rows,
             on_conflict="account_id,user_name,cast_name,tokens,date",
             ignore_duplicates=True,
         ).execute()
 
-    # MATERIALIZED VIEW 更新
-    try:
-        sb.rpc("refresh_paying_users").execute()
-    except Exception:
-        pass
+    # MATERIALIZED VIEW 更新（バックグラウンドでまとめて実行）・集計キャッシュ無効化
+    request_paying_users_refresh(account_id)
+    bump_account_version(account_id)
+    notify_adm_event()
 
     return {"inserted": len(rows)}
 
@@ -467,8 +456,7 @@ async def sync_cookies(body: CookieSyncRequest, user=Depends(get_current_user)):
     Chrome拡張から Stripchat Cookie を受信し cookies.json に保存。
     Chrome DB ロック問題を完全回避する方式B。
     """
-    sb = get_supabase_admin()
-    _verify_account_ownership(sb, body.account_id, user["user_id"])
+    await get_account_context(body.account_id, user["user_id"])
 
     if not body.cookies:
         raise HTTPException(status_code=400, detail="cookies が空です")
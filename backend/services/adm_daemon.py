@@ -0,0 +1,337 @@
+"""ADM daemon - 課金・セッション終了イベントで全アカウントのトリガーを常時評価する
+
+これまで自動DMは POST /api/dm/trigger を押したときだけ、first_visit だけが評価されていた。
+ここではバックグラウンドタスクが POLL_SECONDS ごと（または notify_adm_event() で即時）に
+1パスで全アカウントのイベントを拾い、イベントのあったアカウントだけを評価する。
+
+- 課金: coin_transactions を id の透かしで追う（paid_users / user_segment_members は
+  coin_transactions からの派生なので、初課金もセグメント昇格もここから分かる）。
+  遅れてコミットされた小さい id の行は created_at の重なり窓で拾う
+- セッション終了: sessions.ended_at の透かしで追う。post_session は delay_minutes 後に評価
+  （待ち行列はメモリ上なので、起動時に sessions.ended_at から組み直す）
+- churn_risk / competitor_outflow / cross_promotion は SCHEDULED_INTERVAL_SECONDS ごと
+
+同時に評価するアカウント数は MAX_PARALLEL_ACCOUNTS、アカウント内の並列度と
+読み込みの共有は adm_engine.evaluate_account が受け持つ。
+collector 等の別プロセスからの書き込みは通知されないが、次のポーリングで拾う。
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+from config import get_supabase_async
+from services.adm_engine import (
+    SCHEDULED_TRIGGER_TYPES,
+    evaluate_account,
+    new_adm_events,
+)
+
+logger = logging.getLogger(__name__)
+
+POLL_SECONDS = 10.0
+TRIGGER_CACHE_SECONDS = 60.0
+SCHEDULED_INTERVAL_SECONDS = 3600.0
+MAX_PARALLEL_ACCOUNTS = 4
+STARTUP_LOOKBACK_MINUTES = 10   # 起動直後はこの時間分のイベントから拾う（重複はクールダウンで弾く）
+TX_BATCH = 1000
+TX_OVERLAP_SECONDS = 60.0        # 課金を書くトランザクションの長さ + DBとの時計のずれより長く
+SESSION_BATCH = 200
+
+_tx_watermark: int | None = None          # 処理済み coin_transactions.id
+_tx_polled_at: float | None = None        # 前回の課金ポーリング開始時刻(epoch)
+_seen_tx: dict[int, float] = {}           # 読み直し範囲内の処理済み id → created_at(epoch)
+_session_watermark: str | None = None     # 処理済み sessions.ended_at
+_seen_sessions: dict[str, str] = {}       # 透かしと同時刻の session_id → ended_at（再処理防止）
+_post_session_queue: list[dict] = []      # {"due", "account_id", "trigger_id", "session"}
+_last_scheduled: dict[str, float] = {}    # account_id → 定期評価の実行時刻
+_triggers_cache: tuple[float, dict[str, list[dict]]] | None = None
+_wake: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+_stats = {
+    "passes": 0, "accounts_evaluated": 0, "tx_events": 0, "session_events": 0,
+    "queued": 0, "errors": 0, "post_session_restored": 0, "late_tx_events": 0, "last_pass_at": None,
+}
+
+
+# ----------------------------------------------------------
+# Event sources
+# ----------------------------------------------------------
+async def _load_triggers(sb) -> dict[str, list[dict]]:
+    """有効トリガーを account_id ごとに priority 順で（TRIGGER_CACHE_SECONDS キャッシュ）"""
+    global _triggers_cache
+    if _triggers_cache and time.monotonic() - _triggers_cache[0] < TRIGGER_CACHE_SECONDS:
+        return _triggers_cache[1]
+    result = (await sb.table("dm_triggers")
+              .select("*")
+              .eq("enabled", True)
+              .order("priority")
+              .execute())
+    by_account: dict[str, list[dict]] = defaultdict(list)
+    for trigger in (result.data or []):
+        by_account[trigger["account_id"]].append(trigger)
+    _triggers_cache = (time.monotonic(), dict(by_account))
+    return _triggers_cache[1]
+
+
+def _ts(value: str) -> float:
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+async def _poll_transactions(sb, account_ids: list[str]) -> list[dict]:
+    """
+    id の透かしより後ろの課金に加え、透かし以下でも前回のポーリングの TX_OVERLAP_SECONDS 前以降に
+    書かれた行を読み直す（id は採番順でコミット順ではないため、小さい id が後からコミットされる）。
+    読み直した行のうち処理済みのものは _seen_tx で除く。
+    """
+    global _tx_watermark, _tx_polled_at
+    started = time.time()
+
+    def base():
+        return (sb.table("coin_transactions")
+                .select("id, account_id, cast_name, user_name, tokens, created_at")
+                .in_("account_id", account_ids))
+
+    if _tx_watermark is None:
+        since = datetime.now(timezone.utc) - timedelta(minutes=STARTUP_LOOKBACK_MINUTES)
+        rows = (await base().gte("created_at", since.isoformat()).order("id").limit(TX_BATCH).execute()).data or []
+        late: list[dict] = []
+    else:
+        since = datetime.fromtimestamp(_tx_polled_at - TX_OVERLAP_SECONDS, timezone.utc)
+        fresh, overlap = await asyncio.gather(
+            base().gt("id", _tx_watermark).order("id").limit(TX_BATCH).execute(),
+            # 遅れてコミットされる行は透かしの近くにあるので上から読む
+            base().lte("id", _tx_watermark).gte("created_at", since.isoformat())
+            .order("id", desc=True).limit(TX_BATCH).execute(),
+        )
+        rows = fresh.data or []
+        late = [r for r in (overlap.data or []) if r["id"] not in _seen_tx]
+        _stats["late_tx_events"] += len(late)
+
+    if rows:
+        _tx_watermark = rows[-1]["id"]
+    elif _tx_watermark is None:
+        _tx_watermark = await _max_tx_id(sb)
+    _tx_polled_at = started
+
+    # 次回の読み直し範囲より前に書かれたものは二度と返らないので忘れる
+    for row in late + rows:
+        _seen_tx[row["id"]] = _ts(row["created_at"]) if row.get("created_at") else started
+    horizon = started - TX_OVERLAP_SECONDS
+    for tx_id in [i for i, t in _seen_tx.items() if t < horizon]:
+        del _seen_tx[tx_id]
+    return late + rows
+
+
+async def _max_tx_id(sb) -> int:
+    result = await sb.table("coin_transactions").select("id").order("id", desc=True).limit(1).execute()
+    return result.data[0]["id"] if result.data else 0
+
+
+async def _poll_sessions(sb, account_ids: list[str]) -> list[dict]:
+    global _session_watermark
+    rows = (await sb.table("sessions")
+            .select("session_id, account_id, cast_name, title, started_at, ended_at")
+            .in_("account_id", account_ids)
+            .gte("ended_at", _session_watermark)
+            .order("ended_at")
+            .limit(SESSION_BATCH)
+            .execute()).data or []
+    fresh = [r for r in rows if r["session_id"] not in _seen_sessions]
+    if rows:
+        _session_watermark = rows[-1]["ended_at"]
+        # 透かしより前に終わったものは二度と返らないので忘れる
+        for session_id, ended_at in list(_seen_sessions.items()):
+            if ended_at < _session_watermark:
+                del _seen_sessions[session_id]
+        _seen_sessions.update({r["session_id"]: r["ended_at"] for r in fresh})
+    return fresh
+
+
+def _post_session_delay(trigger: dict) -> int:
+    delay = (trigger.get("condition_config") or {}).get("delay_minutes")
+    return 30 if delay is None else delay
+
+
+def _enqueue_post_session(triggers_by_account: dict[str, list[dict]], session: dict, not_before: datetime | None = None):
+    """終了セッションに対する post_session の評価を delay_minutes 後に予約する"""
+    ended_at = datetime.fromisoformat(session["ended_at"].replace("Z", "+00:00"))
+    for trigger in triggers_by_account.get(session["account_id"], []):
+        if trigger["trigger_type"] != "post_session":
+            continue
+        due = ended_at + timedelta(minutes=_post_session_delay(trigger))
+        if not_before is not None and due < not_before:
+            continue
+        _post_session_queue.append({
+            "due": due,
+            "account_id": session["account_id"],
+            "trigger_id": trigger["id"],
+            "session": session,
+        })
+
+
+async def _restore_post_session_queue(sb, triggers_by_account: dict[str, list[dict]]):
+    """
+    起動時: 待ち行列はメモリ上にしか無いため、再起動前に終わったセッションの配信後DMを
+    sessions.ended_at と各トリガーの delay_minutes から組み直し、セッションの透かしを置く。
+    期限が起動時の見返し幅より前のものは対象外（課金イベントと同じ扱い）。
+    """
+    global _session_watermark
+    start = datetime.now(timezone.utc) - timedelta(minutes=STARTUP_LOOKBACK_MINUTES)
+    delays = [_post_session_delay(t)
+              for triggers in triggers_by_account.values()
+              for t in triggers if t["trigger_type"] == "post_session"]
+    if delays:
+        # 透かし以降に終わったものは _poll_sessions が拾う
+        rows = (await sb.table("sessions")
+                .select("session_id, account_id, cast_name, title, started_at, ended_at")
+                .in_("account_id", list(triggers_by_account))
+                .gte("ended_at", (start - timedelta(minutes=max(delays))).isoformat())
+                .lt("ended_at", start.isoformat())
+                .order("ended_at", desc=True)
+                .limit(TX_BATCH)
+                .execute()).data or []
+        for session in rows:
+            _enqueue_post_session(triggers_by_account, session, not_before=start)
+        _stats["post_session_restored"] = len(_post_session_queue)
+    _session_watermark = start.isoformat()
+
+
+# ----------------------------------------------------------
+# Pass
+# ----------------------------------------------------------
+def _collect_events(triggers_by_account: dict[str, list[dict]], tx_rows: list[dict], sessions: list[dict]) -> dict:
+    now = datetime.now(timezone.utc)
+    events: dict[str, dict] = {}
+
+    def account_events(account_id: str) -> dict:
+        if account_id not in events:
+            events[account_id] = new_adm_events()
+        return events[account_id]
+
+    for row in tx_rows:
+        ev = account_events(row["account_id"])
+        ev["tx_users"].add(row["user_name"])
+        if row.get("cast_name"):
+            ev["tx_tokens"][(row["cast_name"], row["user_name"])] += row["tokens"] or 0
+
+    for session in sessions:
+        account_id = session["account_id"]
+        account_events(account_id)["ended_sessions"].append(session)
+        _enqueue_post_session(triggers_by_account, session)
+
+    due = [item for item in _post_session_queue if item["due"] <= now]
+    _post_session_queue[:] = [item for item in _post_session_queue if item["due"] > now]
+    for item in due:
+        account_events(item["account_id"])["post_sessions"].append((item["trigger_id"], item["session"]))
+
+    mono = time.monotonic()
+    for account_id, triggers in triggers_by_account.items():
+        if not any(t["trigger_type"] in SCHEDULED_TRIGGER_TYPES for t in triggers):
+            continue
+        # 起動直後は1周期待つ（再起動のたびに全件評価しない）
+        last = _last_scheduled.setdefault(account_id, mono)
+        if mono - last >= SCHEDULED_INTERVAL_SECONDS:
+            _last_scheduled[account_id] = mono
+            account_events(account_id)["scheduled"] = True
+
+    return {a: ev for a, ev in events.items() if a in triggers_by_account}
+
+
+async def _run_pass() -> bool:
+    """1パス分を評価する。イベントの取りこぼしがあり得る（バッチ上限に達した）とき True"""
+    sb = get_supabase_async()
+    triggers_by_account = await _load_triggers(sb)
+    if not triggers_by_account:
+        return False
+    if _session_watermark is None:
+        await _restore_post_session_queue(sb, triggers_by_account)
+    account_ids = list(triggers_by_account)
+    tx_rows, sessions = await asyncio.gather(
+        _poll_transactions(sb, account_ids),
+        _poll_sessions(sb, account_ids),
+    )
+    _stats["tx_events"] += len(tx_rows)
+    _stats["session_events"] += len(sessions)
+
+    events = _collect_events(triggers_by_account, tx_rows, sessions)
+    semaphore = asyncio.Semaphore(MAX_PARALLEL_ACCOUNTS)
+
+    async def evaluate(account_id: str, account_events: dict):
+        async with semaphore:
+            try:
+                details = await evaluate_account(sb, account_id, triggers_by_account[account_id], account_events)
+                _stats["queued"] += sum(d["queued"] for d in details)
+            except Exception as e:
+                _stats["errors"] += 1
+                logger.error(f"[ADM-DAEMON] 評価失敗 ({account_id[:8]}): {e}")
+        _stats["accounts_evaluated"] += 1
+
+    await asyncio.gather(*(evaluate(a, ev) for a, ev in events.items()))
+    _stats["passes"] += 1
+    _stats["last_pass_at"] = datetime.now(timezone.utc).isoformat()
+    return len(tx_rows) >= TX_BATCH or len(sessions) >= SESSION_BATCH
+
+
+async def _daemon_loop(wake: asyncio.Event):
+    while True:
+        backlog = False
+        try:
+            backlog = await _run_pass()
+        except Exception as e:
+            _stats["errors"] += 1
+            logger.warning(f"[ADM-DAEMON] パス失敗: {e}")
+        if backlog:
+            continue
+        try:
+            await asyncio.wait_for(wake.wait(), POLL_SECONDS)
+        except asyncio.TimeoutError:
+            pass
+        wake.clear()
+
+
+# ----------------------------------------------------------
+# Public API
+# ----------------------------------------------------------
+def start_adm_daemon():
+    """バックグラウンドタスクを起動（lifespan から呼ぶ）"""
+    global _wake, _task
+    if _task is not None:
+        return
+    _wake = asyncio.Event()
+    _task = asyncio.create_task(_daemon_loop(_wake))
+
+
+async def stop_adm_daemon():
+    global _wake, _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = _wake = None
+
+
+def notify_adm_event():
+    """課金の取り込み・セッション終了を書き込んだ直後に呼ぶ（次のポーリングを待たずに評価）"""
+    if _wake is not None:
+        _wake.set()
+
+
+def invalidate_adm_triggers():
+    """dm_triggers を変更したときに呼ぶ"""
+    global _triggers_cache
+    _triggers_cache = None
+
+
+def get_adm_daemon_stats() -> dict:
+    return {
+        **_stats,
+        "running": _task is not None,
+        "tx_watermark": _tx_watermark,
+        "session_watermark": _session_watermark,
+        "post_session_pending": len(_post_session_queue),
+    }
@@ -1,23 +1,52 @@
 """
-ADM (Auto DM) Engine — 新規ユーザー検出 → トリガー発火 → DM自動送信
+ADM (Auto DM) Engine — イベント/定期評価 → トリガー発火 → DM自動送信
 
-paid_usersに新規追加されたユーザーを検出し、
-dm_triggersのルールに基づいて自動DMをキュー登録する。
+dm_triggers の全 trigger_type を評価して対象ユーザーを求め、
+ルール（クールダウン・日次上限・重複）に基づいて自動DMをキュー登録する。
+
+- first_visit / segment_upgrade : 課金（coin_transactions → user_segment_members）
+- vip_no_tip / post_session     : 配信セッション終了（post_session は delay_minutes 後）
+- churn_risk / competitor_outflow / cross_promotion : 定期評価
+
+常駐評価は services/adm_daemon、手動実行は run_adm_cycle。
 """
 
+import asyncio
 import logging
 import os
+from collections import defaultdict
 from datetime import datetime, timedelta, timezone
 
 import httpx
+from postgrest.types import ReturnMethod
 
 from services.dm_guard import is_dm_test_mode, DM_TEST_WHITELIST
+from services.dm_notify import notify_dm_queued
+from services.dm_pacing import PRIORITY_AUTO, schedule_dm_rows
+from services.dm_trigger_ledger import (
+    daily_fire_count,
+    dm_sent_recently,
+    in_cooldown,
+    record_dm_sent,
+    record_trigger_fires,
+    sync_dm_sent,
+    sync_trigger_ledger,
+    trigger_lock,
+)
 
 logger = logging.getLogger(__name__)
 
 TELEGRAM_BOT_TOKEN = os.environ.get("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_CHAT_ID = os.environ.get("TELEGRAM_CHAT_ID", "")
 
+ACCOUNT_CONCURRENCY = 4          # 1アカウント内で同時に走らせる評価の数
+FIRST_VISIT_LOOKBACK_HOURS = 24  # 課金イベントからこの時間内の初課金を first_visit とみなす
+IN_CHUNK = 200                   # .in_() に渡すユーザー名の最大数（URL長対策）
+PAGE_SIZE = 1000                 # PostgREST の1レスポンス上限
+LOG_WRITE_RETRIES = 3            # dm_trigger_logs 書き込みの試行回数
+LOG_WRITE_BACKOFF_SECONDS = 0.5
+SCHEDULED_TRIGGER_TYPES = frozenset({"churn_risk", "competitor_outflow", "cross_promotion"})
+
 
 # ---------------------------------------------------------------------------
 # Telegram通知
@@ -58,101 +87,86 @@ def render_template(template: str, variables: dict) -> str:
 # ---------------------------------------------------------------------------
 # 新規ユーザー検出
 # ---------------------------------------------------------------------------
-def detect_new_users(sb, account_id: str, cast_name: str | None, lookback_hours: int = 24) -> list[dict]:
+async def detect_new_users(
+    sb,
+    account_id: str,
+    cast_name: str | None,
+    lookback_hours: int = 24,
+    user_names: list[str] | None = None,
+) -> list[dict]:
     """
-    paid_usersからlookback_hours以内に作成されたユーザーを検出。
+    lookback_hours以内に初課金したユーザーを検出（キャスト単位の初課金インデックスを範囲検索）。
+
+    cast_name 未指定時は全キャスト横断で、複数キャストで初課金したユーザーは最も早い1件にまとめる。
+    user_names を渡すとそのユーザーだけを調べる（daemon が課金イベントのあったユーザーに絞る）。
 
     Returns:
         [{"user_name": str, "cast_name": str, "total_coins": int, "segment": str, ...}]
     """
     cutoff = (datetime.now(timezone.utc) - timedelta(hours=lookback_hours)).isoformat()
 
-    query = (
-        sb.table("paid_users")
-        .select("user_name, cast_name, total_coins, segment, created_at")
-        .eq("account_id", account_id)
-        .gte("created_at", cutoff)
-    )
-
-    if cast_name:
-        query = query.eq("cast_name", cast_name)
-
-    result = query.order("created_at", desc=True).limit(500).execute()
-    return result.data or []
-
-
-# ---------------------------------------------------------------------------
-# クールダウン＋日次上限チェック
-# ---------------------------------------------------------------------------
-def get_fired_users(sb, trigger_id: str, cooldown_hours: int) -> set[str]:
-    """クールダウン期間内にすでにDM発火済みのユーザー名一覧を取得"""
-    cutoff = (datetime.now(timezone.utc) - timedelta(hours=cooldown_hours)).isoformat()
-
-    result = (
-        sb.table("dm_trigger_logs")
-        .select("user_name")
-        .eq("trigger_id", trigger_id)
-        .in_("action_taken", ["dm_queued", "scenario_enrolled"])
-        .gte("fired_at", cutoff)
-        .limit(10000)
-        .execute()
-    )
-    return {r["user_name"] for r in (result.data or [])}
-
-
-def get_daily_fire_count(sb, trigger_id: str) -> int:
-    """今日のトリガー発火回数を取得"""
-    today_start = datetime.now(timezone.utc).replace(hour=0, minute=0, second=0, microsecond=0).isoformat()
-
-    result = (
-        sb.table("dm_trigger_logs")
-        .select("id", count="exact")
-        .eq("trigger_id", trigger_id)
-        .in_("action_taken", ["dm_queued", "scenario_enrolled"])
-        .gte("fired_at", today_start)
-        .execute()
-    )
-    return result.count or 0
-
-
-def get_already_dm_sent_users(sb, account_id: str, cast_name: str | None, user_names: list[str]) -> set[str]:
-    """dm_send_logに既にDM送信済み（24h以内、error以外）のユーザーを取得"""
-    if not user_names:
-        return set()
-
-    cutoff = (datetime.now(timezone.utc) - timedelta(hours=24)).isoformat()
-
-    query = (
-        sb.table("dm_send_log")
-        .select("user_name")
-        .eq("account_id", account_id)
-        .in_("user_name", user_names)
-        .neq("status", "error")
-        .gte("queued_at", cutoff)
-    )
-
-    if cast_name:
-        query = query.eq("cast_name", cast_name)
-
-    result = query.limit(10000).execute()
-    return {r["user_name"] for r in (result.data or [])}
+    def build(names):
+        query = (
+            sb.table("user_segment_members")
+            .select("user_name, cast_name, total_tokens, segment, first_paid")
+            .eq("account_id", account_id)
+            .gt("tx_count", 0)
+            .gte("first_paid", cutoff)
+        )
+        if names is not None:
+            query = query.in_("user_name", names)
+
+        if cast_name:
+            query = query.eq("cast_name", cast_name)
+        else:
+            query = query.neq("cast_name", "")
+
+        # 上限に達したときに落ちるのは古い側になるよう新しい順に読む
+        return (query.order("first_paid", desc=True)
+                .order("cast_name")
+                .order("user_name"))
+
+    rows: list[dict] = []
+    for names in (_chunks(user_names) if user_names is not None else [None]):
+        rows.extend(await _fetch_pages(lambda: build(names)))
+
+    users: dict[str, dict] = {}
+    for row in sorted(rows, key=lambda r: r["first_paid"]):
+        if row["user_name"] in users:
+            continue
+        users[row["user_name"]] = {
+            "user_name": row["user_name"],
+            "cast_name": row["cast_name"],
+            "total_coins": row["total_tokens"],
+            "segment": row["segment"],
+            "created_at": row["first_paid"],
+        }
+    return sorted(users.values(), key=lambda u: u["created_at"], reverse=True)
 
 
 # ---------------------------------------------------------------------------
 # トリガー発火（1トリガー分）
 # ---------------------------------------------------------------------------
-def fire_trigger(
+async def fire_trigger(
     sb,
     trigger: dict,
     new_users: list[dict],
     account_id: str,
 ) -> dict:
     """
-    1つのトリガーに対して、新規ユーザーへのDMを発火する。
+    1つのトリガーに対して、評価器が求めた対象ユーザーへのDMを発火する。
+
+    クールダウン・日次上限・24h重複は services/dm_trigger_ledger の台帳で判定し、
+    同じトリガーの判定〜書き込みは直列化する（daemon と手動実行が重なっても二重発火しない）。
 
     Returns:
         {"queued": int, "skipped_cooldown": int, "skipped_duplicate": int, "skipped_daily_limit": int, "errors": int}
     """
+    async with trigger_lock(trigger["id"]):
+        return await _fire_trigger(sb, trigger, new_users, account_id)
+
+
+async def _fire_trigger(sb, trigger: dict, new_users: list[dict], account_id: str) -> dict:
     trigger_id = trigger["id"]
     trigger_name = trigger["trigger_name"]
     cast_name = trigger.get("cast_name")
@@ -180,17 +194,13 @@ def fire_trigger(
     if not eligible_users:
         return stats
 
-    # クールダウン済みユーザーを除外
-    fired_users = get_fired_users(sb, trigger_id, cooldown_hours)
-
-    # 24h以内DM送信済みユーザーを除外
-    user_names = [u["user_name"] for u in eligible_users]
-    dm_sent_users = get_already_dm_sent_users(sb, account_id, cast_name, user_names)
-
-    # 日次上限チェック
-    daily_count = get_daily_fire_count(sb, trigger_id)
+    # 台帳に他経路・他プロセスの新しいログ行だけを読み足す（初回はログから構築）
+    await asyncio.gather(
+        sync_trigger_ledger(sb, trigger_id, cooldown_hours),
+        sync_dm_sent(sb, account_id),
+    )
+    daily_count = daily_fire_count(trigger_id)
 
-    now = datetime.now(timezone.utc).isoformat()
     campaign = f"adm_{trigger['trigger_type']}_{datetime.now(timezone.utc).strftime('%Y%m%d')}"
 
     # DM安全ゲート: テストモードチェック
@@ -198,31 +208,36 @@ def fire_trigger(
     if test_mode:
         logger.info(f"[ADM] DM_TEST_MODE=ON: ホワイトリスト外はスキップ ({', '.join(sorted(DM_TEST_WHITELIST))})")
 
+    # 1. ユーザーごとの判定はメモリ上で行い、書き込みは最後にまとめる
+    skip_logs: list[dict] = []
+    dm_rows: list[dict] = []
+    targets: list[dict] = []
+
     for user in eligible_users:
         user_name = user["user_name"]
         user_cast = user.get("cast_name") or cast_name or ""
 
         # DM安全ゲート: テストモード時ホワイトリスト外はスキップ
         if test_mode and user_name not in DM_TEST_WHITELIST:
-            _log_trigger_skip(sb, trigger_id, account_id, user_cast, user_name, "skipped_test_mode")
+            skip_logs.append(_trigger_log(trigger_id, account_id, user_cast, user_name, "skipped_test_mode"))
             continue
 
         # 日次上限チェック
-        if daily_count + stats["queued"] >= daily_limit:
+        if daily_count + len(dm_rows) >= daily_limit:
             stats["skipped_daily_limit"] += 1
-            _log_trigger_skip(sb, trigger_id, account_id, user_cast, user_name, "skipped_daily_limit")
+            skip_logs.append(_trigger_log(trigger_id, account_id, user_cast, user_name, "skipped_daily_limit"))
             continue
 
         # クールダウンチェック
-        if user_name in fired_users:
+        if in_cooldown(trigger_id, user_name, cooldown_hours):
             stats["skipped_cooldown"] += 1
-            _log_trigger_skip(sb, trigger_id, account_id, user_cast, user_name, "skipped_cooldown")
+            skip_logs.append(_trigger_log(trigger_id, account_id, user_cast, user_name, "skipped_cooldown"))
             continue
 
         # 24h DM重複チェック
-        if user_name in dm_sent_users:
+        if dm_sent_recently(account_id, user_name, cast_name):
             stats["skipped_duplicate"] += 1
-            _log_trigger_skip(sb, trigger_id, account_id, user_cast, user_name, "skipped_duplicate")
+            skip_logs.append(_trigger_log(trigger_id, account_id, user_cast, user_name, "skipped_duplicate"))
             continue
 
         # メッセージ生成
@@ -230,162 +245,687 @@ def fire_trigger(
             "username": user_name,
             "cast_name": user_cast,
             "total_coins": str(user.get("total_coins", 0)),
+            "total_tokens": str(user.get("total_coins", 0)),
             "segment": user.get("segment", ""),
+            "session_tokens": "0",
+            "previous_segment": "",
+            "days_since_last_visit": "0",
+            **(user.get("variables") or {}),
         }
-        message = render_template(message_template, variables)
+        dm_rows.append({
+            "account_id": account_id,
+            "cast_name": user_cast,
+            "user_name": user_name,
+            "message": render_template(message_template, variables),
+            "status": "queued",
+            "campaign": campaign,
+            "template_name": trigger_name,
+        })
+        targets.append(user)
 
+    # 2. dm_send_log へ一括登録（送信可能時刻はペーシングで割り当て）
+    trigger_logs: list[dict] = []
+    if dm_rows:
         try:
-            # dm_send_log にキュー登録
-            dm_result = (
-                sb.table("dm_send_log")
-                .insert({
-                    "account_id": account_id,
-                    "cast_name": user_cast,
-                    "user_name": user_name,
-                    "message": message,
-                    "status": "queued",
-                    "campaign": campaign,
-                    "template_name": trigger_name,
+            await schedule_dm_rows(sb, account_id, dm_rows, PRIORITY_AUTO)
+            dm_result = await sb.table("dm_send_log").insert(dm_rows).execute()
+            record_dm_sent(account_id, dm_result.data or [])
+            # 発火ログの書き込みを待たずにクールダウン・日次上限へ反映する
+            record_trigger_fires(trigger_id, [
+                {"user_name": r["user_name"], "dm_send_log_id": r["id"], "action_taken": "dm_queued"}
+                for r in (dm_result.data or [])
+            ])
+            dm_ids = {(r["user_name"], r["cast_name"]): r["id"] for r in (dm_result.data or [])}
+            for row, user in zip(dm_rows, targets):
+                trigger_logs.append({
+                    **_trigger_log(trigger_id, account_id, row["cast_name"], row["user_name"], "dm_queued"),
+                    "dm_send_log_id": dm_ids.get((row["user_name"], row["cast_name"])),
+                    "metadata": {
+                        "campaign": campaign,
+                        "total_coins": user.get("total_coins", 0),
+                        "segment": user.get("segment"),
+                        "created_at": user.get("created_at"),
+                    },
                 })
-                .execute()
-            )
-
-            dm_log_id = dm_result.data[0]["id"] if dm_result.data else None
-
-            # dm_trigger_logs に発火ログ記録
-            sb.table("dm_trigger_logs").insert({
-                "trigger_id": trigger_id,
-                "account_id": account_id,
-                "cast_name": user_cast,
-                "user_name": user_name,
-                "action_taken": "dm_queued",
-                "dm_send_log_id": dm_log_id,
-                "metadata": {
-                    "campaign": campaign,
-                    "total_coins": user.get("total_coins", 0),
-                    "segment": user.get("segment"),
-                    "created_at": user.get("created_at"),
-                },
-            }).execute()
-
-            stats["queued"] += 1
-
+            stats["queued"] = len(dm_rows)
         except Exception as e:
-            logger.error(f"トリガー発火エラー ({trigger_name} → {user_name}): {e}")
-            try:
-                sb.table("dm_trigger_logs").insert({
-                    "trigger_id": trigger_id,
-                    "account_id": account_id,
-                    "cast_name": user_cast,
-                    "user_name": user_name,
-                    "action_taken": "error",
+            logger.error(f"トリガー発火エラー ({trigger_name} → {len(dm_rows)}名): {e}")
+            for row in dm_rows:
+                trigger_logs.append({
+                    **_trigger_log(trigger_id, account_id, row["cast_name"], row["user_name"], "error"),
                     "error_message": str(e)[:500],
-                }).execute()
-            except Exception:
-                pass
-            stats["errors"] += 1
+                })
+            stats["errors"] = len(dm_rows)
+
+    # 3. 発火ログ・スキップログを一括記録（失敗してもDM登録は取り消さず、数回再試行する）
+    #    他プロセスの台帳・再起動後のクールダウンはこのログから作られる
+    pending = [batch for batch in (trigger_logs, skip_logs) if batch]
+    for attempt in range(LOG_WRITE_RETRIES):
+        try:
+            while pending:
+                await sb.table("dm_trigger_logs").insert(pending[0], returning=ReturnMethod.minimal).execute()
+                pending.pop(0)
+            break
+        except Exception as e:
+            if attempt + 1 == LOG_WRITE_RETRIES:
+                logger.error(f"[ADM] dm_trigger_logs 一括記録失敗 ({trigger_name}, {sum(map(len, pending))}件): {e}")
+            else:
+                await asyncio.sleep(LOG_WRITE_BACKOFF_SECONDS * 2 ** attempt)
 
     return stats
 
 
-def _log_trigger_skip(sb, trigger_id: str, account_id: str, cast_name: str, user_name: str, reason: str):
-    """スキップログを記録（エラーは無視）"""
-    try:
-        sb.table("dm_trigger_logs").insert({
-            "trigger_id": trigger_id,
-            "account_id": account_id,
-            "cast_name": cast_name or "",
-            "user_name": user_name,
-            "action_taken": reason,
-        }).execute()
-    except Exception:
-        pass
+def _trigger_log(trigger_id: str, account_id: str, cast_name: str, user_name: str, action: str) -> dict:
+    return {
+        "trigger_id": trigger_id,
+        "account_id": account_id,
+        "cast_name": cast_name or "",
+        "user_name": user_name,
+        "action_taken": action,
+    }
 
 
 # ---------------------------------------------------------------------------
-# ADMサイクル実行（メインオーケストレーター）
+# 共有読み込み（1アカウント・1回の評価分）
 # ---------------------------------------------------------------------------
-async def run_adm_cycle(sb, account_id: str, lookback_hours: int = 24) -> dict:
+def _chunks(items, size: int = IN_CHUNK):
+    items = list(items)
+    for i in range(0, len(items), size):
+        yield items[i:i + size]
+
+
+def _parse_ts(value: str | None) -> datetime | None:
+    if not value:
+        return None
+    return datetime.fromisoformat(value.replace("Z", "+00:00"))
+
+
+def _cfg(trigger: dict, key: str, default):
+    # 0 / [] も有効な設定値なので、未設定（None）だけを既定値にする
+    value = (trigger.get("condition_config") or {}).get(key)
+    return default if value is None else value
+
+
+def _session_cast(session: dict) -> str:
+    # 古いセッションは cast_name 未設定で title にキャスト名が入っている
+    return session.get("cast_name") or session.get("title") or ""
+
+
+async def _fetch_pages(build, max_rows: int = 20000) -> list[dict]:
+    """build() が返すクエリを PAGE_SIZE ずつ読み切る（順序は build 側で固定すること）"""
+    rows: list[dict] = []
+    while len(rows) < max_rows:
+        page = (await build().range(len(rows), len(rows) + PAGE_SIZE - 1).execute()).data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            break
+    return rows
+
+
+def new_adm_events(lookback_hours: int = FIRST_VISIT_LOOKBACK_HOURS) -> dict:
+    """evaluate_account に渡すイベント（daemon・手動実行の両方で組み立てる）"""
+    return {
+        "tx_users": set(),                 # 課金があったユーザー（None = 初課金インデックス全体を走査）
+        "tx_tokens": defaultdict(int),     # (cast_name, user_name) → 今回の課金tk
+        "ended_sessions": [],              # 終了したセッション
+        "post_sessions": [],               # (trigger_id, session) delay_minutes に達した配信後DM
+        "scheduled": False,                # 定期評価タイプを評価するか
+        "lookback_hours": lookback_hours,
+    }
+
+
+class AccountLoads:
     """
-    ADM（自動DM）サイクルを1回実行する。
+    評価器が使うデータの読み込みをトリガー間で共有する。
 
-    1. first_visit タイプの有効トリガーを取得
-    2. 新規ユーザーを検出
-    3. 各トリガーに対してDMを発火
-    4. Telegram通知
+    同じキーの読み込みは最初の1回だけ実行し、並列に評価している他のトリガーは
+    その結果（Task）を待つ。閾値がトリガーごとに違うものは全トリガーの最小値で
+    1回読み、各評価器がメモリ上で絞り込む。
+    """
 
-    Returns:
-        {"triggers_evaluated": int, "total_queued": int, "total_skipped": int, "details": [...]}
+    def __init__(self, sb, account_id: str, triggers: list[dict], events: dict):
+        self.sb = sb
+        self.account_id = account_id
+        self.triggers = triggers
+        self.events = events
+        self._tasks: dict[tuple, asyncio.Task] = {}
+
+    def _once(self, key: tuple, factory) -> asyncio.Task:
+        task = self._tasks.get(key)
+        if task is None:
+            task = self._tasks[key] = asyncio.ensure_future(factory())
+        return task
+
+    def _floor(self, trigger_type: str, key: str, default):
+        values = [_cfg(t, key, default) for t in self.triggers if t["trigger_type"] == trigger_type]
+        return min(values) if values else default
+
+    # --- 課金イベント ---
+    def new_payers(self):
+        async def load():
+            names = self.events["tx_users"]
+            if names is not None and not names:
+                return []
+            return await detect_new_users(
+                self.sb, self.account_id, None,
+                lookback_hours=self.events["lookback_hours"],
+                user_names=sorted(names) if names is not None else None,
+            )
+        return self._once(("new_payers",), load)
+
+    def tx_members(self):
+        """課金イベントのあった (cast, user) の user_segment_members 行"""
+        async def load():
+            keys = self.events["tx_tokens"]
+            casts = sorted({cast for cast, _ in keys})
+            rows: list[dict] = []
+            for names in _chunks(sorted({user for _, user in keys})):
+                page = await _fetch_pages(lambda: (
+                    self.sb.table("user_segment_members")
+                    .select("user_name, cast_name, total_tokens, last_paid, last_chat_at")
+                    .eq("account_id", self.account_id)
+                    .in_("cast_name", casts)
+                    .in_("user_name", names)
+                    .order("user_name")
+                    .order("cast_name")
+                ))
+                rows.extend(r for r in page if (r["cast_name"], r["user_name"]) in keys)
+            return rows
+        return self._once(("tx_members",), load)
+
+    # --- セッション終了 ---
+    def session_tips(self, session: dict):
+        """セッション中のチップ {user_name: tokens}（vip_no_tip / post_session で共有）"""
+        async def load():
+            rows = await _fetch_pages(lambda: (
+                self.sb.table("spy_messages")
+                .select("user_name, tokens")
+                .eq("account_id", self.account_id)
+                .eq("cast_name", _session_cast(session))
+                .gte("message_time", session["started_at"])
+                .lte("message_time", session["ended_at"])
+                .gt("tokens", 0)
+                .order("id")
+            ))
+            tips: dict[str, int] = defaultdict(int)
+            for r in rows:
+                if r.get("user_name"):
+                    tips[r["user_name"]] += r["tokens"] or 0
+            return dict(tips)
+        return self._once(("session_tips", session["session_id"]), load)
+
+    def session_viewers(self, session: dict):
+        """セッションの視聴者（spy_viewers が無ければ期間内のチャット参加者で代用）"""
+        async def load():
+            rows = await _fetch_pages(lambda: (
+                self.sb.table("spy_viewers")
+                .select("user_name")
+                .eq("account_id", self.account_id)
+                .eq("cast_name", _session_cast(session))
+                .eq("session_id", session["session_id"])
+                .order("id")
+            ))
+            if not rows:
+                rows = await _fetch_pages(lambda: (
+                    self.sb.table("spy_messages")
+                    .select("user_name")
+                    .eq("account_id", self.account_id)
+                    .eq("cast_name", _session_cast(session))
+                    .gte("message_time", session["started_at"])
+                    .lte("message_time", session["ended_at"])
+                    .not_.is_("user_name", "null")
+                    .order("id")
+                ))
+            return {r["user_name"] for r in rows if r.get("user_name")}
+        return self._once(("session_viewers", session["session_id"]), load)
+
+    def session_members(self, session: dict, user_names: set[str]):
+        """セッション参加者のキャスト別累計 {user_name: member行}"""
+        async def load():
+            members: dict[str, dict] = {}
+            for names in _chunks(sorted(user_names)):
+                result = await (
+                    self.sb.table("user_segment_members")
+                    .select("user_name, total_tokens, segment")
+                    .eq("account_id", self.account_id)
+                    .eq("cast_name", _session_cast(session))
+                    .in_("user_name", names)
+                    .execute()
+                )
+                members.update({r["user_name"]: r for r in (result.data or [])})
+            return members
+        return self._once(("session_members", session["session_id"], frozenset(user_names)), load)
+
+    # --- 定期評価 ---
+    def dormant_members(self):
+        """churn_risk 候補（全 churn_risk トリガーの最も緩い条件で1回読む）"""
+        async def load():
+            absence_days = self._floor("churn_risk", "absence_days", 14)
+            cutoff = (datetime.now(timezone.utc) - timedelta(days=absence_days)).isoformat()
+            result = await (
+                self.sb.table("user_segment_members")
+                .select("user_name, cast_name, total_tokens, segment, last_paid, last_chat_at")
+                .eq("account_id", self.account_id)
+                .neq("cast_name", "")
+                .gt("tx_count", 0)
+                .gte("total_tokens", self._floor("churn_risk", "min_total_tokens", 300))
+                .lt("last_paid", cutoff)
+                .or_(f"last_chat_at.is.null,last_chat_at.lt.{cutoff}")
+                .order("total_tokens", desc=True)
+                .limit(PAGE_SIZE)
+                .execute()
+            )
+            return result.data or []
+        return self._once(("dormant_members",), load)
+
+    def competitor_spenders(self):
+        """他社キャストでの高額ユーザー（spy_user_profiles, is_registered_cast=false）"""
+        async def load():
+            result = await (
+                self.sb.table("spy_user_profiles")
+                .select("user_name, total_tokens")
+                .eq("account_id", self.account_id)
+                .eq("is_registered_cast", False)
+                .gte("total_tokens", self._floor("competitor_outflow", "min_spy_tokens", 500))
+                .order("total_tokens", desc=True)
+                .limit(200)
+                .execute()
+            )
+            return result.data or []
+        return self._once(("competitor_spenders",), load)
+
+    def own_profiles(self, user_names: list[str]):
+        """自社キャストでの来訪記録 {user_name: [profile行]}"""
+        async def load():
+            profiles: dict[str, list[dict]] = defaultdict(list)
+            for names in _chunks(user_names):
+                result = await (
+                    self.sb.table("spy_user_profiles")
+                    .select("user_name, cast_name, total_tokens, last_seen")
+                    .eq("account_id", self.account_id)
+                    .eq("is_registered_cast", True)
+                    .in_("user_name", names)
+                    .execute()
+                )
+                for r in (result.data or []):
+                    profiles[r["user_name"]].append(r)
+            return dict(profiles)
+        return self._once(("own_profiles", tuple(user_names)), load)
+
+    def active_casts(self):
+        async def load():
+            result = await (
+                self.sb.table("registered_casts")
+                .select("cast_name")
+                .eq("account_id", self.account_id)
+                .eq("is_active", True)
+                .order("cast_name")
+                .execute()
+            )
+            return [r["cast_name"] for r in (result.data or [])]
+        return self._once(("active_casts",), load)
+
+    def cast_regulars(self, cast_names: list[str]):
+        """自社キャストの常連（message_count が最も緩い min_visits_other_cast 以上）"""
+        async def load():
+            return await _fetch_pages(lambda: (
+                self.sb.table("spy_user_profiles")
+                .select("user_name, cast_name, message_count")
+                .eq("account_id", self.account_id)
+                .eq("is_registered_cast", True)
+                .in_("cast_name", cast_names)
+                .gte("message_count", self._floor("cross_promotion", "min_visits_other_cast", 3))
+                .order("id")
+            ))
+        return self._once(("cast_regulars", tuple(cast_names)), load)
+
+
+# ---------------------------------------------------------------------------
+# 評価器（trigger_type ごと） — 対象ユーザーの dict を返し、判定・登録は fire_trigger
+# ---------------------------------------------------------------------------
+def _s_segment(total: int, last_seen: datetime | None, now: datetime) -> str:
+    """get_user_segments と同じ S1〜S10 分類（デフォルト閾値）"""
+    age = now - last_seen if last_seen else timedelta.max
+    if total >= 5000:
+        return "S1" if age <= timedelta(days=7) else "S2" if age <= timedelta(days=90) else "S3"
+    if total >= 1000:
+        return "S4" if age <= timedelta(days=7) else "S5" if age <= timedelta(days=90) else "S6"
+    if total >= 300:
+        return "S7" if age <= timedelta(days=30) else "S8"
+    return "S9" if total >= 50 else "S10"
+
+
+def _matches_cast(trigger: dict, cast_name: str) -> bool:
+    return not trigger.get("cast_name") or trigger["cast_name"] == cast_name
+
+
+async def _eval_first_visit(loads: AccountLoads, trigger: dict) -> list[dict]:
+    """初課金ユーザー（キャスト絞り込みは fire_trigger 側）"""
+    return await loads.new_payers()
+
+
+async def _eval_segment_upgrade(loads: AccountLoads, trigger: dict) -> list[dict]:
     """
-    # 1. 有効な first_visit トリガーを取得
-    triggers_result = (
-        sb.table("dm_triggers")
-        .select("*")
-        .eq("account_id", account_id)
-        .eq("trigger_type", "first_visit")
-        .eq("enabled", True)
-        .order("priority")
-        .execute()
-    )
-    triggers = triggers_result.data or []
+    今回の課金でセグメントが track_upgrades の遷移をしたユーザー。
 
-    if not triggers:
-        logger.info(f"[ADM] 有効なfirst_visitトリガーなし (account_id={account_id[:8]})")
-        return {
-            "triggers_evaluated": 0,
-            "total_queued": 0,
-            "total_skipped": 0,
-            "details": [],
-            "message": "有効なfirst_visitトリガーが見つかりません",
+    直前のセグメントは今回の課金分を差し引いた累計で求める（最終来訪は同じとみなす）ため、
+    金額による昇格（S9->S7, S4->S1 等）を検出する。
+    """
+    tracked = set(_cfg(trigger, "track_upgrades", []))
+    if not tracked or not loads.events["tx_tokens"]:
+        return []
+    now = datetime.now(timezone.utc)
+    users = []
+    for row in await loads.tx_members():
+        if not _matches_cast(trigger, row["cast_name"]):
+            continue
+        total = row["total_tokens"] or 0
+        last_seen = max(filter(None, [_parse_ts(row.get("last_paid")), _parse_ts(row.get("last_chat_at"))]), default=None)
+        tipped = loads.events["tx_tokens"][(row["cast_name"], row["user_name"])]
+        previous = _s_segment(total - tipped, last_seen, now)
+        current = _s_segment(total, last_seen, now)
+        if f"{previous}->{current}" in tracked:
+            users.append({
+                "user_name": row["user_name"],
+                "cast_name": row["cast_name"],
+                "total_coins": total,
+                "segment": current,
+                "variables": {"previous_segment": previous},
+            })
+    return users
+
+
+async def _eval_vip_no_tip(loads: AccountLoads, trigger: dict) -> list[dict]:
+    """終了したセッションに来ていたがチップしなかった高額ユーザー"""
+    min_total = _cfg(trigger, "min_total_tokens", 1000)
+    users: dict[tuple, dict] = {}
+    for session in loads.events["ended_sessions"]:
+        cast_name = _session_cast(session)
+        if not cast_name or not _matches_cast(trigger, cast_name):
+            continue
+        viewers, tips = await asyncio.gather(loads.session_viewers(session), loads.session_tips(session))
+        no_tip = viewers - tips.keys()
+        if not no_tip:
+            continue
+        members = await loads.session_members(session, no_tip)
+        for name, m in members.items():
+            if (m["total_tokens"] or 0) >= min_total:
+                users[(cast_name, name)] = {
+                    "user_name": name,
+                    "cast_name": cast_name,
+                    "total_coins": m["total_tokens"],
+                    "segment": m["segment"],
+                }
+    return list(users.values())
+
+
+async def _eval_post_session(loads: AccountLoads, trigger: dict) -> list[dict]:
+    """delay_minutes に達したセッションで min_session_tokens 以上チップしたユーザー"""
+    min_session = _cfg(trigger, "min_session_tokens", 50)
+    users: dict[tuple, dict] = {}
+    for trigger_id, session in loads.events["post_sessions"]:
+        cast_name = _session_cast(session)
+        if trigger_id != trigger["id"] or not cast_name or not _matches_cast(trigger, cast_name):
+            continue
+        tips = await loads.session_tips(session)
+        tippers = {name: tokens for name, tokens in tips.items() if tokens >= min_session}
+        if not tippers:
+            continue
+        members = await loads.session_members(session, set(tippers))
+        for name, tokens in tippers.items():
+            m = members.get(name) or {}
+            users[(cast_name, name)] = {
+                "user_name": name,
+                "cast_name": cast_name,
+                "total_coins": m.get("total_tokens", tokens),
+                "segment": m.get("segment", ""),
+                "variables": {"session_tokens": tokens},
+            }
+    return list(users.values())
+
+
+async def _eval_churn_risk(loads: AccountLoads, trigger: dict) -> list[dict]:
+    """absence_days 以上来ていない累計 min_total_tokens 以上のユーザー（最大50名）"""
+    if not loads.events["scheduled"]:
+        return []
+    now = datetime.now(timezone.utc)
+    absence_days = _cfg(trigger, "absence_days", 14)
+    min_total = _cfg(trigger, "min_total_tokens", 300)
+    users: dict[str, dict] = {}
+    for row in await loads.dormant_members():
+        if not _matches_cast(trigger, row["cast_name"]) or (row["total_tokens"] or 0) < min_total:
+            continue
+        last_seen = max(filter(None, [_parse_ts(row.get("last_paid")), _parse_ts(row.get("last_chat_at"))]))
+        days_since = (now - last_seen).days
+        if days_since < absence_days or row["user_name"] in users:
+            continue
+        users[row["user_name"]] = {
+            "user_name": row["user_name"],
+            "cast_name": row["cast_name"],
+            "total_coins": row["total_tokens"],
+            "segment": row["segment"],
+            "variables": {"days_since_last_visit": days_since},
         }
+    return list(users.values())[:50]
+
+
+async def _eval_competitor_outflow(loads: AccountLoads, trigger: dict) -> list[dict]:
+    """他社キャストで min_spy_tokens 以上使い、自社には days_since_own_visit 以上来ていないユーザー（最大30名）"""
+    if not loads.events["scheduled"]:
+        return []
+    now = datetime.now(timezone.utc)
+    min_spy = _cfg(trigger, "min_spy_tokens", 500)
+    days_since_own = _cfg(trigger, "days_since_own_visit", 7)
+    spenders = await loads.competitor_spenders()
+    own = await loads.own_profiles([u["user_name"] for u in spenders])
+
+    users = []
+    for spender in spenders:
+        if (spender["total_tokens"] or 0) < min_spy:
+            continue
+        visits = [p for p in own.get(spender["user_name"], []) if _matches_cast(trigger, p["cast_name"])]
+        if not visits:
+            # 自社未訪問: 誘導先キャストが決まっているトリガーのみ
+            if trigger.get("cast_name"):
+                users.append({
+                    "user_name": spender["user_name"],
+                    "cast_name": trigger["cast_name"],
+                    "total_coins": spender["total_tokens"],
+                })
+            continue
+        best = max(visits, key=lambda p: p["total_tokens"] or 0)
+        last_seen = _parse_ts(best.get("last_seen"))
+        if last_seen and now - last_seen >= timedelta(days=days_since_own):
+            users.append({
+                "user_name": spender["user_name"],
+                "cast_name": best["cast_name"],
+                "total_coins": best["total_tokens"],
+                "variables": {"days_since_last_visit": (now - last_seen).days},
+            })
+    return users[:30]
+
+
+async def _eval_cross_promotion(loads: AccountLoads, trigger: dict) -> list[dict]:
+    """自社の別キャストの常連で、対象キャストにはほぼ来ていないユーザー（1人1キャスト・最大20名）"""
+    if not loads.events["scheduled"]:
+        return []
+    cast_names = (await loads.active_casts())[:5]
+    if len(cast_names) < 2:
+        return []
+    min_other = _cfg(trigger, "min_visits_other_cast", 3)
+    max_target = _cfg(trigger, "max_visits_target_cast", 0)
+
+    visits: dict[str, dict[str, int]] = defaultdict(dict)
+    for p in await loads.cast_regulars(cast_names):
+        visits[p["user_name"]][p["cast_name"]] = p["message_count"] or 0
+
+    users = []
+    for user_name, counts in visits.items():
+        for target in cast_names:
+            if not _matches_cast(trigger, target) or counts.get(target, 0) > max_target:
+                continue
+            if any(c != target and n >= min_other for c, n in counts.items()):
+                users.append({"user_name": user_name, "cast_name": target})
+                break
+    return users[:20]
+
+
+TRIGGER_EVALUATORS = {
+    "first_visit": _eval_first_visit,
+    "vip_no_tip": _eval_vip_no_tip,
+    "churn_risk": _eval_churn_risk,
+    "segment_upgrade": _eval_segment_upgrade,
+    "competitor_outflow": _eval_competitor_outflow,
+    "post_session": _eval_post_session,
+    "cross_promotion": _eval_cross_promotion,
+}
+VALID_TRIGGER_TYPES = frozenset(TRIGGER_EVALUATORS)
 
-    # 2. 新規ユーザーを検出（全キャスト横断）
-    new_users = detect_new_users(sb, account_id, cast_name=None, lookback_hours=lookback_hours)
 
-    if not new_users:
-        logger.info(f"[ADM] 新規ユーザーなし (lookback={lookback_hours}h)")
-        return {
-            "triggers_evaluated": len(triggers),
-            "total_queued": 0,
-            "total_skipped": 0,
-            "new_users_detected": 0,
-            "details": [],
-            "message": f"過去{lookback_hours}時間に新規ユーザーは検出されませんでした",
-        }
+# ---------------------------------------------------------------------------
+# アカウント単位の一括評価
+# ---------------------------------------------------------------------------
+async def evaluate_account(sb, account_id: str, triggers: list[dict], events: dict) -> list[dict]:
+    """
+    1アカウントの有効トリガー（priority 順）をまとめて評価・発火する。
 
-    logger.info(f"[ADM] 新規ユーザー {len(new_users)}名検出、トリガー {len(triggers)}件評価開始")
+    評価は ACCOUNT_CONCURRENCY 並列で読み込みを共有し、DM登録は priority 順に直列で行う
+    （先に登録したDMが後のトリガーの24h重複チェックに効くように）。
 
-    # 3. 各トリガーを評価・発火
-    total_queued = 0
-    total_skipped = 0
-    details = []
+    Returns:
+        トリガーごとの {"trigger_name", "trigger_id", "trigger_type", "cast_name", "candidates", **fire_trigger統計}
+    """
+    loads = AccountLoads(sb, account_id, triggers, events)
+    semaphore = asyncio.Semaphore(ACCOUNT_CONCURRENCY)
+
+    async def _evaluate(trigger: dict) -> list[dict]:
+        evaluator = TRIGGER_EVALUATORS.get(trigger["trigger_type"])
+        if evaluator is None:
+            return []
+        async with semaphore:
+            return await evaluator(loads, trigger)
 
-    for trigger in triggers:
-        stats = fire_trigger(sb, trigger, new_users, account_id)
-        total_queued += stats["queued"]
-        total_skipped += stats["skipped_cooldown"] + stats["skipped_duplicate"] + stats["skipped_daily_limit"]
+    results = await asyncio.gather(*(_evaluate(t) for t in triggers), return_exceptions=True)
 
+    details = []
+    for trigger, users in zip(triggers, results):
+        if isinstance(users, Exception):
+            logger.error(f"[ADM] {trigger['trigger_type']} 評価エラー ({trigger['trigger_name']}): {users}")
+            continue
+        if not users:
+            continue
+        stats = await fire_trigger(sb, trigger, users, account_id)
         details.append({
             "trigger_name": trigger["trigger_name"],
             "trigger_id": trigger["id"],
+            "trigger_type": trigger["trigger_type"],
             "cast_name": trigger.get("cast_name"),
+            "candidates": len(users),
             **stats,
         })
 
-    # 4. Telegram通知
+    total_queued = sum(d["queued"] for d in details)
     if total_queued > 0:
+        # 送信タブの long-poll を起こす
+        notify_dm_queued(account_id)
+        total_skipped = sum(d["skipped_cooldown"] + d["skipped_duplicate"] + d["skipped_daily_limit"] for d in details)
         trigger_names = ", ".join(d["trigger_name"] for d in details if d["queued"] > 0)
         await send_telegram(
             f"🤖 <b>ADM自動発火</b>\n"
-            f"新規ユーザー: {len(new_users)}名検出\n"
             f"DM送信キュー: {total_queued}件\n"
             f"スキップ: {total_skipped}件\n"
             f"トリガー: {trigger_names}"
         )
+    return details
+
+
+async def load_window_events(sb, account_id: str, triggers: list[dict], lookback_hours: int) -> dict:
+    """手動実行用: lookback_hours 内の課金・終了セッションからイベントを組み立てる"""
+    now = datetime.now(timezone.utc)
+    cutoff = (now - timedelta(hours=lookback_hours)).isoformat()
+    events = new_adm_events(lookback_hours)
+    events["tx_users"] = None
+    events["scheduled"] = True
+
+    types = {t["trigger_type"] for t in triggers}
+    if "segment_upgrade" in types:
+        rows = await _fetch_pages(lambda: (
+            sb.table("coin_transactions")
+            .select("user_name, cast_name, tokens")
+            .eq("account_id", account_id)
+            .gte("date", cutoff)
+            .order("id")
+        ), max_rows=5000)
+        for r in rows:
+            if r.get("cast_name"):
+                events["tx_tokens"][(r["cast_name"], r["user_name"])] += r["tokens"] or 0
+
+    if types & {"vip_no_tip", "post_session"}:
+        result = await (
+            sb.table("sessions")
+            .select("session_id, cast_name, title, started_at, ended_at")
+            .eq("account_id", account_id)
+            .gte("ended_at", cutoff)
+            .order("ended_at")
+            .limit(200)
+            .execute()
+        )
+        events["ended_sessions"] = result.data or []
+        for trigger in triggers:
+            if trigger["trigger_type"] != "post_session":
+                continue
+            delay = timedelta(minutes=_cfg(trigger, "delay_minutes", 30))
+            for session in events["ended_sessions"]:
+                if _parse_ts(session["ended_at"]) + delay <= now:
+                    events["post_sessions"].append((trigger["id"], session))
+    return events
+
+
+# ---------------------------------------------------------------------------
+# ADMサイクル実行（手動実行）
+# ---------------------------------------------------------------------------
+async def run_adm_cycle(sb, account_id: str, lookback_hours: int = 24) -> dict:
+    """
+    ADM（自動DM）サイクルを1回実行する。常駐評価（services/adm_daemon）を待たずに
+    lookback_hours 分のイベントをまとめて評価したいときに使う。
+
+    1. 全タイプの有効トリガーを取得
+    2. lookback_hours 内の課金・終了セッションからイベントを組み立て（定期評価タイプも含む）
+    3. evaluate_account で一括評価・発火（Telegram通知も含む）
+
+    Returns:
+        {"triggers_evaluated": int, "total_queued": int, "total_skipped": int, "details": [...]}
+    """
+    # 1. 有効なトリガーを取得
+    triggers_result = (
+        await sb.table("dm_triggers")
+        .select("*")
+        .eq("account_id", account_id)
+        .eq("enabled", True)
+        .order("priority")
+        .execute()
+    )
+    triggers = triggers_result.data or []
+
+    if not triggers:
+        logger.info(f"[ADM] 有効なトリガーなし (account_id={account_id[:8]})")
+        return {
+            "triggers_evaluated": 0,
+            "total_queued": 0,
+            "total_skipped": 0,
+            "details": [],
+            "message": "有効なトリガーが見つかりません",
+        }
+
+    # 2-3. イベントを組み立てて一括評価
+    events = await load_window_events(sb, account_id, triggers, lookback_hours)
+    details = await evaluate_account(sb, account_id, triggers, events)
 
+    total_queued = sum(d["queued"] for d in details)
+    total_skipped = sum(d["skipped_cooldown"] + d["skipped_duplicate"] + d["skipped_daily_limit"] for d in details)
     result = {
         "triggers_evaluated": len(triggers),
-        "new_users_detected": len(new_users),
+        "new_users_detected": max((d["candidates"] for d in details if d["trigger_type"] == "first_visit"), default=0),
         "total_queued": total_queued,
         "total_skipped": total_skipped,
         "details": details,
@@ -0,0 +1,104 @@
+"""Analytics RPC result cache - (rpc, params) キー + アカウント単位のバージョン
+
+売上・ファネル系のRPCは最大365日分の coin_transactions を毎回集計するが、
+結果が変わるのは同期が入ったときだけ。ここでは結果をプロセス内に保持し、
+
+- 同期系の書き込み（coin_transactions / paid_users）が bump_account_version() で
+  アカウントのバージョンを上げたら、そのアカウントの既存エントリは次回ミス扱い
+- FRESH_SECONDS 以内はそのまま返す。STALE_SECONDS 以内なら古い値を返しつつ
+  裏で再取得（他プロセス＝collector の書き込みはこの時間経過で拾う）
+- 同じキーの同時リクエストは実行中の1回を共有する
+"""
+import asyncio
+import json
+import logging
+import time
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+FRESH_SECONDS = 120.0
+STALE_SECONDS = 1800.0
+MAX_ENTRIES = 2000
+
+
+class _Entry:
+    __slots__ = ("value", "version", "stored_at")
+
+    def __init__(self, value, version: int, stored_at: float):
+        self.value = value
+        self.version = version
+        self.stored_at = stored_at
+
+
+_versions: dict[str, int] = {}
+_entries: OrderedDict[tuple, _Entry] = OrderedDict()
+_inflight: dict[tuple, asyncio.Task] = {}
+_stats = {"hits": 0, "stale_hits": 0, "misses": 0, "coalesced": 0, "errors": 0}
+
+
+# ----------------------------------------------------------
+# Loading
+# ----------------------------------------------------------
+async def _execute(sb, key: tuple, rpc: str, params: dict, version: int):
+    try:
+        result = await sb.rpc(rpc, params).execute()
+    finally:
+        _inflight.pop(key, None)
+    # 実行中にバージョンが上がっていれば古い version のまま保存され、次回ミスになる
+    _entries[key] = _Entry(result.data, version, time.monotonic())
+    _entries.move_to_end(key)
+    while len(_entries) > MAX_ENTRIES:
+        _entries.popitem(last=False)
+    return result.data
+
+
+def _start_load(sb, key: tuple, rpc: str, params: dict, version: int) -> asyncio.Task:
+    task = _inflight.get(key)
+    if task is not None:
+        _stats["coalesced"] += 1
+        return task
+    task = asyncio.create_task(_execute(sb, key, rpc, params, version))
+    _inflight[key] = task
+    return task
+
+
+def _log_revalidate_error(task: asyncio.Task):
+    if not task.cancelled() and task.exception() is not None:
+        _stats["errors"] += 1
+        logger.warning(f"[ANALYTICS-CACHE] 再取得失敗: {task.exception()}")
+
+
+# ----------------------------------------------------------
+# Public API
+# ----------------------------------------------------------
+async def cached_rpc(sb, rpc: str, params: dict):
+    """sb.rpc(rpc, params).execute().data と同じ値をキャッシュ経由で返す（params に p_account_id 必須）"""
+    account_id = params["p_account_id"]
+    key = (rpc, json.dumps(params, sort_keys=True, default=str))
+    version = _versions.get(account_id, 0)
+
+    entry = _entries.get(key)
+    if entry is not None and entry.version == version:
+        age = time.monotonic() - entry.stored_at
+        if age < FRESH_SECONDS:
+            _stats["hits"] += 1
+            return entry.value
+        if age < STALE_SECONDS:
+            _stats["stale_hits"] += 1
+            if key not in _inflight:
+                _start_load(sb, key, rpc, params, version).add_done_callback(_log_revalidate_error)
+            return entry.value
+
+    _stats["misses"] += 1
+    # 呼び出し元がキャンセルされても共有中の実行は止めない
+    return await asyncio.shield(_start_load(sb, key, rpc, params, version))
+
+
+def bump_account_version(account_id: str):
+    """アカウントの集計元データが変わったときに呼ぶ（既存エントリを無効化）"""
+    _versions[account_id] = _versions.get(account_id, 0) + 1
+
+
+def get_cache_stats() -> dict:
+    return {**_stats, "entries": len(_entries), "inflight": len(_inflight)}
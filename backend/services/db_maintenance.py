@@ -0,0 +1,110 @@
+"""DB maintenance - トリガーで差分更新しているテーブルの定期掃除
+
+pg_cron が使えない環境（063 参照）向けに、バックエンドプロセス内で
+INTERVAL_SECONDS ごとに掃除用RPCを呼ぶ。
+
+- prune_segment_leads: 課金の無いリード行を funnel の最大窓（90日）を過ぎたら削除する
+  （user_segment_members はチャットごとに行が増えるため）。1回あたり BATCH 行までしか
+  処理しないので、戻り値が BATCH 未満になるまで繰り返す
+- reattribute_recent_dm_conversions: DMの success 更新と課金の書き込みが並行して
+  トリガーでは帰属できなかった分を、直近 REATTRIBUTE_HOURS の窓で付け直す
+"""
+import asyncio
+import logging
+from datetime import datetime, timezone
+
+from config import get_supabase_async
+
+logger = logging.getLogger(__name__)
+
+INTERVAL_SECONDS = 3600.0
+STARTUP_DELAY_SECONDS = 60.0   # 起動直後の負荷と重ならないように
+LEAD_KEEP_DAYS = 90            # funnel_leads / funnel_segments の days 上限
+BATCH = 10000
+MAX_BATCHES_PER_RUN = 50
+REATTRIBUTE_HOURS = 2          # 周期（1時間）より長くして窓を重ねる
+
+_task: asyncio.Task | None = None
+_stats = {"runs": 0, "leads_pruned": 0, "conversions_reattributed": 0, "failed": 0, "last_run_at": None}
+
+
+# ----------------------------------------------------------
+# Jobs
+# ----------------------------------------------------------
+async def _prune_segment_leads(sb) -> int:
+    pruned = 0
+    for _ in range(MAX_BATCHES_PER_RUN):
+        result = await sb.rpc("prune_segment_leads", {
+            "p_keep_days": LEAD_KEEP_DAYS,
+            "p_batch": BATCH,
+        }).execute()
+        deleted = result.data or 0
+        pruned += deleted
+        if deleted < BATCH:
+            break
+    _stats["leads_pruned"] += pruned
+    return pruned
+
+
+async def _reattribute_dm_conversions(sb) -> int:
+    result = await sb.rpc("reattribute_recent_dm_conversions", {
+        "p_hours": REATTRIBUTE_HOURS,
+    }).execute()
+    count = result.data or 0
+    _stats["conversions_reattributed"] += count
+    return count
+
+
+_JOBS = (
+    ("prune_segment_leads", _prune_segment_leads),
+    ("reattribute_recent_dm_conversions", _reattribute_dm_conversions),
+)
+
+
+async def _run_once():
+    sb = get_supabase_async()
+    for name, job in _JOBS:
+        try:
+            count = await job(sb)
+            if count:
+                logger.info(f"[DB-MAINT] {name}: {count}件")
+        except Exception as e:
+            # 関数が未適用の環境もあるため、失敗は記録して次の周期に任せる
+            _stats["failed"] += 1
+            logger.warning(f"[DB-MAINT] {name} 失敗: {e}")
+    _stats["runs"] += 1
+    _stats["last_run_at"] = datetime.now(timezone.utc).isoformat()
+
+
+async def _maintenance_loop():
+    await asyncio.sleep(STARTUP_DELAY_SECONDS)
+    while True:
+        await _run_once()
+        await asyncio.sleep(INTERVAL_SECONDS)
+
+
+# ----------------------------------------------------------
+# Public API
+# ----------------------------------------------------------
+def start_db_maintenance():
+    """バックグラウンドタスクを起動（lifespan から呼ぶ）"""
+    global _task
+    if _task is not None:
+        return
+    _task = asyncio.create_task(_maintenance_loop())
+
+
+async def stop_db_maintenance():
+    global _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = None
+
+
+def get_db_maintenance_stats() -> dict:
+    return {**_stats, "running": _task is not None}
@@ -0,0 +1,138 @@
+"""DM enqueue - 一斉送信・お礼DMのキュー登録（重複・ブラックリスト除外、チャンクINSERT、使用量の予約）
+
+create_dm_batch / thank_dm は全行を1回の INSERT で送り、profiles.dm_used_this_month を
+読んで書き戻していた（同時実行で加算が消える）。ここでは
+
+1. 入力内の重複を落とし、check_blacklisted_users / check_dm_duplicate RPC で
+   ブラックリスト該当者と直近 DEDUPE_HOURS 以内の送信済みを除外（CHECK_CHUNK 名ずつ並列）
+2. reserve_dm_quota RPC で残数の範囲内だけ使用量を原子的に予約し、超過分を落とす
+3. ペーシング（not_before / priority）を割り当て、INSERT_CHUNK 行ずつ INSERT
+4. INSERT に失敗した分の使用量は release_dm_quota で戻す
+
+の順で行う。DM_TEST_MODE のホワイトリスト判定は呼び出し元（ルーター）で済ませておく。
+"""
+import asyncio
+import logging
+
+from postgrest.types import ReturnMethod
+
+from services.dm_notify import notify_dm_queued
+from services.dm_pacing import schedule_dm_rows
+
+logger = logging.getLogger(__name__)
+
+CHECK_CHUNK = 1000      # 重複・ブラックリスト RPC 1回あたりのユーザー数
+INSERT_CHUNK = 500      # dm_send_log INSERT 1回あたりの行数
+MAX_PARALLEL = 4        # RPC・INSERT の同時実行数
+DEDUPE_HOURS = 24
+
+
+class DmQuotaExceededError(Exception):
+    """今月の送信上限に達していて1件も予約できなかった"""
+
+
+async def _gather_limited(coros) -> list:
+    semaphore = asyncio.Semaphore(MAX_PARALLEL)
+
+    async def run(coro):
+        async with semaphore:
+            return await coro
+
+    return await asyncio.gather(*(run(c) for c in coros))
+
+
+async def _excluded_users(sb, account_id: str, cast_name: str, user_names: list[str], skip_duplicates: bool) -> tuple[set[str], set[str]]:
+    """(ブラックリスト該当者, 直近送信済み) を返す"""
+    chunks = [user_names[i:i + CHECK_CHUNK] for i in range(0, len(user_names), CHECK_CHUNK)]
+
+    async def check(rpc: str, params: dict, key: str) -> set[str]:
+        result = await sb.rpc(rpc, params).execute()
+        return set((result.data or {}).get(key) or [])
+
+    calls = [
+        check("check_blacklisted_users",
+              {"p_account_id": account_id, "p_cast_name": cast_name, "p_user_names": chunk}, "blocked")
+        for chunk in chunks
+    ]
+    if skip_duplicates:
+        calls += [
+            check("check_dm_duplicate",
+                  {"p_account_id": account_id, "p_cast_name": cast_name, "p_user_names": chunk,
+                   "p_hours": DEDUPE_HOURS}, "duplicates")
+            for chunk in chunks
+        ]
+    results = await _gather_limited(calls)
+    blocked = set().union(*results[:len(chunks)])
+    duplicates = set().union(*results[len(chunks):])
+    return blocked, duplicates
+
+
+async def enqueue_dms(
+    sb,
+    account_id: str,
+    user_id: str,
+    cast_name: str,
+    rows: list[dict],
+    priority: int,
+    skip_duplicates: bool = True,
+) -> dict:
+    """
+    dm_send_log 行（account_id / cast_name / user_name / message 等は設定済み）をキュー登録する。
+
+    Returns:
+        {"queued", "duplicates", "blacklisted", "over_quota", "failed", "scheduled_until"}
+
+    Raises:
+        DmQuotaExceededError: 除外後の対象が残っているのに使用量を1件も予約できなかった
+    """
+    stats = {"queued": 0, "duplicates": 0, "blacklisted": 0, "over_quota": 0, "failed": 0, "scheduled_until": None}
+
+    # 1. 入力内の重複・ブラックリスト・直近送信済みを除外
+    unique: dict[str, dict] = {}
+    for row in rows:
+        unique.setdefault(row["user_name"], row)
+    stats["duplicates"] = len(rows) - len(unique)
+    if not unique:
+        return stats
+
+    blocked, recent = await _excluded_users(sb, account_id, cast_name, list(unique), skip_duplicates)
+    stats["blacklisted"] = len(blocked)
+    stats["duplicates"] += len(recent - blocked)
+    targets = [row for name, row in unique.items() if name not in blocked and name not in recent]
+    if not targets:
+        return stats
+
+    # 2. 使用量を原子的に予約（残数を超えた分は落とす）
+    result = await sb.rpc("reserve_dm_quota", {"p_user_id": user_id, "p_requested": len(targets)}).execute()
+    granted = result.data or 0
+    if granted <= 0:
+        raise DmQuotaExceededError()
+    stats["over_quota"] = len(targets) - granted
+    targets = targets[:granted]
+
+    # 3. ペーシングを割り当ててチャンクごとに INSERT
+    await schedule_dm_rows(sb, account_id, targets, priority)
+    chunks = [targets[i:i + INSERT_CHUNK] for i in range(0, len(targets), INSERT_CHUNK)]
+
+    async def insert(chunk: list[dict]) -> int:
+        try:
+            await sb.table("dm_send_log").insert(chunk, returning=ReturnMethod.minimal).execute()
+            return len(chunk)
+        except Exception as e:
+            logger.error(f"[DM-ENQUEUE] INSERT失敗 ({account_id[:8]}, {len(chunk)}件): {e}")
+            return 0
+
+    stats["queued"] = sum(await _gather_limited(insert(c) for c in chunks))
+    stats["failed"] = len(targets) - stats["queued"]
+
+    # 4. 入らなかった分の使用量を戻す
+    if stats["failed"]:
+        try:
+            await sb.rpc("release_dm_quota", {"p_user_id": user_id, "p_count": stats["failed"]}).execute()
+        except Exception as e:
+            logger.warning(f"[DM-ENQUEUE] 使用量の返却失敗 ({stats['failed']}件): {e}")
+
+    if stats["queued"]:
+        notify_dm_queued(account_id)
+        stats["scheduled_until"] = targets[-1].get("not_before")
+    return stats
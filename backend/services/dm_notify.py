@@ -0,0 +1,62 @@
+"""DM queue wakeups - 送信タブの long-poll をキュー登録時に即時起床させる
+
+送信タブは空のキューを一定間隔でポーリングする代わりに、claim / queue を
+wait_seconds 付きで呼んで待機する。キュー登録経路（create_dm_batch, thank_dm,
+ADM の evaluate_account）が notify_dm_queued() を呼ぶと、そのアカウントの待機中リクエストが
+全て起きて再取得する。待機中はイベントを await しているだけなのでDBアクセスは無い。
+
+同一プロセス外（collector・手動SQL 等）からの登録は通知されないため、
+待機は RECHECK_SECONDS ごとに一度起きてキューを確認し直す。
+"""
+import asyncio
+import time
+
+RECHECK_SECONDS = 15.0
+
+_events: dict[str, asyncio.Event] = {}
+_stats = {"notifies": 0, "wakeups": 0, "timeouts": 0}
+
+
+def dm_queue_event(account_id: str) -> asyncio.Event:
+    """キュー確認の「前」に取得しておく（確認〜待機の間の通知を取りこぼさない）"""
+    event = _events.get(account_id)
+    if event is None:
+        event = _events[account_id] = asyncio.Event()
+    return event
+
+
+def notify_dm_queued(account_id: str):
+    """DMをキュー登録した直後に呼ぶ"""
+    _stats["notifies"] += 1
+    event = _events.pop(account_id, None)
+    if event is not None:
+        event.set()
+
+
+async def wait_dm_queued(event: asyncio.Event, deadline: float) -> bool:
+    """通知が来たら True、deadline（time.monotonic 基準）または再確認時刻に達したら False"""
+    timeout = min(deadline - time.monotonic(), RECHECK_SECONDS)
+    if timeout <= 0:
+        return False
+    try:
+        await asyncio.wait_for(event.wait(), timeout)
+    except asyncio.TimeoutError:
+        _stats["timeouts"] += 1
+        return False
+    _stats["wakeups"] += 1
+    return True
+
+
+async def long_poll(account_id: str, fetch, wait_seconds: float) -> list:
+    """fetch() が空の間、通知か wait_seconds 経過まで待って取り直す"""
+    deadline = time.monotonic() + wait_seconds
+    while True:
+        event = dm_queue_event(account_id)
+        rows = await fetch()
+        if rows or time.monotonic() >= deadline:
+            return rows
+        await wait_dm_queued(event, deadline)
+
+
+def get_notify_stats() -> dict:
+    return {**_stats, "tracked_accounts": len(_events)}
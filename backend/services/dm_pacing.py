@@ -0,0 +1,108 @@
+"""DM pacing - キュー登録時に送信可能時刻 (not_before) と優先度を割り当てる
+
+アカウントの送信レート (accounts.dm_rate_per_minute) から送信間隔を決め、
+同じか高い優先度で既に積まれている行の末尾に続けて等間隔に並べる。
+静音時間帯 (JST, accounts.dm_quiet_hours_start/end) にかかる行は帯の終わりへ送る。
+
+ここでの割り当ては「いつから送ってよいか」の目安で、実際のレート上限は
+claim_dm_queue RPC が直近1分の配布数で強制する（高優先度の割り込みで
+not_before が重なってもバーストしない）。
+"""
+import logging
+import time
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_RATE_PER_MINUTE = 6
+PACING_CACHE_TTL = 60.0
+JST = timezone(timedelta(hours=9))
+
+# キャンペーン種別ごとの優先度（大きいほど先に配る）
+PRIORITY_BATCH = 0        # Web UI 一斉送信
+PRIORITY_AUTO = 5         # ADM トリガー
+PRIORITY_THANK_YOU = 10   # 新規太客へのお礼（鮮度が重要）
+
+_pacing_cache: dict[str, tuple[float, dict]] = {}
+
+
+async def get_pacing(sb, account_id: str) -> dict:
+    """アカウントのペーシング設定（未設定・列が無い環境ではデフォルト）"""
+    cached = _pacing_cache.get(account_id)
+    if cached and time.monotonic() - cached[0] < PACING_CACHE_TTL:
+        return cached[1]
+    pacing = {"rate_per_minute": DEFAULT_RATE_PER_MINUTE, "quiet_start": None, "quiet_end": None}
+    try:
+        result = (await sb.table("accounts")
+                  .select("dm_rate_per_minute, dm_quiet_hours_start, dm_quiet_hours_end")
+                  .eq("id", account_id)
+                  .limit(1)
+                  .execute())
+        if result.data:
+            row = result.data[0]
+            pacing = {
+                "rate_per_minute": max(row.get("dm_rate_per_minute") or DEFAULT_RATE_PER_MINUTE, 1),
+                "quiet_start": row.get("dm_quiet_hours_start"),
+                "quiet_end": row.get("dm_quiet_hours_end"),
+            }
+    except Exception as e:
+        logger.warning(f"[DM-PACING] 設定取得失敗 ({account_id[:8]}): {e}")
+    _pacing_cache[account_id] = (time.monotonic(), pacing)
+    return pacing
+
+
+def _quiet_end(at: datetime, start: int | None, end: int | None) -> datetime | None:
+    """at が静音時間帯なら帯の終了時刻、そうでなければ None"""
+    if start is None or end is None or start == end:
+        return None
+    local = at.astimezone(JST)
+    hour = local.hour
+    in_quiet = start <= hour < end if start < end else (hour >= start or hour < end)
+    if not in_quiet:
+        return None
+    resume = local.replace(hour=end, minute=0, second=0, microsecond=0)
+    if resume <= local:
+        resume += timedelta(days=1)
+    return resume.astimezone(timezone.utc)
+
+
+async def _queue_tail(sb, account_id: str, priority: int) -> datetime | None:
+    """同じか高い優先度で積まれている行の最後の not_before"""
+    result = (await sb.table("dm_send_log")
+              .select("not_before")
+              .eq("account_id", account_id)
+              .eq("status", "queued")
+              .gte("priority", priority)
+              .not_.is_("not_before", "null")
+              .order("not_before", desc=True)
+              .limit(1)
+              .execute())
+    if not result.data:
+        return None
+    return datetime.fromisoformat(result.data[0]["not_before"].replace("Z", "+00:00"))
+
+
+async def schedule_dm_rows(sb, account_id: str, rows: list[dict], priority: int = PRIORITY_BATCH):
+    """rows（dm_send_log へ INSERT する dict）に not_before / priority を書き込む"""
+    if not rows:
+        return
+    pacing = await get_pacing(sb, account_id)
+    interval = timedelta(seconds=60.0 / pacing["rate_per_minute"])
+
+    now = datetime.now(timezone.utc)
+    cursor = now
+    try:
+        tail = await _queue_tail(sb, account_id, priority)
+        if tail is not None and tail + interval > cursor:
+            cursor = tail + interval
+    except Exception as e:
+        # not_before 列が無い環境: 今から並べる（claim 側の制限はそのまま効く）
+        logger.warning(f"[DM-PACING] キュー末尾の取得失敗 ({account_id[:8]}): {e}")
+
+    for row in rows:
+        resume = _quiet_end(cursor, pacing["quiet_start"], pacing["quiet_end"])
+        if resume is not None:
+            cursor = resume
+        row["not_before"] = cursor.isoformat()
+        row["priority"] = priority
+        cursor += interval
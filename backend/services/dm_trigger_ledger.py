@@ -0,0 +1,268 @@
+"""DM trigger ledger - クールダウン・日次上限・24h重複判定をメモリ上の台帳で行う
+
+fire_trigger は発火のたびに dm_trigger_logs を最大1万行（クールダウン）と件数（日次上限）、
+dm_send_log を最大1万行（24h重複）読み直していた。ここでは
+
+- トリガーごとに user_name → 最終発火時刻 と 当日（UTC）の発火キー集合
+  （DMを伴う発火は dm_send_log の id、それ以外は発火ログの id）
+- アカウントごとに user_name → {cast_name: 最終キュー登録時刻}（24h分）
+
+を保持し、判定は辞書参照だけで行う。台帳は初回参照時にログから構築し、以降は
+id が透かしより大きい行（他プロセス・他経路の書き込み分）を読み足す。id は INSERT 時の採番で
+コミット順ではないため、前回の読み込みから OVERLAP_SECONDS 前以降に書かれた行
+（fired_at / queued_at）も毎回読み直し、透かしより小さい id で後からコミットされた行を拾う。
+この経路での発火は record_* で即時に反映する（透かしの読み足しで同じ行が来ても
+キー集合・最大時刻なので二重計上しない）。発火はDMのキュー登録時点で反映するため、
+その後の発火ログの書き込みに失敗してもこのプロセスの判定からは漏れない。
+
+dm_send_log が後から error に更新されたことは反映しない（最大24h重複扱いが残る）。
+"""
+import asyncio
+import logging
+import time
+from collections import defaultdict
+from datetime import datetime, timedelta, timezone
+
+logger = logging.getLogger(__name__)
+
+FIRED_ACTIONS = ["dm_queued", "scenario_enrolled"]
+DM_SENT_WINDOW_HOURS = 24
+PAGE_SIZE = 1000
+OVERLAP_SECONDS = 60.0   # 書き込みトランザクションの長さ + DBとの時計のずれより長く
+
+
+class _TriggerLedger:
+    __slots__ = ("fired", "day", "today_ids", "window_hours", "watermark", "synced_at")
+
+    def __init__(self, window_hours: int):
+        self.fired: dict[str, float] = {}   # user_name → 最終発火時刻(epoch)
+        self.day = _utc_day()
+        self.today_ids: set[tuple[str, int]] = set()   # ("dm", dm_send_log_id) / ("log", id)
+        self.window_hours = window_hours
+        self.watermark = 0
+        self.synced_at = 0.0   # 前回の読み込み開始時刻(epoch)
+
+
+class _DmSentLedger:
+    __slots__ = ("sent", "watermark", "synced_at")
+
+    def __init__(self):
+        self.sent: dict[str, dict[str, float]] = defaultdict(dict)   # user → cast → queued_at(epoch)
+        self.watermark = 0
+        self.synced_at = 0.0
+
+
+_triggers: dict[str, _TriggerLedger] = {}
+_dm_sent: dict[str, _DmSentLedger] = {}
+_locks: dict[str, asyncio.Lock] = {}
+_stats = {"rebuilds": 0, "delta_rows": 0, "recorded": 0}
+
+
+def _utc_day() -> str:
+    return datetime.now(timezone.utc).strftime("%Y-%m-%d")
+
+
+def _epoch(value: str | None) -> float:
+    if not value:
+        return time.time()
+    return datetime.fromisoformat(value.replace("Z", "+00:00")).timestamp()
+
+
+def _delta_filter(column: str, watermark: int, synced_at: float) -> str:
+    """透かしより後ろ、または前回の読み込みの少し前以降に書かれた行（.or_ 用）"""
+    since = datetime.fromtimestamp(synced_at - OVERLAP_SECONDS, timezone.utc).isoformat()
+    return f'id.gt.{watermark},{column}.gte."{since}"'
+
+
+async def _fetch_pages(build) -> list[dict]:
+    rows: list[dict] = []
+    while True:
+        page = (await build().range(len(rows), len(rows) + PAGE_SIZE - 1).execute()).data or []
+        rows.extend(page)
+        if len(page) < PAGE_SIZE:
+            return rows
+
+
+# ----------------------------------------------------------
+# Trigger cooldown / daily limit
+# ----------------------------------------------------------
+def _fire_key(row: dict) -> tuple[str, int] | None:
+    # キュー登録時の反映と発火ログの読み足しで同じ発火を同じキーにする
+    if row.get("dm_send_log_id") is not None:
+        return ("dm", row["dm_send_log_id"])
+    if row.get("id") is not None:
+        return ("log", row["id"])
+    return None
+
+
+def _apply_fires(ledger: _TriggerLedger, rows: list[dict]):
+    today = _utc_day()
+    if ledger.day != today:
+        ledger.day = today
+        ledger.today_ids.clear()
+    for row in rows:
+        fired_at = _epoch(row.get("fired_at"))
+        if fired_at > ledger.fired.get(row["user_name"], 0):
+            ledger.fired[row["user_name"]] = fired_at
+        key = _fire_key(row)
+        if key is not None and datetime.fromtimestamp(fired_at, timezone.utc).strftime("%Y-%m-%d") == today:
+            ledger.today_ids.add(key)
+
+
+async def sync_trigger_ledger(sb, trigger_id: str, cooldown_hours: int):
+    """台帳を用意する（未構築・クールダウン延長時は再構築、以降は新しいログ行だけ読む）"""
+    window = max(cooldown_hours, 24)
+    ledger = _triggers.get(trigger_id)
+    started = time.time()
+
+    if ledger is None or ledger.window_hours < window:
+        ledger = _TriggerLedger(window)
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=window)).isoformat()
+        rows = await _fetch_pages(lambda: (
+            sb.table("dm_trigger_logs")
+            .select("id, user_name, fired_at, dm_send_log_id")
+            .eq("trigger_id", trigger_id)
+            .in_("action_taken", FIRED_ACTIONS)
+            .gte("fired_at", cutoff)
+            .order("id")
+        ))
+        _stats["rebuilds"] += 1
+    else:
+        rows = await _fetch_pages(lambda: (
+            sb.table("dm_trigger_logs")
+            .select("id, user_name, fired_at, dm_send_log_id")
+            .eq("trigger_id", trigger_id)
+            .in_("action_taken", FIRED_ACTIONS)
+            .or_(_delta_filter("fired_at", ledger.watermark, ledger.synced_at))
+            .order("id")
+        ))
+        _stats["delta_rows"] += len(rows)
+
+    if rows:
+        ledger.watermark = max(ledger.watermark, rows[-1]["id"])
+    ledger.synced_at = started
+    _apply_fires(ledger, rows)
+
+    # 期限切れを落とす
+    expire = time.time() - ledger.window_hours * 3600
+    for user_name in [u for u, t in ledger.fired.items() if t < expire]:
+        del ledger.fired[user_name]
+    _triggers[trigger_id] = ledger
+
+
+def in_cooldown(trigger_id: str, user_name: str, cooldown_hours: int) -> bool:
+    ledger = _triggers.get(trigger_id)
+    fired_at = ledger.fired.get(user_name) if ledger else None
+    return fired_at is not None and fired_at >= time.time() - cooldown_hours * 3600
+
+
+def daily_fire_count(trigger_id: str) -> int:
+    ledger = _triggers.get(trigger_id)
+    if ledger is None or ledger.day != _utc_day():
+        return 0
+    return len(ledger.today_ids)
+
+
+def record_trigger_fires(trigger_id: str, rows: list[dict]):
+    """発火を反映（dm_trigger_logs の行、またはキュー登録した dm_send_log_id 付きの行）"""
+    ledger = _triggers.get(trigger_id)
+    if ledger is None:
+        return
+    fired = [r for r in rows if r.get("action_taken") in FIRED_ACTIONS]
+    _apply_fires(ledger, fired)
+    _stats["recorded"] += len(fired)
+
+
+def trigger_lock(trigger_id: str) -> asyncio.Lock:
+    """判定〜書き込みの間、同じトリガーの発火を直列化する（daemon と手動実行の競合防止）"""
+    lock = _locks.get(trigger_id)
+    if lock is None:
+        lock = _locks[trigger_id] = asyncio.Lock()
+    return lock
+
+
+def forget_trigger(trigger_id: str):
+    _triggers.pop(trigger_id, None)
+
+
+# ----------------------------------------------------------
+# 24h DM duplicates
+# ----------------------------------------------------------
+def _apply_sent(ledger: _DmSentLedger, rows: list[dict]):
+    for row in rows:
+        if row.get("status") == "error":
+            continue
+        queued_at = _epoch(row.get("queued_at"))
+        casts = ledger.sent[row["user_name"]]
+        cast_name = row.get("cast_name") or ""
+        if queued_at > casts.get(cast_name, 0):
+            casts[cast_name] = queued_at
+
+
+async def sync_dm_sent(sb, account_id: str):
+    ledger = _dm_sent.get(account_id)
+    started = time.time()
+    if ledger is None:
+        ledger = _DmSentLedger()
+        cutoff = (datetime.now(timezone.utc) - timedelta(hours=DM_SENT_WINDOW_HOURS)).isoformat()
+        rows = await _fetch_pages(lambda: (
+            sb.table("dm_send_log")
+            .select("id, user_name, cast_name, status, queued_at")
+            .eq("account_id", account_id)
+            .gte("queued_at", cutoff)
+            .order("id")
+        ))
+        _stats["rebuilds"] += 1
+    else:
+        rows = await _fetch_pages(lambda: (
+            sb.table("dm_send_log")
+            .select("id, user_name, cast_name, status, queued_at")
+            .eq("account_id", account_id)
+            .or_(_delta_filter("queued_at", ledger.watermark, ledger.synced_at))
+            .order("id")
+        ))
+        _stats["delta_rows"] += len(rows)
+
+    if rows:
+        ledger.watermark = max(ledger.watermark, rows[-1]["id"])
+    ledger.synced_at = started
+    _apply_sent(ledger, rows)
+
+    expire = time.time() - DM_SENT_WINDOW_HOURS * 3600
+    for user_name in list(ledger.sent):
+        casts = ledger.sent[user_name]
+        for cast_name in [c for c, t in casts.items() if t < expire]:
+            del casts[cast_name]
+        if not casts:
+            del ledger.sent[user_name]
+    _dm_sent[account_id] = ledger
+
+
+def dm_sent_recently(account_id: str, user_name: str, cast_name: str | None) -> bool:
+    """24h以内にキュー登録済みか（cast_name 指定時はそのキャスト宛てのみ）"""
+    ledger = _dm_sent.get(account_id)
+    casts = ledger.sent.get(user_name) if ledger else None
+    if not casts:
+        return False
+    expire = time.time() - DM_SENT_WINDOW_HOURS * 3600
+    if cast_name:
+        return casts.get(cast_name, 0) >= expire
+    return any(t >= expire for t in casts.values())
+
+
+def record_dm_sent(account_id: str, rows: list[dict]):
+    """dm_send_log に書いた行（user_name, cast_name, queued_at）を反映"""
+    ledger = _dm_sent.get(account_id)
+    if ledger is None:
+        return
+    _apply_sent(ledger, rows)
+    _stats["recorded"] += len(rows)
+
+
+def get_ledger_stats() -> dict:
+    return {
+        **_stats,
+        "triggers": len(_triggers),
+        "cooldown_entries": sum(len(l.fired) for l in _triggers.values()),
+        "accounts": len(_dm_sent),
+    }
@@ -0,0 +1,44 @@
+"""Keyset (cursor) pagination helpers
+
+一覧APIを (時刻列, id) の複合キーで降順にページングする。
+OFFSET と違い、何ページ目でも「キーより小さい行を limit 件」読むだけなので
+対応する複合インデックス (… , 時刻列 DESC, id DESC) があれば深さに依らず一定コスト。
+
+カーソルは base64url の不透明文字列。クライアントは中身を解釈しない。
+"""
+import base64
+import json
+
+from fastapi import HTTPException
+
+
+def encode_cursor(row: dict, time_column: str) -> str:
+    raw = json.dumps([row[time_column], row["id"]], separators=(",", ":"))
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor: str) -> tuple[str, int]:
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        value, row_id = json.loads(base64.urlsafe_b64decode(padded))
+        return str(value), int(row_id)
+    except Exception:
+        raise HTTPException(status_code=400, detail="Invalid cursor")
+
+
+def apply_keyset(query, time_column: str, cursor: str | None):
+    """降順 (time_column, id) で並べ、カーソルがあればその位置より後ろだけに絞る"""
+    if cursor:
+        value, row_id = decode_cursor(cursor)
+        query = query.or_(
+            f'{time_column}.lt."{value}",'
+            f'and({time_column}.eq."{value}",id.lt.{row_id})'
+        )
+    return query.order(time_column, desc=True).order("id", desc=True)
+
+
+def next_cursor(rows: list[dict], limit: int, time_column: str) -> str | None:
+    """ページが埋まっていれば次ページのカーソル、最終ページなら None"""
+    if len(rows) < limit or not rows:
+        return None
+    return encode_cursor(rows[-1], time_column)
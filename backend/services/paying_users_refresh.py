@@ -0,0 +1,150 @@
+"""paying_users materialized view - debounced background refresh
+
+同期系エンドポイント（sync_coins / sync_demo / coin-transactions）は
+これまでリクエスト内で refresh_paying_users を同期実行しており、
+Chrome拡張の頻繁な同期のたびにMV全体を再計算していた。
+
+ここでは更新要求をアカウント単位で記録するだけにして、
+バックグラウンドタスクが DEBOUNCE_SECONDS 静かになるまで（最長 MAX_DELAY_SECONDS）
+要求をまとめ、1回の REFRESH で全アカウント分を反映する。
+鮮度は get_refresh_status() で別途返す。REFRESH に失敗した要求は戻して
+バックオフ付きで再試行する。
+
+API側の主要な集計（ファネル・LTV・ランキング）は user_segment_members /
+account_coin_totals をトリガーで差分更新しているため、このMVに依存するのは
+SQL側の一部RPCのみ。
+"""
+import asyncio
+import logging
+import time
+from datetime import datetime, timezone
+
+from config import get_supabase_async
+
+logger = logging.getLogger(__name__)
+
+DEBOUNCE_SECONDS = 15.0     # 最後の要求からこの時間待ってまとめる
+MAX_DELAY_SECONDS = 120.0   # 要求が続いても最初の要求からこの時間内には実行
+RETRY_BASE_SECONDS = 5.0    # 失敗時の再試行間隔（失敗が続くたびに倍）
+RETRY_MAX_SECONDS = 300.0
+
+_pending: dict[str, str] = {}     # account_id → 最初の未反映要求時刻(ISO)
+_running: set[str] = set()        # 実行中の REFRESH に含まれるアカウント
+_first_request: float | None = None
+_last_request: float | None = None
+_last_refreshed_at: str | None = None
+_wake: asyncio.Event | None = None
+_task: asyncio.Task | None = None
+_failures = 0                     # 連続失敗回数
+_stats = {"requested": 0, "refreshes": 0, "failed": 0, "retries": 0}
+
+
+def _now_iso() -> str:
+    return datetime.now(timezone.utc).isoformat()
+
+
+# ----------------------------------------------------------
+# Refresh loop
+# ----------------------------------------------------------
+async def _run_refresh() -> bool:
+    global _last_refreshed_at, _first_request, _last_request, _failures
+    batch = dict(_pending)
+    _running.update(batch)
+    _pending.clear()
+    _first_request = _last_request = None
+    started = _now_iso()
+    try:
+        await get_supabase_async().rpc("refresh_paying_users").execute()
+        _last_refreshed_at = started
+        _failures = 0
+        _stats["refreshes"] += 1
+        return True
+    except Exception as e:
+        # 反映できなかったアカウントを要求時刻ごと戻し、バックオフ後に再試行する
+        _failures += 1
+        _stats["failed"] += 1
+        for account_id, requested_at in batch.items():
+            if account_id not in _pending or requested_at < _pending[account_id]:
+                _pending[account_id] = requested_at
+        logger.warning(f"[PAYING-USERS] refresh_paying_users 失敗（{_failures}回連続）: {e}")
+        return False
+    finally:
+        _running.difference_update(batch)
+
+
+def _retry_delay() -> float:
+    return min(RETRY_BASE_SECONDS * 2 ** (_failures - 1), RETRY_MAX_SECONDS)
+
+
+async def _refresh_loop(wake: asyncio.Event):
+    while True:
+        await wake.wait()
+        wake.clear()
+        # 要求が途切れるまで（または上限まで）待つ
+        while _pending:
+            now = time.monotonic()
+            deadline = min(_last_request + DEBOUNCE_SECONDS, _first_request + MAX_DELAY_SECONDS)
+            if now >= deadline:
+                # 失敗中に届いた要求も次の再試行にまとめる
+                while not await _run_refresh():
+                    await asyncio.sleep(_retry_delay())
+                    _stats["retries"] += 1
+                break
+            try:
+                await asyncio.wait_for(wake.wait(), deadline - now)
+                wake.clear()
+            except asyncio.TimeoutError:
+                pass
+
+
+# ----------------------------------------------------------
+# Public API
+# ----------------------------------------------------------
+def start_paying_users_refresher():
+    """バックグラウンドタスクを起動（lifespan から呼ぶ）"""
+    global _wake, _task
+    if _task is not None:
+        return
+    _wake = asyncio.Event()
+    _task = asyncio.create_task(_refresh_loop(_wake))
+
+
+async def stop_paying_users_refresher():
+    """タスクを止め、未反映の要求があれば最後に1回だけ REFRESH する"""
+    global _wake, _task
+    if _task is None:
+        return
+    _task.cancel()
+    try:
+        await _task
+    except asyncio.CancelledError:
+        pass
+    _task = _wake = None
+    if _pending:
+        await _run_refresh()
+
+
+def request_paying_users_refresh(account_id: str):
+    """paying_users の再計算を要求する（即時に戻る）"""
+    global _first_request, _last_request
+    now = time.monotonic()
+    _pending.setdefault(account_id, _now_iso())
+    _last_request = now
+    if _first_request is None:
+        _first_request = now
+    _stats["requested"] += 1
+    if _wake is not None:
+        _wake.set()
+
+
+def get_refresh_status(account_id: str) -> dict:
+    """アカウントの同期結果が paying_users に反映済みか"""
+    return {
+        "pending": account_id in _pending or account_id in _running,
+        "requested_at": _pending.get(account_id),
+        "refreshed_at": _last_refreshed_at,
+    }
+
+
+def get_refresh_stats() -> dict:
+    return {**_stats, "pending_accounts": len(_pending), "last_refreshed_at": _last_refreshed_at}
@@ -0,0 +1,317 @@
+"""SPY message bulk import - streaming (gzip) NDJSON → spy_messages
+
+キャッチアップ用の大量アップロードを、リクエストボディを読みながら
+1行ずつ処理する。全体をメモリに載せず、Pydantic も通さない。
+
+- gzip は先頭バイトで自動判別（非圧縮NDJSONもそのまま受け付ける）。解凍は出力を
+  DECOMPRESS_CHUNK_BYTES ずつ区切り、合計 MAX_DECOMPRESSED_BYTES を超えたら中断
+- 自然キー (cast_name, message_time, user_name, message) で重複排除。チャンク内は
+  キー集合で、それ以前（前チャンク + DB既存行）はチャンクの message_time の値で引いた
+  既存行で判定する（前チャンクの書き込み完了後に引くので、メモリはチャンク分だけ）
+- chunk_size 行ごとにINSERT。書き込み中に次チャンクをパースし、
+  書き込みは常に1つだけ（読み出しはINSERT完了を待つのでバックプレッシャーになる）
+- 進捗とチャンク単位の失敗は progress dict に逐次反映
+"""
+import asyncio
+import hashlib
+import json
+import logging
+import zlib
+from collections import OrderedDict
+from datetime import datetime, timezone
+
+from services.spy_ingest import insert_spy_rows
+from services.vip_checker import classify_comment, get_vip_index, is_vip_user, pickup_columns
+
+logger = logging.getLogger(__name__)
+
+MAX_LINE_BYTES = 64 * 1024     # 1行の上限（超えたら不正行扱い）
+DECOMPRESS_CHUNK_BYTES = 256 * 1024          # gzip 解凍1回あたりの出力上限
+MAX_DECOMPRESSED_BYTES = 2 * 1024 ** 3       # 解凍後の合計上限（超えたら中断）
+MAX_ERROR_SAMPLES = 20         # progress に残す不正行サンプル数
+MAX_TRACKED_IMPORTS = 100      # 進捗を保持するインポート数
+_EXISTING_PAGE_SIZE = 1000
+_EXISTING_TIMES_PER_QUERY = 100  # 既存行を引く message_time の値の数（URL長の上限）
+
+_REQUIRED_FIELDS = ("cast_name", "message_time", "msg_type")
+_OPTIONAL_TEXT_FIELDS = ("session_id", "session_title", "user_color", "user_league")
+
+# import_id → progress
+_imports: OrderedDict[str, dict] = OrderedDict()
+
+
+# ----------------------------------------------------------
+# Progress registry
+# ----------------------------------------------------------
+def new_progress(import_id: str | None, user_id: str, account_id: str) -> dict:
+    progress = {
+        "import_id": import_id,
+        "account_id": account_id,
+        "status": "running",
+        "lines": 0,
+        "inserted": 0,
+        "duplicates": 0,
+        "invalid": 0,
+        "chunks": 0,
+        "failed_chunks": [],
+        "errors": [],
+        "_user_id": user_id,
+    }
+    if import_id:
+        _imports[import_id] = progress
+        while len(_imports) > MAX_TRACKED_IMPORTS:
+            _imports.popitem(last=False)
+    return progress
+
+
+def get_progress(import_id: str, user_id: str) -> dict | None:
+    progress = _imports.get(import_id)
+    if progress is None or progress.get("_user_id") != user_id:
+        return None
+    return public_progress(progress)
+
+
+def public_progress(progress: dict) -> dict:
+    return {k: v for k, v in progress.items() if not k.startswith("_")}
+
+
+# ----------------------------------------------------------
+# Parsing
+# ----------------------------------------------------------
+def _normalize_time(value) -> str:
+    """比較用にUTCのISO文字列へ正規化"""
+    dt = datetime.fromisoformat(str(value))
+    if dt.tzinfo is None:
+        dt = dt.replace(tzinfo=timezone.utc)
+    return dt.astimezone(timezone.utc).isoformat()
+
+
+def _dedup_key(cast_name: str, message_time: str, user_name, message) -> bytes:
+    raw = "\x1f".join((cast_name, message_time, user_name or "", message or ""))
+    return hashlib.blake2b(raw.encode(), digest_size=16).digest()
+
+
+def _parse_line(line: bytes, account_id: str) -> dict:
+    """1行を spy_messages の行に変換（SpyMessageCreate 相当の検証を手書きで）"""
+    obj = json.loads(line)
+    if not isinstance(obj, dict):
+        raise ValueError("JSON object expected")
+    for field in _REQUIRED_FIELDS:
+        if not obj.get(field):
+            raise ValueError(f"{field} is required")
+    if obj.get("account_id", account_id) != account_id:
+        raise ValueError("account_id mismatch")
+
+    tokens = obj.get("tokens", 0) or 0
+    if not isinstance(tokens, int) or tokens < 0:
+        raise ValueError("tokens must be a non-negative integer")
+    metadata = obj.get("metadata") or {}
+    if not isinstance(metadata, dict):
+        raise ValueError("metadata must be an object")
+    user_level = obj.get("user_level")
+    if user_level is not None and not isinstance(user_level, int):
+        raise ValueError("user_level must be an integer")
+
+    row = {
+        "account_id": account_id,
+        "cast_name": str(obj["cast_name"]),
+        "message_time": _normalize_time(obj["message_time"]),
+        "msg_type": str(obj["msg_type"]),
+        "user_name": obj.get("user_name"),
+        "message": obj.get("message"),
+        "tokens": tokens,
+        "is_vip": False,
+        "metadata": metadata,
+        **pickup_columns(classify_comment(obj.get("message"), str(obj["msg_type"]), tokens)),
+    }
+    for field in _OPTIONAL_TEXT_FIELDS:
+        if obj.get(field):
+            row[field] = str(obj[field])
+    if user_level is not None:
+        row["user_level"] = user_level
+    return row
+
+
+async def _decoded_chunks(stream):
+    """バイトストリームを（gzipなら解凍しつつ）返す。1回の解凍出力と合計サイズに上限を設ける"""
+    decomp = None
+    first = True
+    total = 0
+
+    def count(out: bytes) -> bytes:
+        nonlocal total
+        total += len(out)
+        if total > MAX_DECOMPRESSED_BYTES:
+            raise ValueError(f"decompressed size exceeds {MAX_DECOMPRESSED_BYTES} bytes")
+        return out
+
+    async for chunk in stream:
+        if not chunk:
+            continue
+        if first:
+            first = False
+            if chunk[:2] == b"\x1f\x8b":
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+        if decomp is None:
+            yield chunk
+            continue
+        data = chunk
+        while True:
+            out = count(decomp.decompress(data, DECOMPRESS_CHUNK_BYTES))
+            if out:
+                yield out
+            # 連結された gzip メンバーにも対応
+            if decomp.eof and decomp.unused_data:
+                data = decomp.unused_data
+                decomp = zlib.decompressobj(16 + zlib.MAX_WBITS)
+                continue
+            data = decomp.unconsumed_tail
+            if not data and len(out) < DECOMPRESS_CHUNK_BYTES:
+                break
+    if decomp is not None:
+        out = count(decomp.flush())
+        if out:
+            yield out
+
+
+async def _iter_lines(stream):
+    """行単位に分割。MAX_LINE_BYTES を超えた行は先頭だけを1回返し（不正行扱い）、次の改行まで読み捨てる"""
+    buf = b""
+    skipping = False
+    async for data in _decoded_chunks(stream):
+        if skipping:
+            newline = data.find(b"\n")
+            if newline < 0:
+                continue
+            data = data[newline + 1:]
+            skipping = False
+        buf += data
+        *lines, buf = buf.split(b"\n")
+        for line in lines:
+            yield line
+        if len(buf) > MAX_LINE_BYTES:
+            yield buf[:MAX_LINE_BYTES + 1]
+            buf = b""
+            skipping = True
+    if buf and not skipping:
+        yield buf
+
+
+# ----------------------------------------------------------
+# Writing
+# ----------------------------------------------------------
+async def _existing_keys(sb, account_id: str, rows: list[dict]) -> set[bytes]:
+    """チャンクと同じ message_time（値が一致するもの）・キャストの既存行の自然キー"""
+    times = sorted({r["message_time"] for r in rows})
+    casts = sorted({r["cast_name"] for r in rows})
+    keys: set[bytes] = set()
+    for i in range(0, len(times), _EXISTING_TIMES_PER_QUERY):
+        batch = times[i:i + _EXISTING_TIMES_PER_QUERY]
+        offset = 0
+        while True:
+            result = (await sb.table("spy_messages")
+                      .select("cast_name, message_time, user_name, message")
+                      .eq("account_id", account_id)
+                      .in_("cast_name", casts)
+                      .in_("message_time", batch)
+                      .order("id")
+                      .range(offset, offset + _EXISTING_PAGE_SIZE - 1)
+                      .execute())
+            page = result.data or []
+            for r in page:
+                keys.add(_dedup_key(r["cast_name"], _normalize_time(r["message_time"]),
+                                    r.get("user_name"), r.get("message")))
+            if len(page) < _EXISTING_PAGE_SIZE:
+                break
+            offset += _EXISTING_PAGE_SIZE
+    return keys
+
+
+async def _write_chunk(sb, account_id: str, rows: list[dict], keys: list[bytes],
+                       chunk_no: int, first_line: int, last_line: int, progress: dict):
+    try:
+        existing = await _existing_keys(sb, account_id, rows)
+        if existing:
+            fresh = [r for r, k in zip(rows, keys) if k not in existing]
+            progress["duplicates"] += len(rows) - len(fresh)
+            rows = fresh
+        rejected = await insert_spy_rows(rows) if rows else 0
+        progress["inserted"] += len(rows) - rejected
+        progress["invalid"] += rejected
+    except Exception as e:
+        logger.error(f"[SPY-IMPORT] chunk {chunk_no} (lines {first_line}-{last_line}) 失敗: {e}")
+        progress["failed_chunks"].append({
+            "chunk": chunk_no,
+            "first_line": first_line,
+            "last_line": last_line,
+            "rows": len(rows),
+            "error": str(e),
+        })
+    progress["chunks"] += 1
+
+
+async def import_ndjson(sb, account_id: str, stream, progress: dict, chunk_size: int = 500) -> dict:
+    """NDJSON ストリームを spy_messages に取り込み、progress を更新して返す"""
+    await get_vip_index(sb, account_id)
+    # 現チャンク内のキーだけ持つ（前チャンクとの重複は書き込み時のDB照会で落とす）
+    seen: set[bytes] = set()
+    rows: list[dict] = []
+    keys: list[bytes] = []
+    first_line = 1
+    chunk_no = 0
+    writer: asyncio.Task | None = None
+
+    async def flush():
+        nonlocal writer, rows, keys, chunk_no, first_line
+        if writer is not None:
+            await writer
+        chunk_no += 1
+        writer = asyncio.create_task(_write_chunk(
+            sb, account_id, rows, keys, chunk_no, first_line, progress["lines"], progress,
+        ))
+        rows, keys = [], []
+        seen.clear()
+        first_line = progress["lines"] + 1
+
+    try:
+        async for line in _iter_lines(stream):
+            progress["lines"] += 1
+            line = line.strip()
+            if not line:
+                continue
+            try:
+                if len(line) > MAX_LINE_BYTES:
+                    raise ValueError("line too long")
+                row = _parse_line(line, account_id)
+            except (ValueError, TypeError) as e:
+                progress["invalid"] += 1
+                if len(progress["errors"]) < MAX_ERROR_SAMPLES:
+                    progress["errors"].append({"line": progress["lines"], "error": str(e)})
+                continue
+
+            key = _dedup_key(row["cast_name"], row["message_time"], row["user_name"], row["message"])
+            if key in seen:
+                progress["duplicates"] += 1
+                continue
+            seen.add(key)
+            row["is_vip"] = row["is_whale"] = is_vip_user(account_id, row["user_name"])
+            rows.append(row)
+            keys.append(key)
+            if len(rows) >= chunk_size:
+                await flush()
+
+        if rows:
+            await flush()
+        if writer is not None:
+            await writer
+    except Exception as e:
+        # 解凍・通信エラー: ここまでに書いたチャンクは残る
+        if writer is not None:
+            await writer
+        progress["status"] = "aborted"
+        progress["error"] = str(e)
+        logger.error(f"[SPY-IMPORT] 中断 (line {progress['lines']}): {e}")
+        return progress
+
+    progress["status"] = "completed_with_errors" if progress["failed_chunks"] else "completed"
+    return progress
@@ -0,0 +1,163 @@
+"""SPY message ingestion - micro-batching writer for POST /api/spy/messages
+
+Chrome拡張は1メッセージずつPOSTしてくるため、1件ごとにINSERTすると
+DB往復がチャット行数と同じだけ発生する。ここではハンドラが分類済みの行を
+プロセス内キューに積むだけにして、ライタータスクが短いウィンドウごとに
+まとめて1回のINSERTで書き込む。
+"""
+import asyncio
+import logging
+
+from postgrest.types import ReturnMethod
+
+from config import get_supabase_async
+from services.spy_stream import notify_spy_written
+
+logger = logging.getLogger(__name__)
+
+# マイグレーション未適用環境ではINSERTから外してリトライする列
+# (003: session_id/session_title, 144: ピックアップ用フラグ)
+_OPTIONAL_COLUMNS = ("session_id", "session_title", "is_whale", "is_gift", "is_question")
+_MISSING_COLUMN_CODES = ("PGRST204", "42703")
+_ROW_ERROR_CLASSES = ("22", "23")   # SQLSTATE: データ例外・整合性制約違反
+
+FLUSH_WINDOW_SECONDS = 0.25   # 最初の1件からこの時間だけ待ってまとめる
+MAX_BATCH_ROWS = 500          # 1回のINSERT上限
+MAX_QUEUE_ROWS = 20000        # キュー上限（超過時は呼び出し側で直接INSERT）
+FLUSH_RETRIES = 5             # 一時的な失敗時の再試行回数
+FLUSH_BACKOFF_SECONDS = 0.5
+FLUSH_BACKOFF_MAX_SECONDS = 10.0
+
+_queue: asyncio.Queue | None = None
+_writer_task: asyncio.Task | None = None
+_stats = {"enqueued": 0, "flushed": 0, "batches": 0, "failed": 0, "rejected": 0, "retries": 0}
+
+
+# ----------------------------------------------------------
+# Writer
+# ----------------------------------------------------------
+def _error_code(e: Exception) -> str:
+    return str(getattr(e, "code", None) or "")
+
+
+def _is_missing_column(e: Exception) -> bool:
+    """列が存在しない（マイグレーション未適用）エラーか"""
+    return _error_code(e) in _MISSING_COLUMN_CODES
+
+
+def _is_row_error(e: Exception) -> bool:
+    """特定の行の値が原因のエラーか（データ例外・制約違反）。それ以外は一時的な失敗として扱う"""
+    return _error_code(e)[:2] in _ROW_ERROR_CLASSES
+
+
+async def insert_spy_rows(rows: list[dict]) -> int:
+    """spy_messages へ一括INSERTし、値が不正で弾いた行数を返す
+
+    - 列が無いエラー (PGRST204 / 42703) のときだけ追加列を外してリトライ
+    - 行の値が原因のエラーはバッチを二分して、不正な行だけを落とす
+    - タイムアウト・5xx 等はそのまま送出（呼び出し側でリトライ）
+    """
+    sb = get_supabase_async()
+    try:
+        await sb.table("spy_messages").insert(rows, returning=ReturnMethod.minimal).execute()
+        return 0
+    except Exception as e:
+        if _is_missing_column(e) and any(c in row for row in rows for c in _OPTIONAL_COLUMNS):
+            for row in rows:
+                for column in _OPTIONAL_COLUMNS:
+                    row.pop(column, None)
+            return await insert_spy_rows(rows)
+        if not _is_row_error(e):
+            raise
+        if len(rows) == 1:
+            _stats["rejected"] += 1
+            logger.warning(f"[SPY-INGEST] 不正な行を破棄 ({rows[0].get('cast_name')}/{rows[0].get('user_name')}): {e}")
+            return 1
+    middle = len(rows) // 2
+    return await insert_spy_rows(rows[:middle]) + await insert_spy_rows(rows[middle:])
+
+
+async def _flush(batch: list[dict]):
+    """一時的な失敗はバックオフしながら FLUSH_RETRIES 回まで書き直す（その間の新着はキューに溜まる）"""
+    for attempt in range(FLUSH_RETRIES + 1):
+        try:
+            rejected = await insert_spy_rows(batch)
+            _stats["flushed"] += len(batch) - rejected
+            _stats["batches"] += 1
+            notify_spy_written({row["account_id"] for row in batch})
+            return
+        except Exception as e:
+            if attempt == FLUSH_RETRIES:
+                _stats["failed"] += len(batch)
+                logger.error(f"[SPY-INGEST] バッチINSERT失敗 ({len(batch)}件, {attempt + 1}回目で断念): {e}")
+                return
+            _stats["retries"] += 1
+            delay = min(FLUSH_BACKOFF_SECONDS * 2 ** attempt, FLUSH_BACKOFF_MAX_SECONDS)
+            logger.warning(f"[SPY-INGEST] バッチINSERT失敗 ({len(batch)}件) — {delay:.1f}秒後に再試行: {e}")
+            await asyncio.sleep(delay)
+
+
+async def _writer_loop(queue: asyncio.Queue):
+    """None を受け取ったら手持ちのバッチを書いて終了"""
+    loop = asyncio.get_running_loop()
+    while True:
+        row = await queue.get()
+        if row is None:
+            return
+        batch = [row]
+        stopping = False
+        deadline = loop.time() + FLUSH_WINDOW_SECONDS
+        while len(batch) < MAX_BATCH_ROWS:
+            timeout = deadline - loop.time()
+            if timeout <= 0:
+                break
+            try:
+                row = await asyncio.wait_for(queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            if row is None:
+                stopping = True
+                break
+            batch.append(row)
+        await _flush(batch)
+        if stopping:
+            return
+
+
+# ----------------------------------------------------------
+# Public API
+# ----------------------------------------------------------
+def start_spy_ingest():
+    """ライタータスクを起動（lifespan から呼ぶ）"""
+    global _queue, _writer_task
+    if _writer_task is not None:
+        return
+    _queue = asyncio.Queue(maxsize=MAX_QUEUE_ROWS)
+    _writer_task = asyncio.create_task(_writer_loop(_queue))
+
+
+async def stop_spy_ingest():
+    """キューに残った行を書き切ってからライタータスクを停止"""
+    global _queue, _writer_task
+    if _writer_task is None:
+        return
+    queue, _queue = _queue, None   # 以降の enqueue は直接INSERTへ回す
+    await queue.put(None)
+    await _writer_task
+    _writer_task = None
+
+
+def enqueue_spy_message(row: dict) -> bool:
+    """行をキューに積む。ライター未起動・キュー満杯なら False（呼び出し側で直接INSERT）"""
+    if _queue is None:
+        return False
+    try:
+        _queue.put_nowait(row)
+    except asyncio.QueueFull:
+        return False
+    _stats["enqueued"] += 1
+    return True
+
+
+def get_ingest_stats() -> dict:
+    return {**_stats, "queued": _queue.qsize() if _queue is not None else 0}
@@ -0,0 +1,197 @@
+"""SPY live stream - spy_messages の新着行をアカウント単位で購読者へ配信
+
+アカウントごとに1つのポーリングタスクが差分だけを取得し、そのアカウントの
+全購読者へ配る（購読者が何人いてもDB問い合わせは1本）。id は採番順でコミット順ではないため、
+OVERLAP_SECONDS 前の位置から読み直して配信済み id を除く。
+API経由の取り込み（spy_ingest）は書き込み直後に notify_spy_written() で
+ポーリングを即時起床させ、collector など他プロセスの書き込みは
+POLL_INTERVAL_SECONDS ごとのポーリングで拾う。
+"""
+import asyncio
+import logging
+import time
+from collections import deque
+
+from config import get_supabase_async
+
+logger = logging.getLogger(__name__)
+
+POLL_INTERVAL_SECONDS = 2.0
+FETCH_LIMIT = 500             # 1回の差分取得上限（超過分は次のループで続きを取る）
+SUBSCRIBER_QUEUE_SIZE = 2000  # 溢れた購読者は切断（クライアントは last_id で再開）
+OVERLAP_SECONDS = 10.0        # この時間内に遅れてコミットされた（id が小さい）行も拾う
+
+
+class Subscription:
+    """1購読者分のキューとフィルタ"""
+
+    def __init__(self, cast_name: str | None, msg_type: str | None,
+                 vip_only: bool, exclude_users: set[str]):
+        self.cast_name = cast_name
+        self.msg_type = msg_type
+        self.vip_only = vip_only
+        self.exclude_users = exclude_users
+        self.queue: asyncio.Queue = asyncio.Queue(maxsize=SUBSCRIBER_QUEUE_SIZE)
+        self.overflowed = False
+
+    def matches(self, row: dict) -> bool:
+        if self.cast_name and row.get("cast_name") != self.cast_name:
+            return False
+        if self.msg_type and row.get("msg_type") != self.msg_type:
+            return False
+        if self.vip_only and not row.get("is_vip"):
+            return False
+        if self.exclude_users and row.get("user_name") in self.exclude_users:
+            return False
+        return True
+
+    def offer(self, row: dict):
+        if self.overflowed or not self.matches(row):
+            return
+        try:
+            self.queue.put_nowait(row)
+        except asyncio.QueueFull:
+            # 取りこぼしを黙って続けるより、キューを出し切った時点で切断し last_id から再開させる
+            self.overflowed = True
+
+
+class _AccountChannel:
+    def __init__(self, account_id: str):
+        self.account_id = account_id
+        self.subscribers: set[Subscription] = set()
+        self.wake = asyncio.Event()
+        self.task: asyncio.Task | None = None
+        self.started: asyncio.Task | None = None
+        self.last_id: int | None = None
+        # (時刻, last_id) の履歴。OVERLAP_SECONDS 前の last_id から読み直し、遅れてコミットされた
+        # 小さい id の行を拾う（配信済みは _delivered で除く）
+        self._history: deque[tuple[float, int]] = deque()
+        self._delivered: set[int] = set()
+
+    async def start(self, sb):
+        """配信開始位置（現在の最新 id）を確定する。購読者の取りこぼし分取得はこの後に行う"""
+        latest = (await sb.table("spy_messages")
+                  .select("id")
+                  .eq("account_id", self.account_id)
+                  .order("id", desc=True)
+                  .limit(1)
+                  .execute())
+        self.last_id = latest.data[0]["id"] if latest.data else 0
+        self._history.append((time.monotonic(), self.last_id))
+
+    def _floor(self) -> int:
+        """OVERLAP_SECONDS 前（履歴が浅ければ最古）の last_id"""
+        cutoff = time.monotonic() - OVERLAP_SECONDS
+        while len(self._history) > 1 and self._history[1][0] <= cutoff:
+            self._history.popleft()
+        return self._history[0][1]
+
+    async def _fetch_new(self, sb) -> tuple[list[dict], bool]:
+        """未配信の行と、続きがあるか"""
+        floor = self._floor()
+        self._delivered = {i for i in self._delivered if i > floor}
+        cursor = floor
+        while True:
+            page = (await sb.table("spy_messages")
+                    .select("*")
+                    .eq("account_id", self.account_id)
+                    .gt("id", cursor)
+                    .order("id")
+                    .limit(FETCH_LIMIT)
+                    .execute()).data or []
+            fresh = [row for row in page if row["id"] not in self._delivered]
+            more = len(page) == FETCH_LIMIT
+            if fresh or not more:
+                return fresh, more
+            cursor = page[-1]["id"]
+
+    async def _poll_loop(self):
+        sb = get_supabase_async()
+        while self.subscribers:
+            more = False
+            try:
+                rows, more = await self._fetch_new(sb)
+            except Exception as e:
+                logger.warning(f"[SPY-STREAM] {self.account_id}: 差分取得失敗: {e}")
+                rows = []
+
+            for row in rows:
+                self._delivered.add(row["id"])
+                for sub in list(self.subscribers):
+                    sub.offer(row)
+            if rows:
+                self.last_id = max(self.last_id, rows[-1]["id"])
+            if self.last_id != self._history[-1][1]:
+                self._history.append((time.monotonic(), self.last_id))
+            if more:
+                continue   # まだ続きがある
+
+            self.wake.clear()
+            try:
+                await asyncio.wait_for(self.wake.wait(), POLL_INTERVAL_SECONDS)
+            except asyncio.TimeoutError:
+                pass
+
+
+_channels: dict[str, _AccountChannel] = {}
+
+
+async def subscribe(sb, account_id: str, sub: Subscription):
+    """購読を登録し、チャンネルの配信開始位置が確定するまで待つ
+
+    戻った後に fetch_since で取りこぼし分を読めば、その範囲とライブ配信の間に隙間はできない。
+    """
+    channel = _channels.get(account_id)
+    if channel is None:
+        channel = _channels[account_id] = _AccountChannel(account_id)
+    channel.subscribers.add(sub)
+    if channel.started is None:
+        channel.started = asyncio.create_task(channel.start(sb))
+    try:
+        await asyncio.shield(channel.started)
+    except BaseException:
+        started = channel.started
+        if started.done() and not started.cancelled() and started.exception() is not None:
+            channel.started = None   # 次の購読者で再試行
+        unsubscribe(account_id, sub)
+        raise
+    if channel.task is None or channel.task.done():
+        channel.task = asyncio.create_task(channel._poll_loop())
+
+
+def unsubscribe(account_id: str, sub: Subscription):
+    channel = _channels.get(account_id)
+    if channel is None:
+        return
+    channel.subscribers.discard(sub)
+    if not channel.subscribers:
+        # ポーリングは次のループで自然終了する。last_id はチャンネルごと捨てる
+        channel.wake.set()
+        _channels.pop(account_id, None)
+
+
+def notify_spy_written(account_ids):
+    """新着行を書いた直後に呼ぶ（該当アカウントのポーリングを即時起床）"""
+    for account_id in account_ids:
+        channel = _channels.get(account_id)
+        if channel is not None:
+            channel.wake.set()
+
+
+async def fetch_since(sb, account_id: str, last_id: int, cast_name: str | None,
+                      max_pages: int = 10) -> tuple[list[dict], bool]:
+    """再接続時の取りこぼし分（id > last_id）と、max_pages * FETCH_LIMIT 件で打ち切ったか"""
+    rows: list[dict] = []
+    for _ in range(max_pages):
+        q = (sb.table("spy_messages")
+             .select("*")
+             .eq("account_id", account_id)
+             .gt("id", last_id))
+        if cast_name:
+            q = q.eq("cast_name", cast_name)
+        page = (await q.order("id").limit(FETCH_LIMIT).execute()).data or []
+        rows.extend(page)
+        if len(page) < FETCH_LIMIT:
+            return rows, False
+        last_id = page[-1]["id"]
+    return rows, True
@@ -1,17 +1,221 @@
-"""VIP checker - Ported from audio_server.py _check_vip()"""
-from datetime import datetime, timedelta
+"""VIP checker - Ported from audio_server.py _check_vip()
+
+paid_users はアカウント単位でメモリ上に索引化し、VIP判定はDBを引かずに
+辞書参照だけで行う。同一プロセス内で paid_users を書き込む側（collector の
+save_payers、sync_coins、CSVアップロード）は update_vip_index() で即時反映し、
+他プロセスの書き込みは updated_at 差分で定期的に取り込む。
+索引は DB クライアントに依存しないので、API（async）と collector（sync）の
+どちらからも使える。
+"""
+import asyncio
+import threading
+import time
+from collections import deque
+from datetime import datetime
 
 
 VIP_TOKEN_THRESHOLD = 1000
 VIP_LEVEL_THRESHOLD = 70
 DEDUP_MINUTES = 5
+VIP_INDEX_DELTA_SECONDS = 30   # 他プロセスの書き込みを updated_at 差分で取り込む間隔
+VIP_INDEX_TTL_SECONDS = 3600   # 取りこぼし対策の全件再読込間隔
+_PAGE_SIZE = 1000
+_SELECT_COLUMNS = "cast_name, user_name, total_coins, last_payment_date, user_level, updated_at"
+
+
+# ----------------------------------------------------------
+# Alert dedup (TTL)
+# ----------------------------------------------------------
+class _AlertDedup:
+    """
+    同一キーのアラートを ttl 秒間抑止する。
+
+    TTL が固定なので期限は挿入順に並ぶ。deque の先頭から期限切れだけを
+    取り除けばよく、判定・登録とも償却 O(1)。
+    """
+
+    def __init__(self, ttl_seconds: float):
+        self._ttl = ttl_seconds
+        self._expires: dict[str, float] = {}
+        self._order: deque[tuple[float, str]] = deque()
+
+    def _expire(self, now: float):
+        while self._order and self._order[0][0] <= now:
+            expires_at, key = self._order.popleft()
+            # 再登録されたキーは新しい期限を残す
+            if self._expires.get(key) == expires_at:
+                del self._expires[key]
+
+    def seen(self, key: str) -> bool:
+        now = time.monotonic()
+        self._expire(now)
+        return key in self._expires
+
+    def add(self, key: str):
+        expires_at = time.monotonic() + self._ttl
+        self._expires[key] = expires_at
+        self._order.append((expires_at, key))
+
 
 # In-memory dedup cache (per-process)
-_recent_alerts: dict[str, datetime] = {}
+_recent_alerts = _AlertDedup(DEDUP_MINUTES * 60)
 
 
-async def check_vip(sb, account_id: str, user_name: str) -> dict | None:
-    """Check if user is VIP. Returns alert dict or None.
+# ----------------------------------------------------------
+# VIP index
+# ----------------------------------------------------------
+class VipIndex:
+    """user_name → (total_coins, user_level, last_payment_date)
+
+    paid_users は (account_id, cast_name, user_name) で一意なので、キャストごとの行を
+    casts に持ち、users にはキャスト横断の最大値を置く（後から来た小さい行で上書きしない）。
+    """
+
+    __slots__ = ("users", "casts", "loaded_at", "checked_at", "synced_until")
+
+    def __init__(self):
+        self.users: dict[str, tuple[int, int, str | None]] = {}
+        self.casts: dict[str, dict[str, tuple[int, int, str | None]]] = {}
+        self.loaded_at = time.monotonic()
+        self.checked_at = self.loaded_at
+        self.synced_until: str | None = None   # 取り込み済みの最大 updated_at
+
+    def apply(self, rows: list[dict]):
+        """paid_users の行（書き込んだ列だけでよい）を反映"""
+        for row in rows:
+            name = row.get("user_name")
+            if not name:
+                continue
+            by_cast = self.casts.setdefault(name, {})
+            cast_name = row.get("cast_name") or ""
+            prev = by_cast.get(cast_name, (0, 0, None))
+            by_cast[cast_name] = (
+                int(row["total_coins"] or 0) if "total_coins" in row else prev[0],
+                int(row["user_level"] or 0) if "user_level" in row else prev[1],
+                row["last_payment_date"] if "last_payment_date" in row else prev[2],
+            )
+            # collector のスレッドと API の両方から呼ばれるので、反復は写しに対して行う
+            entries = tuple(by_cast.values())
+            self.users[name] = (
+                max(e[0] for e in entries),
+                max(e[1] for e in entries),
+                max((e[2] for e in entries if e[2]), default=None),
+            )
+            updated_at = row.get("updated_at")
+            if updated_at and (self.synced_until is None or updated_at > self.synced_until):
+                self.synced_until = updated_at
+
+    @property
+    def expired(self) -> bool:
+        return time.monotonic() - self.loaded_at >= VIP_INDEX_TTL_SECONDS
+
+    @property
+    def needs_delta(self) -> bool:
+        return time.monotonic() - self.checked_at >= VIP_INDEX_DELTA_SECONDS
+
+
+# account_id → VipIndex
+_vip_indexes: dict[str, VipIndex] = {}
+_vip_index_locks: dict[str, asyncio.Lock] = {}
+_vip_index_thread_locks: dict[str, threading.Lock] = {}
+_thread_locks_guard = threading.Lock()
+
+
+def _paid_users_page(sb, account_id: str, since: str | None, offset: int):
+    q = (sb.table("paid_users")
+         .select(_SELECT_COLUMNS)
+         .eq("account_id", account_id))
+    if since:
+        q = q.gt("updated_at", since).order("updated_at")
+    else:
+        q = q.order("user_name")
+    return q.range(offset, offset + _PAGE_SIZE - 1)
+
+
+async def _sync_index(sb, account_id: str, index: VipIndex, since: str | None):
+    offset = 0
+    while True:
+        rows = (await _paid_users_page(sb, account_id, since, offset).execute()).data or []
+        index.apply(rows)
+        if len(rows) < _PAGE_SIZE:
+            break
+        offset += _PAGE_SIZE
+    index.checked_at = time.monotonic()
+
+
+def _sync_index_blocking(sb, account_id: str, index: VipIndex, since: str | None):
+    offset = 0
+    while True:
+        rows = _paid_users_page(sb, account_id, since, offset).execute().data or []
+        index.apply(rows)
+        if len(rows) < _PAGE_SIZE:
+            break
+        offset += _PAGE_SIZE
+    index.checked_at = time.monotonic()
+
+
+async def get_vip_index(sb, account_id: str) -> VipIndex:
+    """アカウントの VIP 索引を返す（未読込・TTL 経過時は全件、それ以外は差分のみDBを引く）"""
+    index = _vip_indexes.get(account_id)
+    if index is not None and not index.expired and not index.needs_delta:
+        return index
+
+    lock = _vip_index_locks.setdefault(account_id, asyncio.Lock())
+    async with lock:
+        # 待っている間に別リクエストが更新済みならそれを使う
+        index = _vip_indexes.get(account_id)
+        if index is None or index.expired:
+            index = VipIndex()
+            await _sync_index(sb, account_id, index, None)
+            _vip_indexes[account_id] = index
+        elif index.needs_delta:
+            await _sync_index(sb, account_id, index, index.synced_until)
+        return index
+
+
+def refresh_vip_index_sync(sb, account_id: str) -> VipIndex:
+    """collector 用（sync クライアント、asyncio.to_thread から呼ぶ）: get_vip_index と同じ規則で読込・差分取り込み
+
+    同じアカウントの複数キャストのクライアントが並行して呼ぶので、アカウントごとのロックで
+    読込を1回にまとめる。
+    """
+    index = _vip_indexes.get(account_id)
+    if index is not None and not index.expired and not index.needs_delta:
+        return index
+
+    with _thread_locks_guard:
+        lock = _vip_index_thread_locks.setdefault(account_id, threading.Lock())
+    with lock:
+        # 待っている間に別スレッドが更新済みならそれを使う
+        index = _vip_indexes.get(account_id)
+        if index is None or index.expired:
+            index = VipIndex()
+            _sync_index_blocking(sb, account_id, index, None)
+            _vip_indexes[account_id] = index
+        elif index.needs_delta:
+            _sync_index_blocking(sb, account_id, index, index.synced_until)
+        return index
+
+
+def update_vip_index(account_id: str, rows: list[dict]):
+    """paid_users 書き込み後に呼ぶ。未読込のアカウントは次回の全件読込に任せる"""
+    index = _vip_indexes.get(account_id)
+    if index is not None:
+        index.apply(rows)
+
+
+# ----------------------------------------------------------
+# VIP check
+# ----------------------------------------------------------
+def is_vip_user(account_id: str, user_name: str) -> bool:
+    """索引上で VIP 条件を満たすか（dedup なし・DBアクセスなし）"""
+    index = _vip_indexes.get(account_id)
+    entry = index.users.get(user_name) if index is not None and user_name else None
+    return entry is not None and (entry[0] >= VIP_TOKEN_THRESHOLD or entry[1] >= VIP_LEVEL_THRESHOLD)
+
+
+def evaluate_vip(account_id: str, user_name: str) -> dict | None:
+    """読込済みの索引だけで VIP 判定する（DBアクセスなし）。
 
     VIP criteria:
     - 1000+ total tokens (whale)
@@ -21,35 +225,25 @@ async def check_vip(sb, account_id: str, user_name: str) -> dict | None:
     """
     if not user_name:
         return None
+    index = _vip_indexes.get(account_id)
+    if index is None:
+        return None
+    entry = index.users.get(user_name)
+    if entry is None:
+        return None
+
+    total, level, last_paid = entry
+    if total < VIP_TOKEN_THRESHOLD and level < VIP_LEVEL_THRESHOLD:
+        return None
 
     # Dedup check
     cache_key = f"{account_id}:{user_name}"
-    now = datetime.utcnow()
-    if cache_key in _recent_alerts:
-        if (now - _recent_alerts[cache_key]).total_seconds() < DEDUP_MINUTES * 60:
-            return None
-    
-    # Look up user across all accounts for this user
-    result = (sb.table("paid_users")
-              .select("user_name, total_coins, last_payment_date, user_level")
-              .eq("account_id", account_id)
-              .eq("user_name", user_name)
-              .limit(1)
-              .execute())
-
-    if not result.data:
+    if _recent_alerts.seen(cache_key):
         return None
 
-    user = result.data[0]
-    total = user.get("total_coins", 0) or 0
-    level = user.get("user_level", 0) or 0
-    last_paid = user.get("last_payment_date")
-
     # Lifecycle classification
     lifecycle = _classify_lifecycle(last_paid)
 
-    alert = None
-
     if total >= VIP_TOKEN_THRESHOLD:
         alert = {
             "level": "whale",
@@ -59,7 +253,7 @@ async def check_vip(sb, account_id: str, user_name: str) -> dict | None:
             "lifecycle": lifecycle,
             "alert_message": f"🐋 太客入室: {user_name} (累計{total}tk, {lifecycle})",
         }
-    elif level >= VIP_LEVEL_THRESHOLD:
+    else:
         alert = {
             "level": "high_level",
             "total_tokens": total,
@@ -69,17 +263,21 @@ async def check_vip(sb, account_id: str, user_name: str) -> dict | None:
             "alert_message": f"⭐ 高レベル入室: {user_name} (Lv.{level})",
         }
 
-    if alert:
-        _recent_alerts[cache_key] = now
-        # Clean old entries
-        cutoff = now - timedelta(minutes=DEDUP_MINUTES * 2)
-        expired = [k for k, v in _recent_alerts.items() if v < cutoff]
-        for k in expired:
-            del _recent_alerts[k]
-
+    _recent_alerts.add(cache_key)
     return alert
 
 
+async def check_vip(sb, account_id: str, user_name: str) -> dict | None:
+    """Check if user is VIP. Returns alert dict or None.
+
+    初回（または TTL 経過後）のみ paid_users を読み込み、以降は evaluate_vip と同じ。
+    """
+    if not user_name:
+        return None
+    await get_vip_index(sb, account_id)
+    return evaluate_vip(account_id, user_name)
+
+
 def _classify_lifecycle(last_paid: str | None) -> str:
     """Classify user lifecycle stage based on last payment date"""
     if not last_paid:
@@ -131,3 +329,15 @@ def classify_comment(message: str | None, msg_type: str, tokens: int) -> dict:
         result["priority"] = 1
 
     return result
+
+
+def pickup_columns(classification: dict) -> dict:
+    """classify_comment の結果から spy_messages のピックアップ用列を作る
+
+    /pickup はこの列の部分インデックスで引くので、取り込み経路ごとに必ず付与すること。
+    """
+    return {
+        "is_whale": bool(classification.get("is_whale")),
+        "is_gift": bool(classification.get("is_gift")),
+        "is_question": bool(classification.get("is_question")),
+    }
@@ -0,0 +1,33 @@
+-- アカウントコンテキスト取得RPC
+-- 所有権チェック + cast_usernames + coin_rate + プラン上限を1往復で返す
+-- （APIの各ルーターで accounts を2〜3回引いていたのを1回に集約）
+ALTER TABLE public.accounts ADD COLUMN IF NOT EXISTS coin_rate NUMERIC DEFAULT 7.7;
+
+CREATE OR REPLACE FUNCTION get_account_context(
+  p_account_id UUID,
+  p_user_id UUID
+)
+RETURNS TABLE(
+  account_id UUID,
+  account_name TEXT,
+  cast_usernames JSONB,
+  coin_rate NUMERIC,
+  plan TEXT,
+  max_casts INTEGER,
+  max_dm_per_month INTEGER,
+  max_ai_per_month INTEGER
+) AS $$
+  SELECT
+    a.id,
+    a.account_name,
+    COALESCE(a.cast_usernames, '[]'::jsonb),
+    COALESCE(a.coin_rate, 7.7),
+    COALESCE(p.plan, 'free'),
+    COALESCE(p.max_casts, 1),
+    COALESCE(p.max_dm_per_month, 10),
+    COALESCE(p.max_ai_per_month, 0)
+  FROM public.accounts a
+  LEFT JOIN public.profiles p ON p.id = a.user_id
+  WHERE a.id = p_account_id
+    AND a.user_id = p_user_id;
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
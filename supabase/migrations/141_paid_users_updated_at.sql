@@ -0,0 +1,17 @@
+-- paid_users.updated_at を UPDATE/UPSERT 時に自動更新
+-- API・collector の VIP 索引が updated_at > 前回同期時刻 の差分だけを取り込めるようにする
+CREATE OR REPLACE FUNCTION public.touch_paid_users_updated_at()
+RETURNS TRIGGER AS $$
+BEGIN
+  NEW.updated_at := NOW();
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_paid_users_updated_at ON public.paid_users;
+CREATE TRIGGER trg_paid_users_updated_at
+  BEFORE UPDATE ON public.paid_users
+  FOR EACH ROW EXECUTE FUNCTION public.touch_paid_users_updated_at();
+
+CREATE INDEX IF NOT EXISTS idx_paid_users_account_updated
+  ON public.paid_users (account_id, updated_at);
@@ -0,0 +1,3 @@
+-- spy_messages ライブ配信用: アカウント単位の id 差分取得 (id > last_id ORDER BY id)
+CREATE INDEX IF NOT EXISTS idx_spy_messages_account_id_id
+  ON public.spy_messages (account_id, id);
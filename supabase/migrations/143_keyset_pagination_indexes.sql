@@ -0,0 +1,17 @@
+-- キーセット（カーソル）ページング用の複合インデックス
+-- API は (時刻列 DESC, id DESC) で並べ、カーソル位置より小さいキーを limit 件読む。
+-- 同じ並びのインデックスがあれば何ページ目でも先頭からのスキャンにならない。
+
+-- GET /api/spy/messages（cast_name 指定あり / なし）
+CREATE INDEX IF NOT EXISTS idx_spy_messages_account_time_id
+  ON public.spy_messages (account_id, message_time DESC, id DESC);
+CREATE INDEX IF NOT EXISTS idx_spy_messages_account_cast_time_id
+  ON public.spy_messages (account_id, cast_name, message_time DESC, id DESC);
+
+-- GET /api/dm/log, /api/dm/history
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_account_queued_id
+  ON public.dm_send_log (account_id, queued_at DESC, id DESC);
+
+-- GET /api/spy/sessions
+CREATE INDEX IF NOT EXISTS idx_sessions_account_started_id
+  ON public.sessions (account_id, started_at DESC, id DESC);
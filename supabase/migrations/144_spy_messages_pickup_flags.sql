@@ -0,0 +1,21 @@
+-- コメントピックアップ用の分類フラグを spy_messages の列として保持
+-- これまで metadata->'classification' に入れた値を API 側で最新500件から絞っていたため、
+-- 賑やかな配信では該当コメントが取りこぼされていた。
+-- 取り込み時に列へ書き、キャスト単位の部分インデックスで1クエリで引く。
+ALTER TABLE public.spy_messages ADD COLUMN IF NOT EXISTS is_whale BOOLEAN NOT NULL DEFAULT false;
+ALTER TABLE public.spy_messages ADD COLUMN IF NOT EXISTS is_gift BOOLEAN NOT NULL DEFAULT false;
+ALTER TABLE public.spy_messages ADD COLUMN IF NOT EXISTS is_question BOOLEAN NOT NULL DEFAULT false;
+
+-- ピックアップの時間窓（最大12時間）をカバーする直近分だけバックフィル
+UPDATE public.spy_messages
+SET is_whale    = COALESCE((metadata->'classification'->>'is_whale')::boolean, false) OR COALESCE(is_vip, false),
+    is_gift     = msg_type IN ('gift', 'tip') OR COALESCE(tokens, 0) > 0,
+    is_question = COALESCE((metadata->'classification'->>'is_question')::boolean, false)
+WHERE message_time >= NOW() - INTERVAL '2 days';
+
+CREATE INDEX IF NOT EXISTS idx_spy_messages_pickup_whale
+  ON public.spy_messages (account_id, cast_name, message_time DESC) WHERE is_whale;
+CREATE INDEX IF NOT EXISTS idx_spy_messages_pickup_gift
+  ON public.spy_messages (account_id, cast_name, message_time DESC) WHERE is_gift;
+CREATE INDEX IF NOT EXISTS idx_spy_messages_pickup_question
+  ON public.spy_messages (account_id, cast_name, message_time DESC) WHERE is_question;
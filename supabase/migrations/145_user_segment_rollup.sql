@@ -0,0 +1,201 @@
+-- ファネル分析用のユーザーセグメントを差分更新で保持
+-- funnel_segments / funnel_leads は毎回 paying_users 全行 + spy_messages 直近2000件を読み、
+-- 活発な配信ではリードが切り捨てられていた（paying_users には cast_name も無い）。
+--
+-- user_segment_members: (account, cast, user) ごとの累計。cast_name = '' はアカウント全体
+-- user_segment_rollup : (account, cast, segment) ごとの人数・tk合計
+-- どちらも coin_transactions / spy_messages へのINSERTをトリガーで反映する（書き込み元を問わない）。
+
+CREATE TABLE IF NOT EXISTS public.user_segment_members (
+  account_id UUID NOT NULL REFERENCES public.accounts(id) ON DELETE CASCADE,
+  cast_name TEXT NOT NULL DEFAULT '',
+  user_name TEXT NOT NULL,
+  total_tokens BIGINT NOT NULL DEFAULT 0,
+  tx_count INTEGER NOT NULL DEFAULT 0,
+  first_paid TIMESTAMPTZ,
+  last_paid TIMESTAMPTZ,
+  last_chat_at TIMESTAMPTZ,
+  segment TEXT GENERATED ALWAYS AS (
+    CASE
+      WHEN tx_count <= 0 THEN 'lead'
+      WHEN total_tokens >= 1000 THEN 'whale'
+      WHEN total_tokens >= 100 THEN 'regular'
+      WHEN total_tokens >= 10 THEN 'light'
+      ELSE 'free'
+    END
+  ) STORED,
+  segment_rank SMALLINT GENERATED ALWAYS AS (
+    CASE
+      WHEN tx_count <= 0 THEN 4
+      WHEN total_tokens >= 1000 THEN 0
+      WHEN total_tokens >= 100 THEN 1
+      WHEN total_tokens >= 10 THEN 2
+      ELSE 3
+    END
+  ) STORED,
+  PRIMARY KEY (account_id, cast_name, user_name)
+);
+
+CREATE INDEX IF NOT EXISTS idx_user_segment_members_rank
+  ON public.user_segment_members (account_id, cast_name, segment_rank, total_tokens DESC);
+CREATE INDEX IF NOT EXISTS idx_user_segment_members_leads
+  ON public.user_segment_members (account_id, cast_name, last_chat_at DESC) WHERE tx_count <= 0;
+
+CREATE TABLE IF NOT EXISTS public.user_segment_rollup (
+  account_id UUID NOT NULL REFERENCES public.accounts(id) ON DELETE CASCADE,
+  cast_name TEXT NOT NULL DEFAULT '',
+  segment TEXT NOT NULL,
+  user_count BIGINT NOT NULL DEFAULT 0,
+  total_tokens BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (account_id, cast_name, segment)
+);
+
+ALTER TABLE public.user_segment_members ENABLE ROW LEVEL SECURITY;
+ALTER TABLE public.user_segment_rollup ENABLE ROW LEVEL SECURITY;
+
+-- ─── members の変化を rollup に反映（旧セグメントから引いて新セグメントに足す） ───
+CREATE OR REPLACE FUNCTION public.apply_user_segment_rollup()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    UPDATE public.user_segment_rollup
+    SET user_count = user_count - 1,
+        total_tokens = total_tokens - OLD.total_tokens
+    WHERE account_id = OLD.account_id AND cast_name = OLD.cast_name AND segment = OLD.segment;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO public.user_segment_rollup (account_id, cast_name, segment, user_count, total_tokens)
+    VALUES (NEW.account_id, NEW.cast_name, NEW.segment, 1, NEW.total_tokens)
+    ON CONFLICT (account_id, cast_name, segment) DO UPDATE
+    SET user_count = user_segment_rollup.user_count + 1,
+        total_tokens = user_segment_rollup.total_tokens + EXCLUDED.total_tokens;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_user_segment_rollup ON public.user_segment_members;
+CREATE TRIGGER trg_user_segment_rollup
+  AFTER INSERT OR DELETE OR UPDATE OF total_tokens, tx_count ON public.user_segment_members
+  FOR EACH ROW EXECUTE FUNCTION public.apply_user_segment_rollup();
+
+-- ─── coin_transactions → members（ステートメント単位で集約して1回のUPSERT） ───
+CREATE OR REPLACE FUNCTION public.apply_coin_segment_delta()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO public.user_segment_members AS m
+      (account_id, cast_name, user_name, total_tokens, tx_count)
+    SELECT o.account_id, k.cast_key, o.user_name, -SUM(o.tokens), -COUNT(*)
+    FROM old_rows o
+    CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                        FROM (VALUES (COALESCE(o.cast_name, '')), ('')) v(cast_key)) k
+    GROUP BY o.account_id, k.cast_key, o.user_name
+    ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+    SET total_tokens = m.total_tokens + EXCLUDED.total_tokens,
+        tx_count = m.tx_count + EXCLUDED.tx_count;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO public.user_segment_members AS m
+      (account_id, cast_name, user_name, total_tokens, tx_count, first_paid, last_paid)
+    SELECT n.account_id, k.cast_key, n.user_name, SUM(n.tokens), COUNT(*), MIN(n.date), MAX(n.date)
+    FROM new_rows n
+    CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                        FROM (VALUES (COALESCE(n.cast_name, '')), ('')) v(cast_key)) k
+    GROUP BY n.account_id, k.cast_key, n.user_name
+    ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+    SET total_tokens = m.total_tokens + EXCLUDED.total_tokens,
+        tx_count = m.tx_count + EXCLUDED.tx_count,
+        first_paid = LEAST(m.first_paid, EXCLUDED.first_paid),
+        last_paid = GREATEST(m.last_paid, EXCLUDED.last_paid);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_coin_segment_insert ON public.coin_transactions;
+CREATE TRIGGER trg_coin_segment_insert
+  AFTER INSERT ON public.coin_transactions
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_segment_delta();
+
+DROP TRIGGER IF EXISTS trg_coin_segment_update ON public.coin_transactions;
+CREATE TRIGGER trg_coin_segment_update
+  AFTER UPDATE ON public.coin_transactions
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_segment_delta();
+
+DROP TRIGGER IF EXISTS trg_coin_segment_delete ON public.coin_transactions;
+CREATE TRIGGER trg_coin_segment_delete
+  AFTER DELETE ON public.coin_transactions
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_segment_delta();
+
+-- ─── spy_messages のチャット → members.last_chat_at ───
+CREATE OR REPLACE FUNCTION public.apply_chat_segment_delta()
+RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO public.user_segment_members AS m (account_id, cast_name, user_name, last_chat_at)
+  SELECT n.account_id, k.cast_key, n.user_name, MAX(n.message_time)
+  FROM new_rows n
+  CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                      FROM (VALUES (COALESCE(n.cast_name, '')), ('')) v(cast_key)) k
+  WHERE n.msg_type = 'chat' AND n.user_name IS NOT NULL AND n.account_id IS NOT NULL
+  GROUP BY n.account_id, k.cast_key, n.user_name
+  ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+  SET last_chat_at = GREATEST(m.last_chat_at, EXCLUDED.last_chat_at)
+  WHERE m.last_chat_at IS NULL OR m.last_chat_at < EXCLUDED.last_chat_at;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_spy_chat_segment ON public.spy_messages;
+CREATE TRIGGER trg_spy_chat_segment
+  AFTER INSERT ON public.spy_messages
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_chat_segment_delta();
+
+-- ─── 初期データ（課金は全期間、チャットは funnel の最大窓 90日） ───
+-- rollup は members のトリガーで同時に埋まる
+INSERT INTO public.user_segment_members
+  (account_id, cast_name, user_name, total_tokens, tx_count, first_paid, last_paid)
+SELECT c.account_id, k.cast_key, c.user_name, SUM(c.tokens), COUNT(*), MIN(c.date), MAX(c.date)
+FROM public.coin_transactions c
+CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                    FROM (VALUES (COALESCE(c.cast_name, '')), ('')) v(cast_key)) k
+GROUP BY c.account_id, k.cast_key, c.user_name
+ON CONFLICT (account_id, cast_name, user_name) DO NOTHING;
+
+INSERT INTO public.user_segment_members AS m (account_id, cast_name, user_name, last_chat_at)
+SELECT s.account_id, k.cast_key, s.user_name, MAX(s.message_time)
+FROM public.spy_messages s
+CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                    FROM (VALUES (COALESCE(s.cast_name, '')), ('')) v(cast_key)) k
+WHERE s.msg_type = 'chat' AND s.user_name IS NOT NULL AND s.account_id IS NOT NULL
+  AND s.message_time >= NOW() - INTERVAL '90 days'
+GROUP BY s.account_id, k.cast_key, s.user_name
+ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+SET last_chat_at = GREATEST(m.last_chat_at, EXCLUDED.last_chat_at);
+
+-- ─── 読み出しRPC: セグメント別人数・tk合計（lead は期間内チャット・キャスト除外） ───
+CREATE OR REPLACE FUNCTION get_funnel_segments(
+  p_account_id UUID,
+  p_cast_name TEXT DEFAULT NULL,
+  p_since TIMESTAMPTZ DEFAULT NOW() - INTERVAL '30 days',
+  p_exclude_users TEXT[] DEFAULT '{}'
+)
+RETURNS TABLE(segment TEXT, user_count BIGINT, total_tokens BIGINT) AS $$
+  SELECT r.segment, r.user_count, r.total_tokens
+  FROM public.user_segment_rollup r
+  WHERE r.account_id = p_account_id
+    AND r.cast_name = COALESCE(p_cast_name, '')
+    AND r.segment <> 'lead'
+  UNION ALL
+  SELECT 'lead', COUNT(*), 0
+  FROM public.user_segment_members m
+  WHERE m.account_id = p_account_id
+    AND m.cast_name = COALESCE(p_cast_name, '')
+    AND m.tx_count <= 0
+    AND m.last_chat_at >= p_since
+    AND m.user_name <> ALL(p_exclude_users);
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
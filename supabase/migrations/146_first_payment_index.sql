@@ -0,0 +1,83 @@
+-- 初課金インデックス
+-- user_segment_members（145、coin_transactions のトリガーで差分更新）の first_paid を
+-- 範囲検索できるようにし、「X以降に初課金 & N tk以上」を履歴の量に依らず引く。
+-- first_paid >= X のユーザーは全取引が X 以降なので total_tokens がそのまま期間内合計になる。
+CREATE INDEX IF NOT EXISTS idx_user_segment_members_first_paid
+  ON public.user_segment_members (account_id, cast_name, first_paid DESC)
+  INCLUDE (total_tokens)
+  WHERE tx_count > 0;
+
+-- 新規判定の「過去に取引があるか」を coin_transactions の相関サブクエリから初課金日の比較に置換
+CREATE OR REPLACE FUNCTION detect_new_paying_users(
+  p_account_id UUID,
+  p_cast_name TEXT,
+  p_since TIMESTAMPTZ DEFAULT NOW() - INTERVAL '24 hours'
+)
+RETURNS TABLE (
+  user_name TEXT,
+  total_coins BIGINT,
+  tx_count BIGINT,
+  first_payment TIMESTAMPTZ,
+  is_completely_new BOOLEAN
+)
+AS $$
+BEGIN
+  RETURN QUERY
+  SELECT
+    ct.user_name,
+    COALESCE(SUM(ct.tokens), 0)::BIGINT AS total_coins,
+    COUNT(*)::BIGINT AS tx_count,
+    MIN(ct.date) AS first_payment,
+    COALESCE(MIN(m.first_paid) >= p_since, true) AS is_completely_new
+  FROM coin_transactions ct
+  LEFT JOIN user_segment_members m
+    ON m.account_id = p_account_id
+   AND m.cast_name = COALESCE(p_cast_name, '')
+   AND m.user_name = ct.user_name
+  WHERE ct.account_id = p_account_id
+    AND ct.cast_name = p_cast_name
+    AND ct.synced_at >= p_since
+    AND ct.tokens > 0
+  GROUP BY ct.user_name
+  ORDER BY total_coins DESC;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+CREATE OR REPLACE FUNCTION public.get_new_users_by_session(
+  p_account_id UUID,
+  p_cast_name TEXT,
+  p_session_date DATE
+)
+RETURNS TABLE (
+  user_name TEXT,
+  total_tokens_on_date BIGINT,
+  transaction_count INTEGER,
+  types TEXT[],
+  has_prior_history BOOLEAN
+)
+LANGUAGE plpgsql
+SECURITY DEFINER
+AS $$
+BEGIN
+  RETURN QUERY
+  SELECT
+    ct.user_name,
+    COALESCE(SUM(ct.tokens), 0)::BIGINT AS total_tokens_on_date,
+    COUNT(*)::INTEGER AS transaction_count,
+    ARRAY_AGG(DISTINCT ct.type) AS types,
+    -- 過去履歴あり = 同キャストの初課金日がこの日より前
+    COALESCE(MIN(m.first_paid)::date < p_session_date, false) AS has_prior_history
+  FROM public.coin_transactions ct
+  LEFT JOIN public.user_segment_members m
+    ON m.account_id = p_account_id
+   AND m.cast_name = COALESCE(p_cast_name, '')
+   AND m.user_name = ct.user_name
+  WHERE ct.account_id = p_account_id
+    AND ct.cast_name = p_cast_name
+    AND ct.date >= p_session_date::timestamptz
+    AND ct.date < (p_session_date + 1)::timestamptz
+    AND ct.tokens > 0
+  GROUP BY ct.user_name
+  ORDER BY total_tokens_on_date DESC;
+END;
+$$;
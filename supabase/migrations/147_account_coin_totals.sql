@@ -0,0 +1,143 @@
+-- アカウント単位のコイン累計と LTV ティア分布を差分更新で保持
+-- sync status の合計コインは coin_transactions.tokens 全行、LTV分布は paying_users 全行を
+-- APIに読み込んで集計していた（PostgREST の行数上限で頭打ちにもなる）。
+-- coin_transactions は直接、LTV ティアは user_segment_members（cast_name = '' のアカウント全体行）の
+-- 変化をトリガーで反映し、読み出しは1行で済ませる。
+
+CREATE TABLE IF NOT EXISTS public.account_coin_totals (
+  account_id UUID PRIMARY KEY REFERENCES public.accounts(id) ON DELETE CASCADE,
+  total_coins BIGINT NOT NULL DEFAULT 0,
+  tx_count BIGINT NOT NULL DEFAULT 0,
+  -- 0-99 / 100-499 / 500-999 / 1000-4999 / 5000-9999 / 10000+ の人数
+  ltv_tiers BIGINT[] NOT NULL DEFAULT '{0,0,0,0,0,0}',
+  updated_at TIMESTAMPTZ DEFAULT NOW()
+);
+
+ALTER TABLE public.account_coin_totals ENABLE ROW LEVEL SECURITY;
+
+CREATE OR REPLACE FUNCTION public.ltv_tier(p_tokens BIGINT)
+RETURNS INTEGER AS $$
+  SELECT CASE
+    WHEN p_tokens < 100 THEN 1
+    WHEN p_tokens < 500 THEN 2
+    WHEN p_tokens < 1000 THEN 3
+    WHEN p_tokens < 5000 THEN 4
+    WHEN p_tokens < 10000 THEN 5
+    ELSE 6
+  END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- ─── coin_transactions → total_coins / tx_count ───
+CREATE OR REPLACE FUNCTION public.apply_coin_account_totals()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO public.account_coin_totals AS t (account_id, total_coins, tx_count)
+    SELECT account_id, -SUM(tokens), -COUNT(*) FROM old_rows GROUP BY account_id
+    ON CONFLICT (account_id) DO UPDATE
+    SET total_coins = t.total_coins + EXCLUDED.total_coins,
+        tx_count = t.tx_count + EXCLUDED.tx_count,
+        updated_at = NOW();
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO public.account_coin_totals AS t (account_id, total_coins, tx_count)
+    SELECT account_id, SUM(tokens), COUNT(*) FROM new_rows GROUP BY account_id
+    ON CONFLICT (account_id) DO UPDATE
+    SET total_coins = t.total_coins + EXCLUDED.total_coins,
+        tx_count = t.tx_count + EXCLUDED.tx_count,
+        updated_at = NOW();
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_coin_totals_insert ON public.coin_transactions;
+CREATE TRIGGER trg_coin_totals_insert
+  AFTER INSERT ON public.coin_transactions
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_account_totals();
+
+DROP TRIGGER IF EXISTS trg_coin_totals_update ON public.coin_transactions;
+CREATE TRIGGER trg_coin_totals_update
+  AFTER UPDATE ON public.coin_transactions
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_account_totals();
+
+DROP TRIGGER IF EXISTS trg_coin_totals_delete ON public.coin_transactions;
+CREATE TRIGGER trg_coin_totals_delete
+  AFTER DELETE ON public.coin_transactions
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_account_totals();
+
+-- ─── user_segment_members（アカウント全体行）→ ltv_tiers ───
+CREATE OR REPLACE FUNCTION public.apply_ltv_tier_delta()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_account UUID;
+  v_old_tier INTEGER;
+  v_new_tier INTEGER;
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    v_account := OLD.account_id;
+    IF OLD.cast_name = '' AND OLD.tx_count > 0 THEN
+      v_old_tier := public.ltv_tier(OLD.total_tokens);
+    END IF;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    v_account := NEW.account_id;
+    IF NEW.cast_name = '' AND NEW.tx_count > 0 THEN
+      v_new_tier := public.ltv_tier(NEW.total_tokens);
+    END IF;
+  END IF;
+
+  IF v_old_tier IS NOT DISTINCT FROM v_new_tier THEN
+    RETURN NULL;
+  END IF;
+
+  INSERT INTO public.account_coin_totals (account_id) VALUES (v_account)
+  ON CONFLICT (account_id) DO NOTHING;
+  IF v_old_tier IS NOT NULL THEN
+    UPDATE public.account_coin_totals
+    SET ltv_tiers[v_old_tier] = ltv_tiers[v_old_tier] - 1, updated_at = NOW()
+    WHERE account_id = v_account;
+  END IF;
+  IF v_new_tier IS NOT NULL THEN
+    UPDATE public.account_coin_totals
+    SET ltv_tiers[v_new_tier] = ltv_tiers[v_new_tier] + 1, updated_at = NOW()
+    WHERE account_id = v_account;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_ltv_tier_delta ON public.user_segment_members;
+CREATE TRIGGER trg_ltv_tier_delta
+  AFTER INSERT OR DELETE OR UPDATE OF total_tokens, tx_count ON public.user_segment_members
+  FOR EACH ROW EXECUTE FUNCTION public.apply_ltv_tier_delta();
+
+-- ─── 初期データ ───
+INSERT INTO public.account_coin_totals (account_id, total_coins, tx_count)
+SELECT account_id, SUM(tokens), COUNT(*)
+FROM public.coin_transactions
+GROUP BY account_id
+ON CONFLICT (account_id) DO UPDATE
+SET total_coins = EXCLUDED.total_coins,
+    tx_count = EXCLUDED.tx_count,
+    updated_at = NOW();
+
+UPDATE public.account_coin_totals t
+SET ltv_tiers = h.tiers, updated_at = NOW()
+FROM (
+  SELECT account_id, ARRAY[
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 1),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 2),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 3),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 4),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 5),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 6)
+  ] AS tiers
+  FROM public.user_segment_members
+  WHERE cast_name = '' AND tx_count > 0
+  GROUP BY account_id
+) h
+WHERE t.account_id = h.account_id;
@@ -0,0 +1,82 @@
+-- DMキューのリース方式での取得
+-- Chrome拡張は GET /api/dm/queue で status='queued' を読んでから送信していたため、
+-- 複数タブ・複数ブラウザが同じ行を取得して二重送信し得た。
+-- claim_dm_queue が FOR UPDATE SKIP LOCKED で行をロックしつつ 'sending' + リース期限に更新し、
+-- 期限切れのリースは次の claim で自動的にキューへ戻る。
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS lease_owner TEXT;
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS lease_expires_at TIMESTAMPTZ;
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS attempts INTEGER NOT NULL DEFAULT 0;
+
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_queued
+  ON public.dm_send_log (account_id, queued_at) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_leases
+  ON public.dm_send_log (account_id, lease_expires_at) WHERE status = 'sending';
+
+-- ─── N件をワーカーにリース ───
+CREATE OR REPLACE FUNCTION claim_dm_queue(
+  p_account_id UUID,
+  p_worker_id TEXT,
+  p_limit INTEGER DEFAULT 10,
+  p_lease_seconds INTEGER DEFAULT 300,
+  p_max_attempts INTEGER DEFAULT 3
+)
+RETURNS SETOF public.dm_send_log AS $$
+BEGIN
+  -- 試行回数を使い切った期限切れリースはエラーで確定（無限に再送しない）
+  UPDATE public.dm_send_log
+  SET status = 'error',
+      error = COALESCE(error, 'lease expired'),
+      lease_owner = NULL,
+      lease_expires_at = NULL
+  WHERE account_id = p_account_id
+    AND status = 'sending'
+    AND lease_expires_at < NOW()
+    AND attempts >= p_max_attempts;
+
+  RETURN QUERY
+  WITH candidates AS (
+    SELECT d.id
+    FROM public.dm_send_log d
+    WHERE d.account_id = p_account_id
+      AND (d.status = 'queued'
+           OR (d.status = 'sending' AND d.lease_expires_at < NOW()))
+    ORDER BY d.queued_at, d.id
+    LIMIT p_limit
+    FOR UPDATE SKIP LOCKED
+  )
+  UPDATE public.dm_send_log d
+  SET status = 'sending',
+      lease_owner = p_worker_id,
+      lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+      attempts = d.attempts + 1
+  FROM candidates c
+  WHERE d.id = c.id
+  RETURNING d.*;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- ─── 送信結果の一括確定 ───
+-- p_results: [{"id": 1, "status": "success"|"error"|"sending", "error": "...", "sent_at": "..."}]
+-- status = 'sending' はリース延長（ハートビート）。リースを持つワーカーの結果だけ反映する。
+CREATE OR REPLACE FUNCTION ack_dm_queue(
+  p_account_id UUID,
+  p_worker_id TEXT,
+  p_results JSONB,
+  p_lease_seconds INTEGER DEFAULT 300
+)
+RETURNS TABLE(ack_id BIGINT, ack_status TEXT) AS $$
+  UPDATE public.dm_send_log d
+  SET status = r.status,
+      error = CASE WHEN r.status = 'error' THEN r.error ELSE d.error END,
+      sent_at = CASE WHEN r.status = 'success' THEN COALESCE(r.sent_at, NOW()) ELSE d.sent_at END,
+      lease_owner = CASE WHEN r.status = 'sending' THEN d.lease_owner END,
+      lease_expires_at = CASE WHEN r.status = 'sending'
+                              THEN NOW() + make_interval(secs => p_lease_seconds) END
+  FROM jsonb_to_recordset(p_results) AS r(id BIGINT, status TEXT, error TEXT, sent_at TIMESTAMPTZ)
+  WHERE d.id = r.id
+    AND d.account_id = p_account_id
+    AND d.status = 'sending'
+    AND d.lease_owner = p_worker_id
+    AND r.status IN ('success', 'error', 'sending')
+  RETURNING d.id, d.status;
+$$ LANGUAGE sql SECURITY DEFINER;
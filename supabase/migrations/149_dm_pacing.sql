@@ -0,0 +1,101 @@
+-- DM送信ペーシング（サーバー側）
+-- キュー登録時に dm_pacing が not_before（送信可能時刻）と priority を付与し、
+-- claim_dm_queue は期限の来た行だけを、アカウントの送信レート上限・静音時間帯の範囲で配る。
+-- 送信間隔の管理を拡張機能任せにしないことで、大きなキャンペーンでもバーストせず上限速度で消化する。
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS not_before TIMESTAMPTZ;
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS priority SMALLINT NOT NULL DEFAULT 0;
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS claimed_at TIMESTAMPTZ;
+
+-- アカウント別のペーシング設定（静音時間帯は JST の時。start > end なら日跨ぎ）
+ALTER TABLE public.accounts ADD COLUMN IF NOT EXISTS dm_rate_per_minute INTEGER NOT NULL DEFAULT 6;
+ALTER TABLE public.accounts ADD COLUMN IF NOT EXISTS dm_quiet_hours_start SMALLINT;
+ALTER TABLE public.accounts ADD COLUMN IF NOT EXISTS dm_quiet_hours_end SMALLINT;
+
+DROP INDEX IF EXISTS idx_dm_send_log_queued;
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_queued
+  ON public.dm_send_log (account_id, priority DESC, not_before) WHERE status = 'queued';
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_claimed
+  ON public.dm_send_log (account_id, claimed_at) WHERE claimed_at IS NOT NULL;
+
+CREATE OR REPLACE FUNCTION dm_in_quiet_hours(p_start SMALLINT, p_end SMALLINT, p_at TIMESTAMPTZ)
+RETURNS BOOLEAN AS $$
+  SELECT CASE
+    WHEN p_start IS NULL OR p_end IS NULL OR p_start = p_end THEN false
+    WHEN p_start < p_end THEN EXTRACT(HOUR FROM p_at AT TIME ZONE 'Asia/Tokyo') >= p_start
+                          AND EXTRACT(HOUR FROM p_at AT TIME ZONE 'Asia/Tokyo') < p_end
+    ELSE EXTRACT(HOUR FROM p_at AT TIME ZONE 'Asia/Tokyo') >= p_start
+      OR EXTRACT(HOUR FROM p_at AT TIME ZONE 'Asia/Tokyo') < p_end
+  END;
+$$ LANGUAGE sql IMMUTABLE;
+
+-- ─── claim_dm_queue（148）にペーシングを追加 ───
+CREATE OR REPLACE FUNCTION claim_dm_queue(
+  p_account_id UUID,
+  p_worker_id TEXT,
+  p_limit INTEGER DEFAULT 10,
+  p_lease_seconds INTEGER DEFAULT 300,
+  p_max_attempts INTEGER DEFAULT 3
+)
+RETURNS SETOF public.dm_send_log AS $$
+DECLARE
+  v_rate INTEGER;
+  v_quiet_start SMALLINT;
+  v_quiet_end SMALLINT;
+  v_recent INTEGER;
+  v_budget INTEGER;
+BEGIN
+  -- 同一アカウントの claim を直列化（同時 claim でレート上限を二重に使わない）
+  PERFORM pg_advisory_xact_lock(hashtext('claim_dm_queue:' || p_account_id::text));
+
+  SELECT COALESCE(a.dm_rate_per_minute, 6), a.dm_quiet_hours_start, a.dm_quiet_hours_end
+  INTO v_rate, v_quiet_start, v_quiet_end
+  FROM public.accounts a
+  WHERE a.id = p_account_id;
+
+  IF dm_in_quiet_hours(v_quiet_start, v_quiet_end, NOW()) THEN
+    RETURN;
+  END IF;
+
+  -- 試行回数を使い切った期限切れリースはエラーで確定（無限に再送しない）
+  UPDATE public.dm_send_log
+  SET status = 'error',
+      error = COALESCE(error, 'lease expired'),
+      lease_owner = NULL,
+      lease_expires_at = NULL
+  WHERE account_id = p_account_id
+    AND status = 'sending'
+    AND lease_expires_at < NOW()
+    AND attempts >= p_max_attempts;
+
+  -- 直近1分に配った件数だけレート枠を消費済みとみなす
+  SELECT COUNT(*) INTO v_recent
+  FROM public.dm_send_log
+  WHERE account_id = p_account_id
+    AND claimed_at > NOW() - INTERVAL '1 minute';
+  v_budget := LEAST(p_limit, GREATEST(COALESCE(v_rate, 6) - v_recent, 0));
+  IF v_budget <= 0 THEN
+    RETURN;
+  END IF;
+
+  RETURN QUERY
+  WITH candidates AS (
+    SELECT d.id
+    FROM public.dm_send_log d
+    WHERE d.account_id = p_account_id
+      AND ((d.status = 'queued' AND (d.not_before IS NULL OR d.not_before <= NOW()))
+           OR (d.status = 'sending' AND d.lease_expires_at < NOW()))
+    ORDER BY d.priority DESC, COALESCE(d.not_before, d.queued_at), d.id
+    LIMIT v_budget
+    FOR UPDATE SKIP LOCKED
+  )
+  UPDATE public.dm_send_log d
+  SET status = 'sending',
+      lease_owner = p_worker_id,
+      lease_expires_at = NOW() + make_interval(secs => p_lease_seconds),
+      claimed_at = NOW(),
+      attempts = d.attempts + 1
+  FROM candidates c
+  WHERE d.id = c.id
+  RETURNING d.*;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
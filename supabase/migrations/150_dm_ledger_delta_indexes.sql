@@ -0,0 +1,10 @@
+-- DM trigger ledger（backend/services/dm_trigger_ledger.py）の差分読み込み用インデックス
+-- 台帳は起動後の初回だけログから構築し、以降は id が透かしより大きい行だけを読む。
+-- 既存インデックスは fired_at / queued_at 順なので、id 範囲の読み込みを直接引けるようにする。
+
+CREATE INDEX IF NOT EXISTS idx_dm_trigger_logs_trigger_id_fired
+  ON public.dm_trigger_logs (trigger_id, id)
+  WHERE action_taken IN ('dm_queued', 'scenario_enrolled');
+
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_account_id
+  ON public.dm_send_log (account_id, id);
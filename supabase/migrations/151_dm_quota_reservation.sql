@@ -0,0 +1,34 @@
+-- DM月間使用量の原子的な予約
+-- create_dm_batch / thank_dm は profiles.dm_used_this_month を読んで +N した値を書き戻しており、
+-- 同時に走ったバッチの加算が失われていた（上限も読んだ時点の残数で判定していた）。
+-- reserve_dm_quota が1文の UPDATE で残数の範囲内だけ加算し、実際に確保できた件数を返す。
+-- 重複除外・INSERT失敗で使わなかった分は release_dm_quota で戻す。
+
+CREATE OR REPLACE FUNCTION reserve_dm_quota(
+  p_user_id UUID,
+  p_requested INTEGER
+)
+RETURNS INTEGER AS $$
+  WITH quota AS (
+    SELECT id,
+           GREATEST(LEAST(p_requested, COALESCE(max_dm_per_month, 500) - COALESCE(dm_used_this_month, 0)), 0) AS granted
+    FROM public.profiles
+    WHERE id = p_user_id
+    FOR UPDATE
+  )
+  UPDATE public.profiles p
+  SET dm_used_this_month = COALESCE(p.dm_used_this_month, 0) + c.granted
+  FROM quota c
+  WHERE p.id = c.id
+  RETURNING c.granted;
+$$ LANGUAGE sql;
+
+CREATE OR REPLACE FUNCTION release_dm_quota(
+  p_user_id UUID,
+  p_count INTEGER
+)
+RETURNS VOID AS $$
+  UPDATE public.profiles
+  SET dm_used_this_month = GREATEST(COALESCE(dm_used_this_month, 0) - p_count, 0)
+  WHERE id = p_user_id AND p_count > 0;
+$$ LANGUAGE sql;
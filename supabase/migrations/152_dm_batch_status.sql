@@ -0,0 +1,71 @@
+-- DMバッチ進捗の集計と差分フィード
+-- GET /api/dm/status/{batch_id} はバッチの全行を select * で読み、Python で件数を数えて
+-- 全行をそのまま返していた。送信中はUIがポーリングするため、5,000件のバッチで毎回数MBになる。
+-- ここでは
+--   - 件数は (account_id, campaign, status) のインデックスだけで GROUP BY する
+--   - 行はステータスが変わるたびに採番する status_seq の透かしより後ろだけを返す
+-- ようにして、1回のポーリングで読む行数をバッチの大きさに依らず一定にする。
+
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS status_seq BIGINT;
+
+CREATE SEQUENCE IF NOT EXISTS public.dm_send_log_status_seq;
+
+-- 既存行は id をそのまま使い、シーケンスをその後ろから始める
+UPDATE public.dm_send_log SET status_seq = id WHERE status_seq IS NULL;
+SELECT setval('public.dm_send_log_status_seq',
+              GREATEST((SELECT MAX(id) FROM public.dm_send_log), 1));
+
+CREATE OR REPLACE FUNCTION public.bump_dm_status_seq()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' OR NEW.status IS DISTINCT FROM OLD.status THEN
+    NEW.status_seq := nextval('public.dm_send_log_status_seq');
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_dm_status_seq ON public.dm_send_log;
+CREATE TRIGGER trg_dm_status_seq
+  BEFORE INSERT OR UPDATE OF status ON public.dm_send_log
+  FOR EACH ROW EXECUTE FUNCTION public.bump_dm_status_seq();
+
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_campaign_status
+  ON public.dm_send_log (account_id, campaign, status);
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_campaign_seq
+  ON public.dm_send_log (account_id, campaign, status_seq);
+
+-- ─── 件数 + status_seq > p_since の変更行（最大 p_limit 件）を1往復で ───
+-- 採番はコミット順ではないため、並行トランザクションの行が透かしより手前で後から
+-- 見えることがある（items は進捗表示用。件数は常に正確）。
+CREATE OR REPLACE FUNCTION get_dm_batch_status(
+  p_account_id UUID,
+  p_campaign TEXT,
+  p_since BIGINT DEFAULT 0,
+  p_limit INTEGER DEFAULT 200
+)
+RETURNS JSONB AS $$
+  SELECT jsonb_build_object(
+    'counts', COALESCE((
+      SELECT jsonb_object_agg(status, n)
+      FROM (
+        SELECT status, COUNT(*) AS n
+        FROM public.dm_send_log
+        WHERE account_id = p_account_id AND campaign = p_campaign
+        GROUP BY status
+      ) c
+    ), '{}'::jsonb),
+    'items', COALESCE((
+      SELECT jsonb_agg(to_jsonb(i) ORDER BY i.status_seq)
+      FROM (
+        SELECT id, user_name, cast_name, status, error, queued_at, not_before, sent_at, status_seq
+        FROM public.dm_send_log
+        WHERE account_id = p_account_id
+          AND campaign = p_campaign
+          AND status_seq > p_since
+        ORDER BY status_seq
+        LIMIT p_limit
+      ) i
+    ), '[]'::jsonb)
+  );
+$$ LANGUAGE sql STABLE;
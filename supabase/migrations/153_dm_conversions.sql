@@ -0,0 +1,329 @@
+-- DM→課金のコンバージョン帰属を差分更新で保持
+-- dm_timeline は期間内の dm_send_log / coin_transactions を全行ダウンロードし、Python で
+-- 日別ユーザー集合を 0〜7日後の8通りで突き合わせていた（複数日に課金したユーザーを多重計上）。
+-- dm_effectiveness（125で削除済み）/ get_dm_campaign_cvr も呼び出しのたびに全DM×全課金を JOIN していた。
+--
+-- dm_conversions: 課金1件（coin_transactions.id）ごとに、直前30日以内で
+-- 最も新しい送信成功DMを1件だけ紐付ける（ラストタッチ）。課金と同じキャストのDMを優先し、
+-- 無ければ他キャストのDMに帰属する。
+--   - coin_transactions の INSERT / UPDATE をトリガーで反映（書き込み元を問わない）
+--   - DM が success になったときは、その後30日以内の同ユーザーの課金を付け替える
+-- 集計側は「paid_at <= dm_sent_at + 窓」で絞るだけで、30日以内の任意の窓のラストタッチになる。
+
+CREATE TABLE IF NOT EXISTS public.dm_conversions (
+  tx_id BIGINT PRIMARY KEY REFERENCES public.coin_transactions(id) ON DELETE CASCADE,
+  account_id UUID NOT NULL REFERENCES public.accounts(id) ON DELETE CASCADE,
+  user_name TEXT NOT NULL,
+  tx_cast_name TEXT NOT NULL DEFAULT '',
+  tokens INTEGER NOT NULL,
+  paid_at TIMESTAMPTZ NOT NULL,
+  dm_id BIGINT NOT NULL,
+  dm_campaign TEXT NOT NULL DEFAULT '',
+  dm_cast_name TEXT NOT NULL DEFAULT '',
+  dm_queued_at TIMESTAMPTZ NOT NULL,
+  dm_sent_at TIMESTAMPTZ NOT NULL
+);
+
+CREATE INDEX IF NOT EXISTS idx_dm_conversions_day
+  ON public.dm_conversions (account_id, dm_queued_at);
+CREATE INDEX IF NOT EXISTS idx_dm_conversions_campaign
+  ON public.dm_conversions (account_id, dm_campaign, dm_queued_at);
+
+-- 帰属先DMの検索用（account, user ごとに送信成功を新しい順）
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_success_touch
+  ON public.dm_send_log (account_id, user_name, (COALESCE(sent_at, queued_at)) DESC)
+  WHERE status = 'success';
+
+ALTER TABLE public.dm_conversions ENABLE ROW LEVEL SECURITY;
+
+DO $$ BEGIN
+  IF NOT EXISTS (
+    SELECT 1 FROM pg_policies WHERE tablename = 'dm_conversions' AND policyname = 'dm_conversions_account_scope'
+  ) THEN
+    CREATE POLICY dm_conversions_account_scope ON public.dm_conversions
+      FOR SELECT USING (account_id IN (SELECT public.user_account_ids()));
+  END IF;
+END $$;
+
+-- ─── 指定した課金の帰属をやり直す（帰属先が無くなったものは消える） ───
+CREATE OR REPLACE FUNCTION public.attribute_dm_conversions(p_tx_ids BIGINT[])
+RETURNS INTEGER AS $$
+DECLARE
+  v_count INTEGER;
+BEGIN
+  DELETE FROM public.dm_conversions WHERE tx_id = ANY(p_tx_ids);
+
+  INSERT INTO public.dm_conversions AS dc
+    (tx_id, account_id, user_name, tx_cast_name, tokens, paid_at,
+     dm_id, dm_campaign, dm_cast_name, dm_queued_at, dm_sent_at)
+  SELECT ct.id, ct.account_id, ct.user_name, COALESCE(ct.cast_name, ''), ct.tokens, ct.date,
+         d.id, COALESCE(d.campaign, ''), COALESCE(d.cast_name, ''), d.queued_at, d.touched_at
+  FROM public.coin_transactions ct
+  CROSS JOIN LATERAL (
+    SELECT dsl.id, dsl.campaign, dsl.cast_name, dsl.queued_at,
+           COALESCE(dsl.sent_at, dsl.queued_at) AS touched_at
+    FROM public.dm_send_log dsl
+    WHERE dsl.account_id = ct.account_id
+      AND dsl.user_name = ct.user_name
+      AND dsl.status = 'success'
+      AND COALESCE(dsl.sent_at, dsl.queued_at) <= ct.date
+      AND COALESCE(dsl.sent_at, dsl.queued_at) > ct.date - INTERVAL '30 days'
+    ORDER BY (COALESCE(dsl.cast_name, '') = COALESCE(ct.cast_name, '')) DESC,
+             COALESCE(dsl.sent_at, dsl.queued_at) DESC,
+             dsl.id DESC
+    LIMIT 1
+  ) d
+  WHERE ct.id = ANY(p_tx_ids)
+    AND ct.tokens > 0
+  ON CONFLICT (tx_id) DO UPDATE
+  SET dm_id = EXCLUDED.dm_id,
+      dm_campaign = EXCLUDED.dm_campaign,
+      dm_cast_name = EXCLUDED.dm_cast_name,
+      dm_queued_at = EXCLUDED.dm_queued_at,
+      dm_sent_at = EXCLUDED.dm_sent_at;
+
+  GET DIAGNOSTICS v_count = ROW_COUNT;
+  RETURN v_count;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- ─── coin_transactions → dm_conversions（ステートメント単位で1回） ───
+CREATE OR REPLACE FUNCTION public.apply_coin_dm_conversions()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM public.attribute_dm_conversions(ARRAY(SELECT n.id FROM new_rows n));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_coin_dm_conversions_insert ON public.coin_transactions;
+CREATE TRIGGER trg_coin_dm_conversions_insert
+  AFTER INSERT ON public.coin_transactions
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_dm_conversions();
+
+DROP TRIGGER IF EXISTS trg_coin_dm_conversions_update ON public.coin_transactions;
+CREATE TRIGGER trg_coin_dm_conversions_update
+  AFTER UPDATE ON public.coin_transactions
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_coin_dm_conversions();
+
+-- ─── DM が success になった → その後30日以内の同ユーザーの課金を付け替え ───
+CREATE OR REPLACE FUNCTION public.apply_dm_success_conversions()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_touched TIMESTAMPTZ := COALESCE(NEW.sent_at, NEW.queued_at);
+BEGIN
+  PERFORM public.attribute_dm_conversions(ARRAY(
+    SELECT ct.id
+    FROM public.coin_transactions ct
+    WHERE ct.account_id = NEW.account_id
+      AND ct.user_name = NEW.user_name
+      AND ct.date >= v_touched
+      AND ct.date < v_touched + INTERVAL '30 days'
+      AND ct.tokens > 0
+  ));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_dm_success_conversions_insert ON public.dm_send_log;
+CREATE TRIGGER trg_dm_success_conversions_insert
+  AFTER INSERT ON public.dm_send_log
+  FOR EACH ROW WHEN (NEW.status = 'success')
+  EXECUTE FUNCTION public.apply_dm_success_conversions();
+
+DROP TRIGGER IF EXISTS trg_dm_success_conversions_update ON public.dm_send_log;
+CREATE TRIGGER trg_dm_success_conversions_update
+  AFTER UPDATE OF status ON public.dm_send_log
+  FOR EACH ROW WHEN (NEW.status = 'success' AND OLD.status IS DISTINCT FROM 'success')
+  EXECUTE FUNCTION public.apply_dm_success_conversions();
+
+-- ─── 既存データの初期投入（timeline / CVR が参照する直近120日分） ───
+SELECT public.attribute_dm_conversions(ARRAY(
+  SELECT id FROM public.coin_transactions
+  WHERE date >= NOW() - INTERVAL '120 days' AND tokens > 0
+));
+
+
+-- ============================================================
+-- 集計RPC（すべて dm_conversions を読む）
+-- ============================================================
+
+-- ─── 日別 送信・成功・エラー・コンバージョン人数 ───
+CREATE OR REPLACE FUNCTION public.get_dm_timeline(
+  p_account_id UUID,
+  p_days INTEGER DEFAULT 30,
+  p_cast_name TEXT DEFAULT NULL,
+  p_window_days INTEGER DEFAULT 7
+)
+RETURNS TABLE(
+  date TEXT,
+  sent BIGINT,
+  success BIGINT,
+  error BIGINT,
+  converted BIGINT
+) AS $$
+  WITH sent AS (
+    SELECT (d.queued_at AT TIME ZONE 'UTC')::date AS day,
+           COUNT(*) AS sent,
+           COUNT(*) FILTER (WHERE d.status = 'success') AS success,
+           COUNT(*) FILTER (WHERE d.status = 'error') AS error
+    FROM public.dm_send_log d
+    WHERE d.account_id = p_account_id
+      AND d.queued_at >= NOW() - make_interval(days => p_days)
+      AND (p_cast_name IS NULL OR d.cast_name = p_cast_name)
+    GROUP BY 1
+  ),
+  conv AS (
+    SELECT (c.dm_queued_at AT TIME ZONE 'UTC')::date AS day,
+           COUNT(DISTINCT c.user_name) AS converted
+    FROM public.dm_conversions c
+    WHERE c.account_id = p_account_id
+      AND c.dm_queued_at >= NOW() - make_interval(days => p_days)
+      AND c.paid_at <= c.dm_sent_at + make_interval(days => p_window_days)
+      AND (p_cast_name IS NULL OR (c.dm_cast_name = p_cast_name AND c.tx_cast_name = p_cast_name))
+    GROUP BY 1
+  )
+  SELECT to_char(s.day, 'YYYY-MM-DD'), s.sent, s.success, s.error, COALESCE(c.converted, 0)
+  FROM sent s
+  LEFT JOIN conv c ON c.day = s.day
+  ORDER BY s.day;
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
+
+-- ─── キャンペーン別 再課金率（125で削除された dm_effectiveness を同じ戻り値で再作成） ───
+CREATE OR REPLACE FUNCTION public.dm_effectiveness(
+  p_account_id UUID,
+  p_window_days INTEGER DEFAULT 7,
+  p_cast_name TEXT DEFAULT NULL
+)
+RETURNS TABLE(
+  campaign TEXT,
+  dm_sent_count BIGINT,
+  reconverted_count BIGINT,
+  conversion_rate NUMERIC,
+  reconverted_tokens BIGINT
+) AS $$
+  WITH sent AS (
+    SELECT d.campaign, COUNT(DISTINCT d.user_name) AS users
+    FROM public.dm_send_log d
+    WHERE d.account_id = p_account_id
+      AND d.status = 'success'
+      AND d.campaign IS NOT NULL
+      AND d.campaign != ''
+      AND (p_cast_name IS NULL OR d.cast_name = p_cast_name)
+    GROUP BY d.campaign
+  ),
+  conv AS (
+    SELECT c.dm_campaign AS campaign,
+           COUNT(DISTINCT c.user_name) AS users,
+           SUM(c.tokens) AS tokens
+    FROM public.dm_conversions c
+    WHERE c.account_id = p_account_id
+      AND c.dm_campaign != ''
+      AND c.paid_at <= c.dm_sent_at + make_interval(days => p_window_days)
+      AND (p_cast_name IS NULL OR (c.dm_cast_name = p_cast_name AND c.tx_cast_name = p_cast_name))
+    GROUP BY c.dm_campaign
+  )
+  SELECT s.campaign,
+         s.users::BIGINT,
+         COALESCE(c.users, 0)::BIGINT,
+         ROUND(COALESCE(c.users, 0)::NUMERIC * 100.0 / NULLIF(s.users, 0), 1),
+         COALESCE(c.tokens, 0)::BIGINT
+  FROM sent s
+  LEFT JOIN conv c ON c.campaign = s.campaign
+  ORDER BY 4 DESC NULLS LAST;
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
+
+-- ─── キャンペーン別CVR（戻り値は 092 と同じ。paid_after / total_tokens を帰属済みの課金から） ───
+CREATE OR REPLACE FUNCTION get_dm_campaign_cvr(
+  p_account_id UUID DEFAULT NULL,
+  p_cast_name TEXT DEFAULT NULL,
+  p_since DATE DEFAULT (CURRENT_DATE - INTERVAL '90 days')::date
+)
+RETURNS TABLE(
+  campaign TEXT,
+  dm_sent BIGINT,
+  paid_after BIGINT,
+  visited_after BIGINT,
+  cvr_pct NUMERIC,
+  visit_cvr_pct NUMERIC,
+  total_tokens BIGINT,
+  avg_tokens_per_payer NUMERIC,
+  first_sent TIMESTAMPTZ,
+  last_sent TIMESTAMPTZ
+) AS $$
+BEGIN
+  RETURN QUERY
+  WITH dm AS (
+    -- キャンペーン×ユーザー単位で最初のDM送信を取得
+    SELECT DISTINCT ON (dsl.campaign, dsl.user_name)
+      dsl.campaign,
+      dsl.user_name,
+      dsl.queued_at,
+      dsl.sent_at,
+      dsl.account_id,
+      dsl.cast_name
+    FROM dm_send_log dsl
+    WHERE dsl.queued_at >= p_since
+      AND (p_account_id IS NULL OR dsl.account_id = p_account_id)
+      AND (p_cast_name  IS NULL OR dsl.cast_name  = p_cast_name)
+      AND dsl.campaign IS NOT NULL
+      AND dsl.campaign != ''
+      AND dsl.status = 'success'
+    ORDER BY dsl.campaign, dsl.user_name, dsl.queued_at ASC
+  ),
+  visit_flags AS (
+    -- DM送信後にspy_messagesに出現したユーザー（来場判定）
+    SELECT DISTINCT dm.campaign, dm.user_name
+    FROM dm
+    WHERE EXISTS (
+      SELECT 1 FROM spy_messages sm
+      WHERE sm.user_name = dm.user_name
+        AND sm.message_time > dm.queued_at
+        AND sm.account_id = dm.account_id
+        AND sm.cast_name  = dm.cast_name
+    )
+  ),
+  paid AS (
+    -- キャンペーンのDMに帰属した課金（p_cast_name 指定時は課金側も同キャストのみ）
+    SELECT dc.dm_campaign AS campaign,
+           COUNT(DISTINCT dc.user_name) AS payers,
+           SUM(dc.tokens) AS tokens
+    FROM dm_conversions dc
+    WHERE dc.dm_queued_at >= p_since
+      AND (p_account_id IS NULL OR dc.account_id = p_account_id)
+      AND (p_cast_name  IS NULL OR (dc.dm_cast_name = p_cast_name AND dc.tx_cast_name = p_cast_name))
+      AND dc.dm_campaign != ''
+    GROUP BY dc.dm_campaign
+  ),
+  sent AS (
+    SELECT dm.campaign,
+           COUNT(DISTINCT dm.user_name) AS users,
+           MIN(dm.queued_at) AS first_sent,
+           MAX(dm.sent_at) AS last_sent
+    FROM dm
+    GROUP BY dm.campaign
+  ),
+  visited AS (
+    SELECT vf.campaign, COUNT(*) AS users
+    FROM visit_flags vf
+    GROUP BY vf.campaign
+  )
+  SELECT
+    s.campaign,
+    s.users::BIGINT AS dm_sent,
+    COALESCE(p.payers, 0)::BIGINT AS paid_after,
+    COALESCE(v.users, 0)::BIGINT AS visited_after,
+    ROUND(COALESCE(p.payers, 0)::numeric / NULLIF(s.users, 0) * 100, 1) AS cvr_pct,
+    ROUND(COALESCE(v.users, 0)::numeric / NULLIF(s.users, 0) * 100, 1) AS visit_cvr_pct,
+    COALESCE(p.tokens, 0)::BIGINT AS total_tokens,
+    ROUND(COALESCE(p.tokens, 0)::numeric / NULLIF(p.payers, 0), 0) AS avg_tokens_per_payer,
+    s.first_sent,
+    s.last_sent
+  FROM sent s
+  LEFT JOIN paid p ON p.campaign = s.campaign
+  LEFT JOIN visited v ON v.campaign = s.campaign
+  ORDER BY dm_sent DESC, cvr_pct DESC NULLS LAST;
+END;
+$$ LANGUAGE plpgsql;
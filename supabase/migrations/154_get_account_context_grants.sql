@@ -0,0 +1,6 @@
+-- get_account_context は SECURITY DEFINER で任意の p_user_id を受け取るため、
+-- 既定の PUBLIC EXECUTE のままだと anon キーで他ユーザーのアカウント・プラン上限を引けた。
+-- 呼び出し元はバックエンド（service_role）だけなので、それ以外からの実行権限を外す。
+
+REVOKE EXECUTE ON FUNCTION public.get_account_context(UUID, UUID) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.get_account_context(UUID, UUID) TO service_role;
@@ -0,0 +1,134 @@
+-- ユーザーセグメント集計の競合とリード行の肥大化を解消
+-- 145 の trg_user_segment_rollup は members の1行ごとに (account, cast, segment) の
+-- rollup 行を更新していた。rollup 行はセグメントごとに1行しかないため、同じアカウントの
+-- 同期・チャット取り込みが並行するとそこに書き込みが集中し、ロック順が行の処理順に依存するので
+-- デッドロックも起こり得た。また spy_messages のチャットごとに members にリード行が増え、消されなかった。
+--
+--   - rollup テーブルとトリガーを廃止し、課金セグメントは読み出し時に
+--     idx_user_segment_members_rank（account, cast, segment_rank, total_tokens）から集計する
+--   - coin / chat の差分UPSERTはキー順に並べ、並行ステートメント間のロック順を固定する
+--   - 課金の無いリードは funnel の最大窓（90日）を過ぎたら prune_segment_leads で削除する
+
+DROP TRIGGER IF EXISTS trg_user_segment_rollup ON public.user_segment_members;
+DROP FUNCTION IF EXISTS public.apply_user_segment_rollup();
+DROP TABLE IF EXISTS public.user_segment_rollup;
+
+-- ─── coin_transactions → members（キー順にUPSERT） ───
+CREATE OR REPLACE FUNCTION public.apply_coin_segment_delta()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    INSERT INTO public.user_segment_members AS m
+      (account_id, cast_name, user_name, total_tokens, tx_count)
+    SELECT o.account_id, k.cast_key, o.user_name, -SUM(o.tokens), -COUNT(*)
+    FROM old_rows o
+    CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                        FROM (VALUES (COALESCE(o.cast_name, '')), ('')) v(cast_key)) k
+    GROUP BY o.account_id, k.cast_key, o.user_name
+    ORDER BY o.account_id, k.cast_key, o.user_name
+    ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+    SET total_tokens = m.total_tokens + EXCLUDED.total_tokens,
+        tx_count = m.tx_count + EXCLUDED.tx_count;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    INSERT INTO public.user_segment_members AS m
+      (account_id, cast_name, user_name, total_tokens, tx_count, first_paid, last_paid)
+    SELECT n.account_id, k.cast_key, n.user_name, SUM(n.tokens), COUNT(*), MIN(n.date), MAX(n.date)
+    FROM new_rows n
+    CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                        FROM (VALUES (COALESCE(n.cast_name, '')), ('')) v(cast_key)) k
+    GROUP BY n.account_id, k.cast_key, n.user_name
+    ORDER BY n.account_id, k.cast_key, n.user_name
+    ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+    SET total_tokens = m.total_tokens + EXCLUDED.total_tokens,
+        tx_count = m.tx_count + EXCLUDED.tx_count,
+        first_paid = LEAST(m.first_paid, EXCLUDED.first_paid),
+        last_paid = GREATEST(m.last_paid, EXCLUDED.last_paid);
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ─── spy_messages のチャット → members.last_chat_at（キー順にUPSERT） ───
+CREATE OR REPLACE FUNCTION public.apply_chat_segment_delta()
+RETURNS TRIGGER AS $$
+BEGIN
+  INSERT INTO public.user_segment_members AS m (account_id, cast_name, user_name, last_chat_at)
+  SELECT n.account_id, k.cast_key, n.user_name, MAX(n.message_time)
+  FROM new_rows n
+  CROSS JOIN LATERAL (SELECT DISTINCT v.cast_key
+                      FROM (VALUES (COALESCE(n.cast_name, '')), ('')) v(cast_key)) k
+  WHERE n.msg_type = 'chat' AND n.user_name IS NOT NULL AND n.account_id IS NOT NULL
+    AND n.message_time >= NOW() - INTERVAL '90 days'
+  GROUP BY n.account_id, k.cast_key, n.user_name
+  ORDER BY n.account_id, k.cast_key, n.user_name
+  ON CONFLICT (account_id, cast_name, user_name) DO UPDATE
+  SET last_chat_at = GREATEST(m.last_chat_at, EXCLUDED.last_chat_at)
+  WHERE m.last_chat_at IS NULL OR m.last_chat_at < EXCLUDED.last_chat_at;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ─── 読み出しRPC: 課金セグメントは members から集計（lead は期間内チャット・キャスト除外） ───
+CREATE OR REPLACE FUNCTION get_funnel_segments(
+  p_account_id UUID,
+  p_cast_name TEXT DEFAULT NULL,
+  p_since TIMESTAMPTZ DEFAULT NOW() - INTERVAL '30 days',
+  p_exclude_users TEXT[] DEFAULT '{}'
+)
+RETURNS TABLE(segment TEXT, user_count BIGINT, total_tokens BIGINT) AS $$
+  SELECT m.segment, COUNT(*), SUM(m.total_tokens)::BIGINT
+  FROM public.user_segment_members m
+  WHERE m.account_id = p_account_id
+    AND m.cast_name = COALESCE(p_cast_name, '')
+    AND m.segment_rank < 4
+  GROUP BY m.segment_rank, m.segment
+  UNION ALL
+  SELECT 'lead', COUNT(*), 0
+  FROM public.user_segment_members m
+  WHERE m.account_id = p_account_id
+    AND m.cast_name = COALESCE(p_cast_name, '')
+    AND m.tx_count <= 0
+    AND m.last_chat_at >= p_since
+    AND m.user_name <> ALL(p_exclude_users);
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
+
+-- ─── 古いリードの削除（バックエンドの定期ジョブから呼ぶ） ───
+-- 1回の呼び出しで最大 p_batch 行。戻り値が p_batch 未満になるまで繰り返す
+CREATE INDEX IF NOT EXISTS idx_user_segment_members_stale_leads
+  ON public.user_segment_members (last_chat_at) WHERE tx_count <= 0;
+
+CREATE OR REPLACE FUNCTION public.prune_segment_leads(
+  p_keep_days INTEGER DEFAULT 90,
+  p_batch INTEGER DEFAULT 10000
+)
+RETURNS INTEGER AS $$
+DECLARE
+  v_deleted INTEGER;
+BEGIN
+  DELETE FROM public.user_segment_members m
+  USING (
+    SELECT account_id, cast_name, user_name
+    FROM public.user_segment_members
+    WHERE tx_count <= 0
+      AND (last_chat_at IS NULL OR last_chat_at < NOW() - make_interval(days => p_keep_days))
+    ORDER BY account_id, cast_name, user_name
+    LIMIT p_batch
+    FOR UPDATE SKIP LOCKED
+  ) s
+  WHERE m.account_id = s.account_id
+    AND m.cast_name = s.cast_name
+    AND m.user_name = s.user_name
+    AND m.tx_count <= 0;
+  GET DIAGNOSTICS v_deleted = ROW_COUNT;
+  RETURN v_deleted;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+REVOKE EXECUTE ON FUNCTION public.prune_segment_leads(INTEGER, INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.prune_segment_leads(INTEGER, INTEGER) TO service_role;
+
+-- 既存の古いリードを一括で削除
+DELETE FROM public.user_segment_members
+WHERE tx_count <= 0
+  AND (last_chat_at IS NULL OR last_chat_at < NOW() - INTERVAL '90 days');
@@ -0,0 +1,64 @@
+-- LTV ティアは課金額のあるユーザーだけを数える
+-- 147 は tx_count > 0 で判定していたため、tokens = 0 の取引（無料アクションの記録など）しか
+-- 無いユーザーも 0-99 ティアに入っていた。total_tokens > 0 で判定し、既存の分布を数え直す。
+
+CREATE OR REPLACE FUNCTION public.apply_ltv_tier_delta()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_account UUID;
+  v_old_tier INTEGER;
+  v_new_tier INTEGER;
+BEGIN
+  IF TG_OP IN ('UPDATE', 'DELETE') THEN
+    v_account := OLD.account_id;
+    IF OLD.cast_name = '' AND OLD.total_tokens > 0 THEN
+      v_old_tier := public.ltv_tier(OLD.total_tokens);
+    END IF;
+  END IF;
+  IF TG_OP IN ('INSERT', 'UPDATE') THEN
+    v_account := NEW.account_id;
+    IF NEW.cast_name = '' AND NEW.total_tokens > 0 THEN
+      v_new_tier := public.ltv_tier(NEW.total_tokens);
+    END IF;
+  END IF;
+
+  IF v_old_tier IS NOT DISTINCT FROM v_new_tier THEN
+    RETURN NULL;
+  END IF;
+
+  INSERT INTO public.account_coin_totals (account_id) VALUES (v_account)
+  ON CONFLICT (account_id) DO NOTHING;
+  IF v_old_tier IS NOT NULL THEN
+    UPDATE public.account_coin_totals
+    SET ltv_tiers[v_old_tier] = ltv_tiers[v_old_tier] - 1, updated_at = NOW()
+    WHERE account_id = v_account;
+  END IF;
+  IF v_new_tier IS NOT NULL THEN
+    UPDATE public.account_coin_totals
+    SET ltv_tiers[v_new_tier] = ltv_tiers[v_new_tier] + 1, updated_at = NOW()
+    WHERE account_id = v_account;
+  END IF;
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- ─── 既存の分布を数え直す（該当ユーザーがいなくなったアカウントは 0 に戻す） ───
+LOCK TABLE public.account_coin_totals IN SHARE ROW EXCLUSIVE MODE;
+
+UPDATE public.account_coin_totals t
+SET ltv_tiers = COALESCE(h.tiers, '{0,0,0,0,0,0}'), updated_at = NOW()
+FROM public.account_coin_totals a
+LEFT JOIN (
+  SELECT account_id, ARRAY[
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 1),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 2),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 3),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 4),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 5),
+    COUNT(*) FILTER (WHERE public.ltv_tier(total_tokens) = 6)
+  ] AS tiers
+  FROM public.user_segment_members
+  WHERE cast_name = '' AND total_tokens > 0
+  GROUP BY account_id
+) h ON h.account_id = a.account_id
+WHERE t.account_id = a.account_id;
@@ -0,0 +1,9 @@
+-- claim_dm_queue / ack_dm_queue は SECURITY DEFINER で p_account_id の所有者を確かめないため、
+-- 既定の PUBLIC EXECUTE のままだと anon キーで他アカウントのキューをリース・確定できた。
+-- 呼び出し元はバックエンド（service_role、所有者チェック済み）だけなので、それ以外からの実行権限を外す。
+
+REVOKE EXECUTE ON FUNCTION public.claim_dm_queue(UUID, TEXT, INTEGER, INTEGER, INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.claim_dm_queue(UUID, TEXT, INTEGER, INTEGER, INTEGER) TO service_role;
+
+REVOKE EXECUTE ON FUNCTION public.ack_dm_queue(UUID, TEXT, JSONB, INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.ack_dm_queue(UUID, TEXT, JSONB, INTEGER) TO service_role;
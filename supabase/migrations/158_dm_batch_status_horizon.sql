@@ -0,0 +1,73 @@
+-- DMバッチ差分フィードのカーソルをコミット順に対して安全にする
+-- 152 の status_seq は採番順でコミット順ではないため、クライアントが items の最後の
+-- status_seq までカーソルを進めると、それより小さい番号を持つ並行トランザクションの行が
+-- 後からコミットされたときに二度と返らなかった。
+--
+-- 採番時刻（status_changed_at）を残し、返すカーソルは「採番から p_settle_seconds 以上
+-- 経った行の最大 status_seq」までに留める。status_seq は時刻順に採番されるので、
+-- その番号以下を持つ行はすべて p_settle_seconds 以上前に採番されており、
+-- dm_send_log を更新するトランザクション（claim / ack / 登録）がそれより短ければ取りこぼさない。
+-- カーソルより後ろの行は次のポーリングで再送される（items は id ごとの最新状態なので冪等）。
+
+ALTER TABLE public.dm_send_log ADD COLUMN IF NOT EXISTS status_changed_at TIMESTAMPTZ;
+
+CREATE OR REPLACE FUNCTION public.bump_dm_status_seq()
+RETURNS TRIGGER AS $$
+BEGIN
+  IF TG_OP = 'INSERT' OR NEW.status IS DISTINCT FROM OLD.status THEN
+    NEW.status_seq := nextval('public.dm_send_log_status_seq');
+    NEW.status_changed_at := clock_timestamp();
+  END IF;
+  RETURN NEW;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP FUNCTION IF EXISTS get_dm_batch_status(UUID, TEXT, BIGINT, INTEGER);
+
+-- ─── 件数 + status_seq > p_since の変更行（最大 p_limit 件）+ 次回のカーソル ───
+CREATE OR REPLACE FUNCTION get_dm_batch_status(
+  p_account_id UUID,
+  p_campaign TEXT,
+  p_since BIGINT DEFAULT 0,
+  p_limit INTEGER DEFAULT 200,
+  p_settle_seconds INTEGER DEFAULT 10
+)
+RETURNS JSONB AS $$
+  WITH items AS (
+    SELECT id, user_name, cast_name, status, error, queued_at, not_before, sent_at, status_seq
+    FROM public.dm_send_log
+    WHERE account_id = p_account_id
+      AND campaign = p_campaign
+      AND status_seq > p_since
+    ORDER BY status_seq
+    LIMIT p_limit
+  ),
+  horizon AS (
+    -- (account_id, campaign, status_seq) を後ろから読み、採番直後の行だけを読み飛ばす
+    SELECT status_seq
+    FROM public.dm_send_log
+    WHERE account_id = p_account_id
+      AND campaign = p_campaign
+      AND status_seq IS NOT NULL
+      AND (status_changed_at IS NULL
+           OR status_changed_at < NOW() - make_interval(secs => p_settle_seconds))
+    ORDER BY status_seq DESC
+    LIMIT 1
+  )
+  SELECT jsonb_build_object(
+    'counts', COALESCE((
+      SELECT jsonb_object_agg(status, n)
+      FROM (
+        SELECT status, COUNT(*) AS n
+        FROM public.dm_send_log
+        WHERE account_id = p_account_id AND campaign = p_campaign
+        GROUP BY status
+      ) c
+    ), '{}'::jsonb),
+    'items', COALESCE((SELECT jsonb_agg(to_jsonb(i) ORDER BY i.status_seq) FROM items i), '[]'::jsonb),
+    'cursor', GREATEST(
+      p_since,
+      LEAST((SELECT MAX(status_seq) FROM items), COALESCE((SELECT status_seq FROM horizon), 0))
+    )
+  );
+$$ LANGUAGE sql STABLE;
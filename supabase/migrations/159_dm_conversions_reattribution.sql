@@ -0,0 +1,138 @@
+-- DMコンバージョン帰属の取りこぼしと古い dm_id を解消
+-- 153 の帰属は書き込んだトランザクションの中でしか走らないため、
+--   - DM の success 更新と課金の INSERT が並行すると、互いに相手の未コミット行が見えず帰属されない
+--   - dm_send_log の行が削除・success 以外に戻されても dm_conversions が古い dm_id を指したまま残る
+-- ここでは
+--   - DM の削除・success からの変更で、その DM に帰属していた課金を付け替える
+--   - バックエンドの定期ジョブ（reattribute_recent_dm_conversions）で、直近に success になった DM の
+--     後30日の課金と、直近に帰属した課金のうち帰属先が無効になったものを付け直す
+-- 並行書き込みで取りこぼすのは、どちらも直近に書かれた行なので直近の窓だけ見ればよい。
+
+ALTER TABLE public.dm_conversions ADD COLUMN IF NOT EXISTS attributed_at TIMESTAMPTZ NOT NULL DEFAULT NOW();
+
+CREATE INDEX IF NOT EXISTS idx_dm_conversions_dm
+  ON public.dm_conversions (dm_id);
+CREATE INDEX IF NOT EXISTS idx_dm_conversions_attributed
+  ON public.dm_conversions (attributed_at);
+-- 158 で追加した採番時刻（success になった時刻）
+CREATE INDEX IF NOT EXISTS idx_dm_send_log_success_changed
+  ON public.dm_send_log (status_changed_at) WHERE status = 'success';
+
+-- ─── 指定した課金の帰属をやり直す（153 と同じ。付け替え時も attributed_at を更新） ───
+CREATE OR REPLACE FUNCTION public.attribute_dm_conversions(p_tx_ids BIGINT[])
+RETURNS INTEGER AS $$
+DECLARE
+  v_count INTEGER;
+BEGIN
+  DELETE FROM public.dm_conversions WHERE tx_id = ANY(p_tx_ids);
+
+  INSERT INTO public.dm_conversions AS dc
+    (tx_id, account_id, user_name, tx_cast_name, tokens, paid_at,
+     dm_id, dm_campaign, dm_cast_name, dm_queued_at, dm_sent_at)
+  SELECT ct.id, ct.account_id, ct.user_name, COALESCE(ct.cast_name, ''), ct.tokens, ct.date,
+         d.id, COALESCE(d.campaign, ''), COALESCE(d.cast_name, ''), d.queued_at, d.touched_at
+  FROM public.coin_transactions ct
+  CROSS JOIN LATERAL (
+    SELECT dsl.id, dsl.campaign, dsl.cast_name, dsl.queued_at,
+           COALESCE(dsl.sent_at, dsl.queued_at) AS touched_at
+    FROM public.dm_send_log dsl
+    WHERE dsl.account_id = ct.account_id
+      AND dsl.user_name = ct.user_name
+      AND dsl.status = 'success'
+      AND COALESCE(dsl.sent_at, dsl.queued_at) <= ct.date
+      AND COALESCE(dsl.sent_at, dsl.queued_at) > ct.date - INTERVAL '30 days'
+    ORDER BY (COALESCE(dsl.cast_name, '') = COALESCE(ct.cast_name, '')) DESC,
+             COALESCE(dsl.sent_at, dsl.queued_at) DESC,
+             dsl.id DESC
+    LIMIT 1
+  ) d
+  WHERE ct.id = ANY(p_tx_ids)
+    AND ct.tokens > 0
+  ON CONFLICT (tx_id) DO UPDATE
+  SET dm_id = EXCLUDED.dm_id,
+      dm_campaign = EXCLUDED.dm_campaign,
+      dm_cast_name = EXCLUDED.dm_cast_name,
+      dm_queued_at = EXCLUDED.dm_queued_at,
+      dm_sent_at = EXCLUDED.dm_sent_at,
+      attributed_at = NOW();
+
+  GET DIAGNOSTICS v_count = ROW_COUNT;
+  RETURN v_count;
+END;
+$$ LANGUAGE plpgsql SECURITY DEFINER;
+
+-- ─── DM が削除された → 帰属していた課金を付け替え（ステートメント単位で1回） ───
+CREATE OR REPLACE FUNCTION public.apply_dm_removed_conversions()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM public.attribute_dm_conversions(ARRAY(
+    SELECT dc.tx_id
+    FROM public.dm_conversions dc
+    JOIN old_rows o ON o.id = dc.dm_id
+  ));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_dm_removed_conversions ON public.dm_send_log;
+CREATE TRIGGER trg_dm_removed_conversions
+  AFTER DELETE ON public.dm_send_log
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_dm_removed_conversions();
+
+-- ─── DM が success 以外に戻された → 帰属していた課金を付け替え ───
+CREATE OR REPLACE FUNCTION public.apply_dm_unsuccess_conversions()
+RETURNS TRIGGER AS $$
+BEGIN
+  PERFORM public.attribute_dm_conversions(ARRAY(
+    SELECT dc.tx_id FROM public.dm_conversions dc WHERE dc.dm_id = OLD.id
+  ));
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+DROP TRIGGER IF EXISTS trg_dm_unsuccess_conversions ON public.dm_send_log;
+CREATE TRIGGER trg_dm_unsuccess_conversions
+  AFTER UPDATE OF status ON public.dm_send_log
+  FOR EACH ROW WHEN (OLD.status = 'success' AND NEW.status IS DISTINCT FROM 'success')
+  EXECUTE FUNCTION public.apply_dm_unsuccess_conversions();
+
+-- ─── 定期の付け直し（バックエンドの定期ジョブから p_hours を周期より長めに渡して呼ぶ） ───
+CREATE OR REPLACE FUNCTION public.reattribute_recent_dm_conversions(p_hours INTEGER DEFAULT 2)
+RETURNS INTEGER AS $$
+  SELECT public.attribute_dm_conversions(ARRAY(
+    -- 直近に success になったDMの後30日の課金（課金と並行してコミットされたDM）
+    SELECT ct.id
+    FROM public.dm_send_log d
+    JOIN public.coin_transactions ct
+      ON ct.account_id = d.account_id
+     AND ct.user_name = d.user_name
+     AND ct.date >= COALESCE(d.sent_at, d.queued_at)
+     AND ct.date < COALESCE(d.sent_at, d.queued_at) + INTERVAL '30 days'
+     AND ct.tokens > 0
+    WHERE d.status = 'success'
+      AND d.status_changed_at >= NOW() - make_interval(hours => p_hours)
+    UNION
+    -- 直近に帰属した課金のうち、帰属先DMが消えた・success でなくなったもの
+    SELECT dc.tx_id
+    FROM public.dm_conversions dc
+    WHERE dc.attributed_at >= NOW() - make_interval(hours => p_hours)
+      AND NOT EXISTS (
+        SELECT 1 FROM public.dm_send_log d
+        WHERE d.id = dc.dm_id AND d.status = 'success'
+      )
+  ));
+$$ LANGUAGE sql SECURITY DEFINER;
+
+REVOKE EXECUTE ON FUNCTION public.reattribute_recent_dm_conversions(INTEGER) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.reattribute_recent_dm_conversions(INTEGER) TO service_role;
+
+-- ─── 既存の古い dm_id を付け直す ───
+SELECT public.attribute_dm_conversions(ARRAY(
+  SELECT dc.tx_id
+  FROM public.dm_conversions dc
+  WHERE NOT EXISTS (
+    SELECT 1 FROM public.dm_send_log d
+    WHERE d.id = dc.dm_id AND d.status = 'success'
+  )
+));
@@ -0,0 +1,6 @@
+-- ADM daemon（backend/services/adm_daemon.py）の課金ポーリング用
+-- id の透かしより小さい id で遅れてコミットされた課金を、created_at の重なり窓で読み直す。
+-- 起動直後の見返し（created_at >= 起動10分前）も同じインデックスで引く。
+
+CREATE INDEX IF NOT EXISTS idx_coin_tx_account_created
+  ON public.coin_transactions (account_id, created_at);
@@ -0,0 +1,157 @@
+-- user_segment_rollup を保持したまま、差分の反映をステートメント単位にする
+-- 155 は rollup を廃止して読み出し時に members を集計したが、それでは get_funnel_segments が
+-- 呼び出しのたびにアカウントの members 全行を読む。競合・デッドロックの原因は rollup ではなく
+-- members の行トリガーで、行の処理順に rollup 行（と 147 の account_coin_totals 行）を
+-- 1行ずつロックしていたことにある。
+--
+--   - rollup を作り直し、members の変化はステートメントごとに (account, cast, segment) へ
+--     集約してキー順に1回だけUPSERTする
+--   - LTV ティア（147 / 156 の行トリガー）も同じステートメントトリガーでアカウントごとに1回反映する
+--   - ロック順は常に members（キー順）→ rollup（キー順）→ account_coin_totals（アカウント順）
+
+CREATE TABLE IF NOT EXISTS public.user_segment_rollup (
+  account_id UUID NOT NULL REFERENCES public.accounts(id) ON DELETE CASCADE,
+  cast_name TEXT NOT NULL DEFAULT '',
+  segment TEXT NOT NULL,
+  user_count BIGINT NOT NULL DEFAULT 0,
+  total_tokens BIGINT NOT NULL DEFAULT 0,
+  PRIMARY KEY (account_id, cast_name, segment)
+);
+
+ALTER TABLE public.user_segment_rollup ENABLE ROW LEVEL SECURITY;
+
+DROP TRIGGER IF EXISTS trg_ltv_tier_delta ON public.user_segment_members;
+DROP FUNCTION IF EXISTS public.apply_ltv_tier_delta();
+
+-- ─── members の変化 → rollup / ltv_tiers（ステートメント単位で集約） ───
+-- 変化した行を (符号, 行) の一覧にまとめ、両方の集計で共有する
+CREATE OR REPLACE FUNCTION public.apply_user_segment_deltas()
+RETURNS TRIGGER AS $$
+DECLARE
+  v_rows JSONB;
+BEGIN
+  IF TG_OP = 'INSERT' THEN
+    SELECT jsonb_agg(jsonb_build_object(
+             'a', n.account_id, 'c', n.cast_name, 's', n.segment, 'v', n.total_tokens, 'n', 1))
+    INTO v_rows
+    FROM new_rows n;
+  ELSIF TG_OP = 'DELETE' THEN
+    SELECT jsonb_agg(jsonb_build_object(
+             'a', o.account_id, 'c', o.cast_name, 's', o.segment, 'v', o.total_tokens, 'n', -1))
+    INTO v_rows
+    FROM old_rows o;
+  ELSE
+    -- last_chat_at だけの更新（チャット取り込み）は集計に影響しないので除く
+    SELECT jsonb_agg(x.r)
+    INTO v_rows
+    FROM (
+      SELECT jsonb_build_object('a', n.account_id, 'c', n.cast_name, 's', n.segment, 'v', n.total_tokens, 'n', 1) AS r
+      FROM new_rows n
+      JOIN old_rows o USING (account_id, cast_name, user_name)
+      WHERE n.total_tokens IS DISTINCT FROM o.total_tokens OR n.tx_count IS DISTINCT FROM o.tx_count
+      UNION ALL
+      SELECT jsonb_build_object('a', o.account_id, 'c', o.cast_name, 's', o.segment, 'v', o.total_tokens, 'n', -1)
+      FROM new_rows n
+      JOIN old_rows o USING (account_id, cast_name, user_name)
+      WHERE n.total_tokens IS DISTINCT FROM o.total_tokens OR n.tx_count IS DISTINCT FROM o.tx_count
+    ) x;
+  END IF;
+
+  IF v_rows IS NULL THEN
+    RETURN NULL;
+  END IF;
+
+  INSERT INTO public.user_segment_rollup AS r (account_id, cast_name, segment, user_count, total_tokens)
+  SELECT d.a, d.c, d.s, SUM(d.n), SUM(d.n * d.v)
+  FROM jsonb_to_recordset(v_rows) AS d(a UUID, c TEXT, s TEXT, v BIGINT, n INTEGER)
+  GROUP BY d.a, d.c, d.s
+  HAVING SUM(d.n) <> 0 OR SUM(d.n * d.v) <> 0
+  ORDER BY d.a, d.c, d.s
+  ON CONFLICT (account_id, cast_name, segment) DO UPDATE
+  SET user_count = r.user_count + EXCLUDED.user_count,
+      total_tokens = r.total_tokens + EXCLUDED.total_tokens;
+
+  -- LTV ティアはアカウント全体行（cast_name = ''）の課金額のあるユーザーだけ（156）
+  INSERT INTO public.account_coin_totals AS t (account_id, ltv_tiers)
+  SELECT h.a, ARRAY[
+    COALESCE(SUM(h.n) FILTER (WHERE h.tier = 1), 0),
+    COALESCE(SUM(h.n) FILTER (WHERE h.tier = 2), 0),
+    COALESCE(SUM(h.n) FILTER (WHERE h.tier = 3), 0),
+    COALESCE(SUM(h.n) FILTER (WHERE h.tier = 4), 0),
+    COALESCE(SUM(h.n) FILTER (WHERE h.tier = 5), 0),
+    COALESCE(SUM(h.n) FILTER (WHERE h.tier = 6), 0)
+  ]::BIGINT[]
+  FROM (
+    SELECT d.a, public.ltv_tier(d.v) AS tier, d.n
+    FROM jsonb_to_recordset(v_rows) AS d(a UUID, c TEXT, v BIGINT, n INTEGER)
+    WHERE d.c = '' AND d.v > 0
+  ) h
+  GROUP BY h.a
+  ORDER BY h.a
+  ON CONFLICT (account_id) DO UPDATE
+  SET ltv_tiers = ARRAY[
+        t.ltv_tiers[1] + EXCLUDED.ltv_tiers[1],
+        t.ltv_tiers[2] + EXCLUDED.ltv_tiers[2],
+        t.ltv_tiers[3] + EXCLUDED.ltv_tiers[3],
+        t.ltv_tiers[4] + EXCLUDED.ltv_tiers[4],
+        t.ltv_tiers[5] + EXCLUDED.ltv_tiers[5],
+        t.ltv_tiers[6] + EXCLUDED.ltv_tiers[6]
+      ]::BIGINT[],
+      updated_at = NOW()
+  WHERE EXCLUDED.ltv_tiers <> '{0,0,0,0,0,0}';
+
+  RETURN NULL;
+END;
+$$ LANGUAGE plpgsql;
+
+-- INSERT ... ON CONFLICT DO UPDATE では INSERT / UPDATE の両方が、それぞれの行だけで発火する
+DROP TRIGGER IF EXISTS trg_user_segment_deltas_insert ON public.user_segment_members;
+CREATE TRIGGER trg_user_segment_deltas_insert
+  AFTER INSERT ON public.user_segment_members
+  REFERENCING NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_user_segment_deltas();
+
+DROP TRIGGER IF EXISTS trg_user_segment_deltas_update ON public.user_segment_members;
+CREATE TRIGGER trg_user_segment_deltas_update
+  AFTER UPDATE ON public.user_segment_members
+  REFERENCING OLD TABLE AS old_rows NEW TABLE AS new_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_user_segment_deltas();
+
+DROP TRIGGER IF EXISTS trg_user_segment_deltas_delete ON public.user_segment_members;
+CREATE TRIGGER trg_user_segment_deltas_delete
+  AFTER DELETE ON public.user_segment_members
+  REFERENCING OLD TABLE AS old_rows
+  FOR EACH STATEMENT EXECUTE FUNCTION public.apply_user_segment_deltas();
+
+-- ─── 初期データ（トリガー切り替えの間の書き込みを止めて members から数え直す） ───
+LOCK TABLE public.user_segment_members IN SHARE ROW EXCLUSIVE MODE;
+
+DELETE FROM public.user_segment_rollup;
+INSERT INTO public.user_segment_rollup (account_id, cast_name, segment, user_count, total_tokens)
+SELECT account_id, cast_name, segment, COUNT(*), SUM(total_tokens)
+FROM public.user_segment_members
+GROUP BY account_id, cast_name, segment;
+
+-- ─── 読み出しRPC: rollup を読む（lead は期間内チャット・キャスト除外） ───
+CREATE OR REPLACE FUNCTION get_funnel_segments(
+  p_account_id UUID,
+  p_cast_name TEXT DEFAULT NULL,
+  p_since TIMESTAMPTZ DEFAULT NOW() - INTERVAL '30 days',
+  p_exclude_users TEXT[] DEFAULT '{}'
+)
+RETURNS TABLE(segment TEXT, user_count BIGINT, total_tokens BIGINT) AS $$
+  SELECT r.segment, r.user_count, r.total_tokens
+  FROM public.user_segment_rollup r
+  WHERE r.account_id = p_account_id
+    AND r.cast_name = COALESCE(p_cast_name, '')
+    AND r.segment <> 'lead'
+    AND r.user_count > 0
+  UNION ALL
+  SELECT 'lead', COUNT(*), 0
+  FROM public.user_segment_members m
+  WHERE m.account_id = p_account_id
+    AND m.cast_name = COALESCE(p_cast_name, '')
+    AND m.tx_count <= 0
+    AND m.last_chat_at >= p_since
+    AND m.user_name <> ALL(p_exclude_users);
+$$ LANGUAGE sql STABLE SECURITY DEFINER;
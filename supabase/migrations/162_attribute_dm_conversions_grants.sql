@@ -0,0 +1,14 @@
+-- attribute_dm_conversions（153 / 159）は SECURITY DEFINER で任意の課金IDを受け取るため、
+-- 既定の PUBLIC EXECUTE のままだと anon / authenticated が PostgREST 経由で dm_conversions を
+-- 削除・書き換えでき、巨大な配列で重い処理もさせられた。実行権限は service_role だけにする。
+--
+-- 呼び出し元のトリガー関数は書き込んだロール（フロントエンドの authenticated を含む）で動くため、
+-- そちらを SECURITY DEFINER にして所有者の権限で呼ぶ（トリガー関数は直接は呼べない）。
+
+REVOKE EXECUTE ON FUNCTION public.attribute_dm_conversions(BIGINT[]) FROM PUBLIC, anon, authenticated;
+GRANT EXECUTE ON FUNCTION public.attribute_dm_conversions(BIGINT[]) TO service_role;
+
+ALTER FUNCTION public.apply_coin_dm_conversions() SECURITY DEFINER SET search_path = public;
+ALTER FUNCTION public.apply_dm_success_conversions() SECURITY DEFINER SET search_path = public;
+ALTER FUNCTION public.apply_dm_removed_conversions() SECURITY DEFINER SET search_path = public;
+ALTER FUNCTION public.apply_dm_unsuccess_conversions() SECURITY DEFINER SET search_path = public;
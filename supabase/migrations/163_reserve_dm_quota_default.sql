@@ -0,0 +1,23 @@
+-- reserve_dm_quota（151）の既定上限を他と揃える
+-- max_dm_per_month が NULL のとき 500 として予約していたが、001 のスキーマ既定値・
+-- get_account_context（140）・API（auth.py / schemas.py）はいずれも 10 として扱う。
+-- 画面上の上限が 10 なのに月500件まで登録できていたので 10 にする。
+
+CREATE OR REPLACE FUNCTION reserve_dm_quota(
+  p_user_id UUID,
+  p_requested INTEGER
+)
+RETURNS INTEGER AS $$
+  WITH quota AS (
+    SELECT id,
+           GREATEST(LEAST(p_requested, COALESCE(max_dm_per_month, 10) - COALESCE(dm_used_this_month, 0)), 0) AS granted
+    FROM public.profiles
+    WHERE id = p_user_id
+    FOR UPDATE
+  )
+  UPDATE public.profiles p
+  SET dm_used_this_month = COALESCE(p.dm_used_this_month, 0) + c.granted
+  FROM quota c
+  WHERE p.id = c.id
+  RETURNING c.granted;
+$$ LANGUAGE sql;